@@ -42,22 +42,111 @@ DB_NAME = "telegram_bot"
 
 DB_PATH = "database.db"
 
+# تجمع اتصالات مشترك يُنشأ مرة واحدة عند تشغيل البوت
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+DB_POOL_RECYCLE = 3600  # ثانية، أقل من wait_timeout في MySQL
+
+db_pool = None
+db_pool_lock = asyncio.Lock()
+
+
+async def init_db_pool():
+    """إنشاء تجمع الاتصالات إن لم يكن موجوداً"""
+    global db_pool
+    async with db_pool_lock:
+        if db_pool is None:
+            db_pool = await aiomysql.create_pool(
+                host=DB_HOST,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                db=DB_NAME,
+                port=DB_PORT,
+                charset='utf8mb4',
+                autocommit=False,
+                minsize=DB_POOL_MIN_SIZE,
+                maxsize=DB_POOL_MAX_SIZE,
+                pool_recycle=DB_POOL_RECYCLE
+            )
+            logging.info("✅ تم إنشاء تجمع اتصالات MySQL.")
+    return db_pool
+
+
+async def close_db_pool(application=None):
+    """إغلاق تجمع الاتصالات عند إيقاف البوت"""
+    global db_pool
+    if db_pool is not None:
+        db_pool.close()
+        await db_pool.wait_closed()
+        db_pool = None
+        logging.info("🛑 تم إغلاق تجمع اتصالات MySQL.")
+
+
 @asynccontextmanager
 async def get_db_connection():
-    """دالة للاتصال بقاعدة بيانات MySQL"""
-    conn = await aiomysql.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        db=DB_NAME,
-        port=DB_PORT,
-        charset='utf8mb4',
-        autocommit=False
+    """دالة للحصول على اتصال بقاعدة بيانات MySQL من التجمع المشترك"""
+    pool = db_pool or await init_db_pool()
+    async with pool.acquire() as conn:
+        try:
+            yield conn
+        finally:
+            # التراجع عن أي معاملة لم يتم تأكيدها قبل إعادة الاتصال للتجمع
+            if conn.get_transaction_status():
+                try:
+                    await conn.rollback()
+                except Exception:
+                    conn.close()
+
+
+async def bump_catalog_version(cursor, scope, scope_id=0):
+    """تسجيل تغيير في الكتالوج ضمن نفس معاملة التعديل ليحدّث بوت المستخدم ذاكرته
+    scope: "restaurant" أو "city" أو "geo" (المحافظات والمدن) أو "all"
+    """
+    await cursor.execute("""
+        INSERT INTO catalog_version (scope, scope_id, version) VALUES (%s, %s, 1)
+        ON DUPLICATE KEY UPDATE version = version + 1
+    """, (scope, scope_id))
+
+
+async def remove_user_ratings_from_summary(cursor, user_ids):
+    """طرح تقييمات المستخدمين من ملخص التقييمات قبل حذفهم (الحذف المتسلسل لا يحدّث الملخص)"""
+    if not user_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    await cursor.execute(
+        f"""
+        UPDATE restaurant_rating_summary s
+        JOIN (
+            SELECT restaurant_id, COUNT(*) AS cnt, COALESCE(SUM(rating), 0) AS total
+            FROM restaurant_ratings
+            WHERE user_id IN ({placeholders})
+            GROUP BY restaurant_id
+        ) r ON r.restaurant_id = s.restaurant_id
+        SET s.rating_count = s.rating_count - r.cnt,
+            s.rating_sum = s.rating_sum - r.total
+        """,
+        list(user_ids)
     )
-    try:
-        yield conn
-    finally:
-        conn.close()
+
+
+async def bump_restaurant_version(cursor, restaurant_id=None, restaurant_name=None, category_id=None, meal_id=None):
+    """رفع نسخة المطعم انطلاقًا من أي معرف متوفر (يُستدعى قبل الحذف لا بعده)"""
+    if restaurant_id is None:
+        if meal_id is not None:
+            await cursor.execute("""
+                SELECT c.restaurant_id FROM meals m
+                JOIN categories c ON c.id = m.category_id
+                WHERE m.id = %s
+            """, (meal_id,))
+        elif category_id is not None:
+            await cursor.execute("SELECT restaurant_id FROM categories WHERE id = %s", (category_id,))
+        else:
+            await cursor.execute("SELECT id FROM restaurants WHERE name = %s", (restaurant_name,))
+        row = await cursor.fetchone()
+        if not row:
+            return
+        restaurant_id = row[0]
+    await bump_catalog_version(cursor, "restaurant", restaurant_id)
 
 
 async def setup_location_tables():
@@ -151,6 +240,18 @@ async def setup_menu_tables():
                 if not has_image_message_id:
                     await cursor.execute("ALTER TABLE meals ADD COLUMN image_message_id INT")
 
+                # نسخ الكتالوج التي يراقبها بوت المستخدم لتحديث ذاكرته
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS catalog_version (
+                        scope VARCHAR(16) NOT NULL,
+                        scope_id INT NOT NULL DEFAULT 0,
+                        version BIGINT NOT NULL DEFAULT 1,
+                        updated_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+                        PRIMARY KEY (scope, scope_id),
+                        INDEX idx_catalog_version_updated (updated_at)
+                    )
+                """)
+
             await conn.commit()
     except Exception as e:
         logging.error(f"❌ خطأ في setup_menu_tables: {e}")
@@ -197,6 +298,8 @@ async def ensure_meals_have_price():
     async with get_db_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute("UPDATE meals SET price = 0 WHERE price IS NULL")
+            if cursor.rowcount:
+                await bump_catalog_version(cursor, "all")
         await conn.commit()
         print("✅ تم تعيين السعر 0 للوجبات التي كانت بدون سعر.")
 
@@ -204,6 +307,8 @@ async def ensure_size_options_not_null():
     async with get_db_connection() as conn:
         async with conn.cursor() as cursor:
             await cursor.execute("UPDATE meals SET size_options = '[]' WHERE size_options IS NULL")
+            if cursor.rowcount:
+                await bump_catalog_version(cursor, "all")
         await conn.commit()
         print("✅ تم تحويل size_options = NULL إلى '[]'.")
 
@@ -313,6 +418,9 @@ async def normalize_size_options():
             except Exception as e: 
                 print(f"❌ خطأ في معالجة الوجبة ID={meal_id}: {e}")
 
+        if updated_count:
+            async with conn.cursor() as cursor:
+                await bump_catalog_version(cursor, "all")
         await conn.commit()
         print(f"✅ تم تحديث {updated_count} وجبة إلى الصيغة الجديدة.")
 
@@ -462,6 +570,7 @@ async def handle_province_name(update: Update, context: ContextTypes.DEFAULT_TYP
                 if action == "add":
                     try:
                         await cursor.execute("INSERT INTO provinces (name) VALUES (%s)", (province_name,))
+                        await bump_catalog_version(cursor, "geo")
                         await conn.commit()
                         await update.message.reply_text(f"✅ تم إضافة المحافظة: {province_name}")
                     except pymysql.err.IntegrityError:
@@ -491,13 +600,16 @@ async def handle_province_name(update: Update, context: ContextTypes.DEFAULT_TYP
                             await cursor.execute("DELETE FROM meals WHERE category_id IN (SELECT id FROM categories WHERE restaurant_id = %s)", (rest_id,))
                             await cursor.execute("DELETE FROM categories WHERE restaurant_id = %s", (rest_id,))
                             await cursor.execute("DELETE FROM restaurants WHERE id = %s", (rest_id,))
+                            await bump_restaurant_version(cursor, rest_id)
 
                     await cursor.execute("DELETE FROM cities WHERE province_id = %s", (province_id,))
                     await cursor.execute("DELETE FROM provinces WHERE id = %s", (province_id,))
+                    await bump_catalog_version(cursor, "all")
                     await cursor.execute("SELECT user_id FROM user_data WHERE province = %s", (province_name,))
                     users_data = await cursor.fetchall()
                     users = [row[0] for row in users_data]
 
+                    await remove_user_ratings_from_summary(cursor, users)
                     for user_id in users:
                         await cursor.execute("DELETE FROM user_data WHERE user_id = %s", (user_id,))
                         try:
@@ -522,6 +634,7 @@ async def handle_province_name(update: Update, context: ContextTypes.DEFAULT_TYP
                     new_name = province_name
                     try:
                         await cursor.execute("UPDATE provinces SET name = %s WHERE name = %s", (new_name, old_name))
+                        await bump_catalog_version(cursor, "geo")
                         await cursor.execute("UPDATE user_data SET province = %s WHERE province = %s", (new_name, old_name))
                         await conn.commit()
                         await update.message.reply_text(f"✅ تم تعديل اسم المحافظة من '{old_name}' إلى '{new_name}'.")
@@ -751,6 +864,7 @@ async def handle_city_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             "INSERT INTO cities (name, province_id, ads_channel) VALUES (%s, %s, %s)",
                             (city_name, province_id, ads_channel)
                         )
+                        await bump_catalog_version(cursor, "geo")
                         await conn.commit()
                         await update.message.reply_text(f"✅ تم إضافة المدينة '{city_name}' بنجاح.")
                     except pymysql.err.IntegrityError:
@@ -764,6 +878,7 @@ async def handle_city_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 # 🟡 حذف مدينة
                 elif action == "delete_city":
                     await cursor.execute("DELETE FROM cities WHERE name = %s AND province_id = %s", (text, province_id))
+                    await bump_catalog_version(cursor, "all")
                     await conn.commit()
                     await update.message.reply_text(f"🗑️ تم حذف المدينة '{text}' بنجاح.")
 
@@ -793,6 +908,7 @@ async def handle_city_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                         # تحديث اسم المدينة
                         await cursor.execute("UPDATE cities SET name = %s WHERE id = %s", (new_name, city_id))
+                        await bump_catalog_version(cursor, "geo")
 
                         # تحديث المستخدمين الذين ينتمون لهذه المدينة
                         await cursor.execute("UPDATE user_data SET city_id = %s WHERE city_id = %s", (city_id, city_id))
@@ -1341,9 +1457,11 @@ async def confirm_delete_restaurant(update: Update, context: ContextTypes.DEFAUL
 
                 # حذف التقييمات
                 await cursor.execute("DELETE FROM restaurant_ratings WHERE restaurant_id = %s", (restaurant_id,))
+                await cursor.execute("DELETE FROM restaurant_rating_summary WHERE restaurant_id = %s", (restaurant_id,))
 
                 # حذف المطعم
                 await cursor.execute("DELETE FROM restaurants WHERE id = %s", (restaurant_id,))
+                await bump_restaurant_version(cursor, restaurant_id)
 
                 await conn.commit()
 
@@ -1472,6 +1590,7 @@ async def handle_restaurant_name(update: Update, context: ContextTypes.DEFAULT_T
                     """, (restaurant_id,))
                     await cursor.execute("DELETE FROM categories WHERE restaurant_id = %s", (restaurant_id,))
                     await cursor.execute("DELETE FROM restaurants WHERE id = %s", (restaurant_id,))
+                    await bump_restaurant_version(cursor, restaurant_id)
                     await conn.commit()
 
             await update.message.reply_text(f"🗑️ تم حذف المطعم '{name}' وكل ما يتعلق به.")
@@ -1546,6 +1665,7 @@ async def handle_close_hour(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     INSERT INTO restaurants (name, city_id, channel, open_hour, close_hour)
                     VALUES (%s, %s, %s, %s, %s)
                 """, (name, city_id, channel, open_hour, close_hour))
+                await bump_catalog_version(cursor, "city", city_id)
                 await conn.commit()
 
         await update.message.reply_text(f"✅ تم إضافة المطعم '{name}' بنجاح.")
@@ -1705,16 +1825,17 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return await start(update, context)
     
         try:
-           async with get_db_connection() as conn:
-               async with conn.cursor() as cursor:
-                   await cursor.execute("""
-                       UPDATE meals SET name = %s
-                       WHERE name = %s AND category_id = %s
-                   """, (new_name, old_name, category_id))
-                   await conn.commit()
-           await update.message.reply_text(f"✅ تم تعديل اسم الوجبة إلى: {new_name}")
-       except pymysql.err.IntegrityError:
-           await update.message.reply_text("⚠️ هناك وجبة بهذا الاسم موجودة مسبقًا.")
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        UPDATE meals SET name = %s
+                        WHERE name = %s AND category_id = %s
+                    """, (new_name, old_name, category_id))
+                    await bump_restaurant_version(cursor, category_id=category_id)
+                    await conn.commit()
+            await update.message.reply_text(f"✅ تم تعديل اسم الوجبة إلى: {new_name}")
+        except pymysql.err.IntegrityError:
+            await update.message.reply_text("⚠️ هناك وجبة بهذا الاسم موجودة مسبقًا.")
         except Exception as e:
             logging.error(f"خطأ في تعديل اسم الوجبة: {e}", exc_info=True)
             await update.message.reply_text("❌ حدث خطأ أثناء تعديل اسم الوجبة.")
@@ -1751,6 +1872,7 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
                               WHERE name = %s AND category_id = %s
                           """, (new_price, meal_name, category_id))
 
+                        await bump_restaurant_version(cursor, category_id=category_id)
                         await conn.commit()
                         await update.message.reply_text(f"✅ تم تعديل سعر '{meal_name}' إلى {new_price} ل.س.")
     
@@ -1798,6 +1920,7 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
                              category_id
                          ))
 
+                        await bump_restaurant_version(cursor, category_id=category_id)
                         await conn.commit()
     
                         await update.message.reply_text(f"✅ تم تعديل سعر '{meal_name}' بنجاح.")
@@ -1819,6 +1942,7 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
             async with get_db_connection() as conn:
                 async with conn.cursor() as cursor:
                     await cursor.execute("UPDATE meals SET caption = %s WHERE id = %s", (new_caption, meal_id))
+                    await bump_restaurant_version(cursor, meal_id=meal_id)
                     await conn.commit()
             await update.message.reply_text("✅ تم تعديل وصف الوجبة بنجاح.")
         except Exception as e:
@@ -1905,6 +2029,7 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
                          category_id
                      ))
 
+                    await bump_restaurant_version(cursor, category_id=category_id)
                     await conn.commit()
     
             await update.message.reply_text("✅ تم حذف القياس بنجاح.")
@@ -1917,136 +2042,139 @@ async def handle_text_inputs(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return await show_meal_management_menu(update, context)
     
     # ✅ استقبال قياس جديد أثناء تعديل القياسات
-elif context.user_data.get("edit_step") == "add_single_size":
-    if "/" not in text:
-        await update.message.reply_text("⚠️ الصيغة غير صحيحة. أرسلها مثل: وسط/6000")
-        return
+    elif context.user_data.get("edit_step") == "add_single_size":
+        if "/" not in text:
+            await update.message.reply_text("⚠️ الصيغة غير صحيحة. أرسلها مثل: وسط/6000")
+            return
 
-    size_name, price_str = text.split("/", 1)
-    try:
-        price = int(price_str)
-    except ValueError:
-        await update.message.reply_text("⚠️ السعر غير صالح. أرسل رقمًا فقط.")
-        return
+        size_name, price_str = text.split("/", 1)
+        try:
+            price = int(price_str)
+        except ValueError:
+            await update.message.reply_text("⚠️ السعر غير صالح. أرسل رقمًا فقط.")
+            return
 
-    new_size = {"name": size_name.strip(), "price": price}
-    meal_name = context.user_data.get("meal_to_edit_sizes")
-    category_id = context.user_data.get("selected_category_id")
+        new_size = {"name": size_name.strip(), "price": price}
+        meal_name = context.user_data.get("meal_to_edit_sizes")
+        category_id = context.user_data.get("selected_category_id")
 
-    if not category_id:
-        await update.message.reply_text("❌ لم يتم تحديد الفئة. يرجى البدء من جديد.")
-        return await start(update, context)
+        if not category_id:
+            await update.message.reply_text("❌ لم يتم تحديد الفئة. يرجى البدء من جديد.")
+            return await start(update, context)
 
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                # جلب القياسات الحالية
-                await cursor.execute("""
-                    SELECT size_options FROM meals
-                    WHERE name = %s AND category_id = %s
-                """, (meal_name, category_id))
-                result = await cursor.fetchone()
+        try:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    # جلب القياسات الحالية
+                    await cursor.execute("""
+                        SELECT size_options FROM meals
+                        WHERE name = %s AND category_id = %s
+                    """, (meal_name, category_id))
+                    result = await cursor.fetchone()
 
-                sizes = json.loads(result[0]) if result and result[0] else []
-                sizes.append(new_size)
+                    sizes = json.loads(result[0]) if result and result[0] else []
+                    sizes.append(new_size)
 
-                # تحديث الوجبة
-                await cursor.execute("""
-                    UPDATE meals SET size_options = %s, price = %s
-                    WHERE name = %s AND category_id = %s
-                """, (
-                    json.dumps(sizes, ensure_ascii=False),
-                    max([s["price"] for s in sizes]),
-                    meal_name,
-                    category_id
-                ))
-                await conn.commit()
+                    # تحديث الوجبة
+                    await cursor.execute("""
+                        UPDATE meals SET size_options = %s, price = %s
+                        WHERE name = %s AND category_id = %s
+                    """, (
+                        json.dumps(sizes, ensure_ascii=False),
+                        max([s["price"] for s in sizes]),
+                        meal_name,
+                        category_id
+                    ))
+                    await bump_restaurant_version(cursor, category_id=category_id)
+                    await conn.commit()
 
-        await update.message.reply_text("✅ تم إضافة القياس الجديد بنجاح.")
-        context.user_data.clear()
-        return await show_meal_management_menu(update, context)
+            await update.message.reply_text("✅ تم إضافة القياس الجديد بنجاح.")
+            context.user_data.clear()
+            return await show_meal_management_menu(update, context)
 
-    except Exception as e:
-        logging.error(f"❌ خطأ أثناء إضافة قياس جديد: {e}", exc_info=True)
-        await update.message.reply_text("❌ حدث خطأ أثناء إضافة القياس.")
-        return await start(update, context)
+        except Exception as e:
+            logging.error(f"❌ خطأ أثناء إضافة قياس جديد: {e}", exc_info=True)
+            await update.message.reply_text("❌ حدث خطأ أثناء إضافة القياس.")
+            return await start(update, context)
 
 
-elif context.user_data.get("meal_action") == "edit_sizes" and context.user_data.get("edit_step") == "add_sizes_to_empty":
-    try:
-        sizes = [s.strip() for s in text.split(",")]
-        formatted_sizes = []
+    elif context.user_data.get("meal_action") == "edit_sizes" and context.user_data.get("edit_step") == "add_sizes_to_empty":
+        try:
+            sizes = [s.strip() for s in text.split(",")]
+            formatted_sizes = []
 
-        for s in sizes:
-            if "/" not in s:
-                raise ValueError("صيغة غير صحيحة.")
-            name, price = s.split("/")
-            formatted_sizes.append({"name": name.strip(), "price": int(price.strip())})
+            for s in sizes:
+                if "/" not in s:
+                    raise ValueError("صيغة غير صحيحة.")
+                name, price = s.split("/")
+                formatted_sizes.append({"name": name.strip(), "price": int(price.strip())})
 
-        meal_name = context.user_data.get("meal_to_edit_sizes")
-        category_id = context.user_data.get("selected_category_id")
+            meal_name = context.user_data.get("meal_to_edit_sizes")
+            category_id = context.user_data.get("selected_category_id")
 
-        if not category_id:
-            await update.message.reply_text("❌ لم يتم تحديد الفئة.")
-            return await start(update, context)
+            if not category_id:
+                await update.message.reply_text("❌ لم يتم تحديد الفئة.")
+                return await start(update, context)
 
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    UPDATE meals SET size_options = %s, price = %s
-                    WHERE name = %s AND category_id = %s
-                """, (
-                    json.dumps(formatted_sizes, ensure_ascii=False),
-                    max(s["price"] for s in formatted_sizes),
-                    meal_name,
-                    category_id
-                ))
-                await conn.commit()
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        UPDATE meals SET size_options = %s, price = %s
+                        WHERE name = %s AND category_id = %s
+                    """, (
+                        json.dumps(formatted_sizes, ensure_ascii=False),
+                        max(s["price"] for s in formatted_sizes),
+                        meal_name,
+                        category_id
+                    ))
+                    await bump_restaurant_version(cursor, category_id=category_id)
+                    await conn.commit()
 
-        await update.message.reply_text("✅ تم حفظ القياسات بنجاح.")
-        for key in ["meal_action", "edit_step", "meal_to_edit_sizes"]:
-            context.user_data.pop(key, None)
-        return await show_meal_management_menu(update, context)
+            await update.message.reply_text("✅ تم حفظ القياسات بنجاح.")
+            for key in ["meal_action", "edit_step", "meal_to_edit_sizes"]:
+                context.user_data.pop(key, None)
+            return await show_meal_management_menu(update, context)
 
-    except Exception as e:
-        logging.error(f"❌ خطأ أثناء حفظ القياسات الجديدة: {e}", exc_info=True)
-        await update.message.reply_text("❌ تأكد من كتابة القياسات بشكل صحيح مثل: كبير/5000, صغير/3000")
-        return
+        except Exception as e:
+            logging.error(f"❌ خطأ أثناء حفظ القياسات الجديدة: {e}", exc_info=True)
+            await update.message.reply_text("❌ تأكد من كتابة القياسات بشكل صحيح مثل: كبير/5000, صغير/3000")
+            return
 
-elif context.user_data.get("category_action") == "add":
-    category_name = text
-    restaurant_name = context.user_data.get("selected_restaurant_category")
+    elif context.user_data.get("category_action") == "add":
+        category_name = text
+        restaurant_name = context.user_data.get("selected_restaurant_category")
 
-    if not restaurant_name:
-        await update.message.reply_text("⚠️ لم يتم تحديد المطعم. يرجى العودة واختياره من جديد.")
-        return
+        if not restaurant_name:
+            await update.message.reply_text("⚠️ لم يتم تحديد المطعم. يرجى العودة واختياره من جديد.")
+            return
 
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT id FROM restaurants WHERE name = %s", (restaurant_name,))
-                result = await cursor.fetchone()
+        try:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("SELECT id FROM restaurants WHERE name = %s", (restaurant_name,))
+                    result = await cursor.fetchone()
 
-                if not result:
-                    await update.message.reply_text("❌ لم يتم العثور على المطعم في قاعدة البيانات.")
-                    return
+                    if not result:
+                        await update.message.reply_text("❌ لم يتم العثور على المطعم في قاعدة البيانات.")
+                        return
 
-                restaurant_id = result[0]
-                try:
-                    await cursor.execute(
-                        "INSERT INTO categories (name, restaurant_id) VALUES (%s, %s)",
-                        (category_name, restaurant_id)
-                    )
-                    await conn.commit()
-                    await update.message.reply_text(f"✅ تم إضافة الفئة: {category_name}")
-                except pymysql.err.IntegrityError:
-                    await update.message.reply_text("⚠️ هذه الفئة موجودة بالفعل لهذا المطعم.")
-    except Exception as e:
-        logging.error(f"❌ خطأ أثناء إضافة فئة: {e}", exc_info=True)
-        await update.message.reply_text("❌ حدث خطأ أثناء إضافة الفئة.")
+                    restaurant_id = result[0]
+                    try:
+                        await cursor.execute(
+                            "INSERT INTO categories (name, restaurant_id) VALUES (%s, %s)",
+                            (category_name, restaurant_id)
+                        )
+                        await bump_restaurant_version(cursor, restaurant_id=restaurant_id)
+                        await conn.commit()
+                        await update.message.reply_text(f"✅ تم إضافة الفئة: {category_name}")
+                    except pymysql.err.IntegrityError:
+                        await update.message.reply_text("⚠️ هذه الفئة موجودة بالفعل لهذا المطعم.")
+        except Exception as e:
+            logging.error(f"❌ خطأ أثناء إضافة فئة: {e}", exc_info=True)
+            await update.message.reply_text("❌ حدث خطأ أثناء إضافة الفئة.")
 
-    context.user_data.pop("category_action", None)
-    return await show_category_options(update, context)
+        context.user_data.pop("category_action", None)
+        return await show_category_options(update, context)
 
     
     elif context.user_data.get("category_action") == "delete":
@@ -2060,6 +2188,7 @@ elif context.user_data.get("category_action") == "add":
         try:
             async with get_db_connection() as conn:
                 async with conn.cursor() as cursor:
+                    await bump_restaurant_version(cursor, category_id=category_id)
                     await cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
                     await conn.commit()
     
@@ -2078,33 +2207,34 @@ elif context.user_data.get("category_action") == "add":
         await update.message.reply_text("📝 أرسل الاسم الجديد للفئة:")
         return
     
-elif context.user_data.get("category_action") == "edit_new_name":
-    new_name = text
-    old_name = context.user_data.get("old_category_name")
-    category_id = context.user_data.get("selected_category_id")
+    elif context.user_data.get("category_action") == "edit_new_name":
+        new_name = text
+        old_name = context.user_data.get("old_category_name")
+        category_id = context.user_data.get("selected_category_id")
 
-    if not category_id:
-        await update.message.reply_text("❌ لم يتم تحديد الفئة. يرجى اختيارها من جديد.")
-        return await show_category_options(update, context)
+        if not category_id:
+            await update.message.reply_text("❌ لم يتم تحديد الفئة. يرجى اختيارها من جديد.")
+            return await show_category_options(update, context)
 
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    "UPDATE categories SET name = %s WHERE id = %s",
-                    (new_name, category_id)
-                )
-                await conn.commit()
-        await update.message.reply_text(f"✏️ تم تعديل اسم الفئة من '{old_name}' إلى: {new_name}")
-    except pymysql.err.IntegrityError:
-        await update.message.reply_text("⚠️ توجد فئة بهذا الاسم مسبقًا.")
-    except Exception as e:
-        logging.error(f"❌ خطأ أثناء تعديل اسم الفئة: {e}", exc_info=True)
-        await update.message.reply_text("❌ حدث خطأ أثناء تعديل اسم الفئة.")
+        try:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "UPDATE categories SET name = %s WHERE id = %s",
+                        (new_name, category_id)
+                    )
+                    await bump_restaurant_version(cursor, category_id=category_id)
+                    await conn.commit()
+            await update.message.reply_text(f"✏️ تم تعديل اسم الفئة من '{old_name}' إلى: {new_name}")
+        except pymysql.err.IntegrityError:
+            await update.message.reply_text("⚠️ توجد فئة بهذا الاسم مسبقًا.")
+        except Exception as e:
+            logging.error(f"❌ خطأ أثناء تعديل اسم الفئة: {e}", exc_info=True)
+            await update.message.reply_text("❌ حدث خطأ أثناء تعديل اسم الفئة.")
 
-    context.user_data.pop("category_action", None)
-    context.user_data.pop("old_category_name", None)
-    return await show_category_options(update, context)
+        context.user_data.pop("category_action", None)
+        context.user_data.pop("old_category_name", None)
+        return await show_category_options(update, context)
 
 
 
@@ -2120,6 +2250,7 @@ elif context.user_data.get("category_action") == "edit_new_name":
                     await cursor.execute("UPDATE restaurants SET name = %s WHERE name = %s", (new_name, old_name))
                     await cursor.execute("UPDATE restaurant_ratings SET restaurant = %s WHERE restaurant = %s", (new_name, old_name))
                     await cursor.execute("UPDATE user_orders SET restaurant = %s WHERE restaurant = %s", (new_name, old_name))
+                    await bump_restaurant_version(cursor, restaurant_name=new_name)
                     await conn.commit()
             await update.message.reply_text(f"✅ تم تعديل اسم المطعم إلى: {new_name}")
         except pymysql.err.IntegrityError:
@@ -2141,6 +2272,7 @@ elif context.user_data.get("category_action") == "edit_new_name":
             async with get_db_connection() as conn:
                 async with conn.cursor() as cursor:
                     await cursor.execute("UPDATE restaurants SET name = %s WHERE name = %s", (new_name, old_name))
+                    await bump_restaurant_version(cursor, restaurant_name=new_name)
                     await conn.commit()
             await update.message.reply_text(f"✅ تم تعديل اسم المطعم إلى: {new_name}")
         except Exception as e:
@@ -2162,6 +2294,7 @@ elif context.user_data.get("category_action") == "edit_new_name":
             async with get_db_connection() as conn:
                 async with conn.cursor() as cursor:
                     await cursor.execute("UPDATE restaurants SET channel = %s WHERE name = %s", (new_channel, restaurant))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await conn.commit()
             await update.message.reply_text(f"✅ تم تعديل معرف القناة إلى: {new_channel}")
         except Exception as e:
@@ -2205,6 +2338,7 @@ elif context.user_data.get("category_action") == "edit_new_name":
                         UPDATE restaurants SET open_hour = %s, close_hour = %s
                         WHERE name = %s
                     """, (open_hour, close_hour, restaurant))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await conn.commit()
             await update.message.reply_text(f"✅ تم تعديل أوقات المطعم إلى {open_hour} - {close_hour}")
         except Exception as e:
@@ -2346,7 +2480,9 @@ elif context.user_data.get("category_action") == "edit_new_name":
                     await cursor.execute("DELETE FROM meals WHERE category_id IN (SELECT id FROM categories WHERE restaurant_id = %s)", (restaurant_id,))
                     await cursor.execute("DELETE FROM categories WHERE restaurant_id = %s", (restaurant_id,))
                     await cursor.execute("DELETE FROM restaurant_ratings WHERE restaurant_id = %s", (restaurant_id,))
+                    await cursor.execute("DELETE FROM restaurant_rating_summary WHERE restaurant_id = %s", (restaurant_id,))
                     await cursor.execute("DELETE FROM restaurants WHERE id = %s", (restaurant_id,))
+                    await bump_restaurant_version(cursor, restaurant_id)
                     await conn.commit()
     
             await update.message.reply_text(f"🗑️ تم حذف المطعم '{text}' بنجاح.")
@@ -2592,6 +2728,7 @@ async def delete_selected_category(update: Update, context: ContextTypes.DEFAULT
 
                 category_name = result[0]
 
+                await bump_restaurant_version(cursor, category_id=category_id)
                 await cursor.execute("DELETE FROM categories WHERE id = %s", (category_id,))
                 await conn.commit()
 
@@ -2908,6 +3045,7 @@ async def handle_add_meal_image(update: Update, context: ContextTypes.DEFAULT_TY
                     INSERT INTO meals (name, price, category_id, caption, image_file_id, size_options, unique_id, image_message_id)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
                 """, (meal_name, price, category_id, caption, photo_file_id, sizes_json, unique_id, image_message_id))
+                await bump_restaurant_version(cursor, category_id=category_id)
                 await conn.commit()
 
                 await update.message.reply_text(f"✅ تم حفظ الوجبة '{meal_name}' بنجاح مع الصورة.")
@@ -2959,6 +3097,7 @@ async def handle_new_meal_photo(update: Update, context: ContextTypes.DEFAULT_TY
                     SET image_file_id = %s, image_message_id = %s
                     WHERE id = %s
                 """, (new_photo, new_message_id, meal_id))
+                await bump_restaurant_version(cursor, meal_id=meal_id)
                 await conn.commit()
 
                 await update.message.reply_text("✅ تم تحديث صورة الوجبة بنجاح.")
@@ -3214,6 +3353,7 @@ async def confirm_delete_meal(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         async with get_db_connection() as conn:
             async with conn.cursor() as cursor:
+                await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                 await cursor.execute("""
                     DELETE FROM meals
                     WHERE name = %s AND category_id = (
@@ -3399,6 +3539,7 @@ async def handle_edit_price_step_by_step(update: Update, context: ContextTypes.D
                             WHERE c.name = %s AND r.name = %s
                         )
                     """, (price, meal, category, restaurant))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await update.message.reply_text("✅ تم تعديل السعر بنجاح.")
 
                 elif step == "multi_price":
@@ -3434,6 +3575,7 @@ async def handle_edit_price_step_by_step(update: Update, context: ContextTypes.D
                         json.dumps(updated_sizes, ensure_ascii=False),
                         meal, category, restaurant
                     ))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await update.message.reply_text("✅ تم تعديل الأسعار لجميع القياسات بنجاح.")
 
             await conn.commit()
@@ -3472,6 +3614,7 @@ async def handle_edit_meal_text_input(update: Update, context: ContextTypes.DEFA
                             WHERE c.name = %s AND r.name = %s
                         )
                     """, (value, meal_name, category_name, restaurant_name))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                     await update.message.reply_text("✅ تم تعديل الكابشن بنجاح.")
 
                 elif step == "sizes":
@@ -3492,6 +3635,7 @@ async def handle_edit_meal_text_input(update: Update, context: ContextTypes.DEFA
                             WHERE c.name = %s AND r.name = %s
                         )
                     """, (json.dumps(sizes, ensure_ascii=False), meal_name, category_name, restaurant_name))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                     await update.message.reply_text("✅ تم تعديل القياسات بنجاح.")
 
                 elif step == "edit_price_single":
@@ -3507,6 +3651,7 @@ async def handle_edit_meal_text_input(update: Update, context: ContextTypes.DEFA
                             WHERE c.name = %s AND r.name = %s
                         )
                     """, (new_price, meal_name, category_name, restaurant_name))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                     await update.message.reply_text("✅ تم تعديل السعر بنجاح.")
 
                 elif step == "edit_price_multiple":
@@ -3541,6 +3686,7 @@ async def handle_edit_meal_text_input(update: Update, context: ContextTypes.DEFA
                             category_name,
                             restaurant_name
                         ))
+                        await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                         await update.message.reply_text("✅ تم تعديل أسعار القياسات بنجاح.")
 
                     except Exception as e:
@@ -3676,6 +3822,7 @@ async def save_meal_to_database(update: Update, context: ContextTypes.DEFAULT_TY
                         INSERT INTO meals (name, price, category_id, caption, image_file_id, size_options)
                         VALUES (%s, %s, %s, %s, %s, %s)
                     """, (name, save_price, category_id, caption, image_id, size_options_json))
+                    await bump_restaurant_version(cursor, category_id=category_id)
                     await conn.commit()
                     await update.message.reply_text("✅ تم حفظ الوجبة بنجاح.")
                 except pymysql.err.IntegrityError:
@@ -3973,6 +4120,7 @@ async def handle_add_new_size(update: Update, context: ContextTypes.DEFAULT_TYPE
                         WHERE c.name = %s AND r.name = %s
                     )
                 """, (json.dumps(sizes, ensure_ascii=False), meal_name, category, restaurant))
+                await bump_restaurant_version(cursor, restaurant_name=restaurant)
                 await conn.commit()
 
         await update.message.reply_text("✅ تم إضافة القياس بنجاح.")
@@ -4072,6 +4220,7 @@ async def handle_add_sizes_to_empty_meal(update: Update, context: ContextTypes.D
                     max(s["price"] for s in formatted_sizes),
                     meal_name, category, restaurant
                 ))
+                await bump_restaurant_version(cursor, restaurant_name=restaurant)
                 await conn.commit()
 
         await update.message.reply_text("✅ تم حفظ القياسات بنجاح.")
@@ -4174,6 +4323,7 @@ async def handle_remove_size(update: Update, context: ContextTypes.DEFAULT_TYPE)
                             WHERE c.name = %s AND r.name = %s
                         )
                     """, (new_price, meal_name, category, restaurant))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await conn.commit()
                     await query.edit_message_text(f"✅ تم حذف القياس {size_to_remove} بنجاح.\n⚡ الوجبة الآن أصبحت بدون قياسات.")
                 else:
@@ -4190,6 +4340,7 @@ async def handle_remove_size(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         new_base_price,
                         meal_name, category, restaurant
                     ))
+                    await bump_restaurant_version(cursor, restaurant_name=restaurant)
                     await conn.commit()
                     await query.edit_message_text(f"✅ تم حذف القياس {size_to_remove} بنجاح.")
 
@@ -4247,6 +4398,7 @@ async def handle_new_meal_sizes(update: Update, context: ContextTypes.DEFAULT_TY
                     max(s["price"] for s in formatted_sizes),
                     meal_name, category, restaurant
                 ))
+                await bump_restaurant_version(cursor, restaurant_name=restaurant)
                 await conn.commit()
 
         await update.message.reply_text("✅ تم حفظ القياسات بنجاح.")
@@ -4482,6 +4634,7 @@ async def handle_freeze_restaurant_choice(update: Update, context: ContextTypes.
                     "UPDATE restaurants SET is_frozen = %s WHERE name = %s",
                     (is_frozen, restaurant_name)
                 )
+                await bump_restaurant_version(cursor, restaurant_name=restaurant_name)
                 await conn.commit()
     except Exception as e:
         await query.message.reply_text(f"❌ حدث خطأ أثناء التعديل: {e}")
@@ -4885,6 +5038,7 @@ async def run_admin_bot():
     logging.info("🚀 بدء تنفيذ الكود في main.py")
 
     # إعداد قاعدة البيانات والجداول
+    await init_db_pool()
     await setup_location_tables()
     await setup_menu_tables()
     await ensure_is_frozen_column()
@@ -4896,7 +5050,12 @@ async def run_admin_bot():
     
 
     # إنشاء التطبيق
-    app = Application.builder().token("8035243318:AAGiaP7K8ErWJar1xuxrnqPA8KD9QQwKT0c").build()
+    app = (
+        Application.builder()
+        .token("8035243318:AAGiaP7K8ErWJar1xuxrnqPA8KD9QQwKT0c")
+        .post_shutdown(close_db_pool)
+        .build()
+    )
 
     # جميع المعالجات - handlers
 
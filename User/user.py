@@ -15,14 +15,15 @@ import math
 import logging
 from datetime import datetime, timedelta
 from urllib.parse import unquote
-from apscheduler.schedulers.background import BackgroundScheduler
-from collections import defaultdict, deque
+from collections import Counter, OrderedDict, defaultdict, deque
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.error import NetworkError, TelegramError
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    PersistenceInput,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -31,8 +32,6 @@ from telegram.ext import (
     CallbackContext,
     filters
 )
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
 from telegram import ReplyKeyboardMarkup, Update
 from telegram.ext import CallbackContext
 
@@ -63,16 +62,18 @@ class RateLimiter:
         self.calls = deque()
 
     async def acquire(self):
-        now = time.time()
+        while True:
+            now = time.time()
 
-        # إزالة الطلبات القديمة
-        while self.calls and self.calls[0] < now - self.period:
-            self.calls.popleft()
+            # إزالة الطلبات القديمة
+            while self.calls and self.calls[0] < now - self.period:
+                self.calls.popleft()
 
-        # إذا وصلنا للحد الأقصى، انتظر
-        if len(self.calls) >= self.max_calls:
-            wait_time = self.calls[0] + self.period - now
-            await asyncio.sleep(wait_time)
+            if len(self.calls) < self.max_calls:
+                break
+
+            # إذا وصلنا للحد الأقصى، انتظر ثم أعد الفحص (قد يسبقنا منتظر آخر)
+            await asyncio.sleep(self.calls[0] + self.period - now)
 
         # تسجيل الطلب الجديد
         self.calls.append(time.time())
@@ -107,6 +108,187 @@ async def send_message_with_retry(bot, chat_id, text, order_id=None, max_retries
     raise Exception(f"فشلت جميع المحاولات ({max_retries}) لإرسال الرسالة.")
 
 
+# إعدادات حذف الرسائل القديمة
+MESSAGE_DELETE_BATCH = 100              # الحد الأقصى لـ deleteMessages في طلب واحد
+MESSAGE_DELETE_MAX_AGE = 48 * 3600 - 300  # البوت لا يستطيع حذف رسائل أقدم من 48 ساعة
+MESSAGE_DELETE_DELAY = 0.3              # ثانية لتجميع الحذف القادم من عدة معالجات
+MESSAGE_TRACK_MAX = 50000               # عدد الرسائل التي نحفظ وقت إرسالها
+
+
+class MessageCleaner:
+    """حذف الرسائل القديمة على دفعات لكل محادثة عبر deleteMessages خارج مسار المعالج"""
+
+    def __init__(self):
+        self.bot = None
+        self._pending = defaultdict(set)   # chat_id -> معرفات بانتظار الحذف
+        self._sent_at = OrderedDict()      # (chat_id, message_id) -> وقت الإرسال
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self.api_calls = 0
+        self.deleted = 0
+        self.expired = 0
+
+    def track(self, chat_id, message_ids):
+        """تسجيل وقت إرسال رسائل سنحذفها لاحقًا حتى نعرف إن كانت ما زالت قابلة للحذف"""
+        now = time.time()
+        for message_id in message_ids:
+            self._sent_at[(chat_id, message_id)] = now
+        while len(self._sent_at) > MESSAGE_TRACK_MAX:
+            self._sent_at.popitem(last=False)
+
+    def schedule(self, chat_id, message_ids):
+        """إضافة رسائل لقائمة الحذف دون انتظار تيليجرام"""
+        now = time.time()
+        for message_id in message_ids:
+            if not message_id:
+                continue
+            sent_at = self._sent_at.pop((chat_id, message_id), None)
+            if sent_at is not None and now - sent_at > MESSAGE_DELETE_MAX_AGE:
+                self.expired += 1
+                continue
+            self._pending[chat_id].add(message_id)
+        if self._pending:
+            self._wakeup.set()
+
+    async def _delete_batch(self, chat_id, message_ids):
+        delete_messages = getattr(self.bot, "delete_messages", None)
+        if delete_messages is None:
+            # نسخ المكتبة الأقدم من 20.8 لا تدعم deleteMessages
+            for message_id in message_ids:
+                try:
+                    await self.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                except Exception:
+                    pass
+            self.api_calls += len(message_ids)
+            return
+
+        for attempt in range(2):
+            try:
+                await telegram_limiter.acquire()
+                # الرسائل غير الموجودة يتجاوزها تيليجرام دون خطأ
+                await delete_messages(chat_id=chat_id, message_ids=message_ids)
+                self.api_calls += 1
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر حذف {len(message_ids)} رسالة في المحادثة {chat_id}: {e}")
+                return
+
+    async def flush(self):
+        pending, self._pending = self._pending, defaultdict(set)
+        for chat_id, message_ids in pending.items():
+            message_ids = sorted(message_ids)
+            for start in range(0, len(message_ids), MESSAGE_DELETE_BATCH):
+                batch = message_ids[start:start + MESSAGE_DELETE_BATCH]
+                await self._delete_batch(chat_id, batch)
+                self.deleted += len(batch)
+
+    async def _flush_loop(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            if not self._closing:
+                await asyncio.sleep(MESSAGE_DELETE_DELAY)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ خطأ في حذف الرسائل المجدولة: {e}", exc_info=True)
+
+    def start(self, bot):
+        self.bot = bot
+        self._closing = False
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            # إيقاف الحلقة بعلامة بدل الإلغاء حتى تكمل الدفعة الجارية بدل ضياعها
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self.bot:
+            await self.flush()
+        logger.info(
+            f"🧹 حذف الرسائل: {self.deleted} رسالة بـ {self.api_calls} طلب، تجاوز {self.expired} رسالة منتهية"
+        )
+
+
+message_cleaner = MessageCleaner()
+
+
+SUMMARY_DEBOUNCE = 0.4  # ثانية، الضغطات المتتالية خلالها تُعرض كتحديث واحد لرسالة الملخص
+
+
+class SummaryMessages:
+    """رسالة ملخص السلة لكل محادثة: تُعدَّل في مكانها، ويُعرض آخر نص فقط عند الضغط السريع"""
+
+    def __init__(self, debounce=SUMMARY_DEBOUNCE):
+        self.debounce = debounce
+        self._latest = {}   # chat_id -> (bot, user_data, text) آخر ملخص مطلوب
+        self._tasks = {}    # chat_id -> مهمة العرض المؤجلة
+        self.edits = 0
+        self.sends = 0
+        self.skipped = 0
+
+    def update(self, bot, chat_id, user_data, text):
+        """طلب عرض ملخص جديد دون انتظار تيليجرام؛ أي طلب أحدث قبل العرض يستبدله"""
+        if chat_id in self._latest:
+            self.skipped += 1
+        self._latest[chat_id] = (bot, user_data, text)
+        task = self._tasks.get(chat_id)
+        if task is None or task.done():
+            self._tasks[chat_id] = asyncio.create_task(self._render_later(chat_id))
+
+    async def _render_later(self, chat_id):
+        try:
+            await asyncio.sleep(self.debounce)
+            bot, user_data, text = self._latest.pop(chat_id)
+            await self._render(bot, chat_id, user_data, text)
+        except Exception as e:
+            logger.error(f"❌ فشل في تحديث رسالة الملخص: {e}", exc_info=True)
+        finally:
+            self._tasks.pop(chat_id, None)
+            # طلب وصل أثناء العرض نفسه
+            if chat_id in self._latest:
+                self._tasks[chat_id] = asyncio.create_task(self._render_later(chat_id))
+
+    async def _render(self, bot, chat_id, user_data, text):
+        message_id = user_data.get("summary_msg_id")
+        if message_id:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                self.edits += 1
+                return
+            except BadRequest as e:
+                if "not modified" in str(e):
+                    return
+                logger.warning(f"⚠️ تعذر تعديل رسالة الملخص {message_id}، سيتم إرسال رسالة جديدة: {e}")
+                message_cleaner.schedule(chat_id, [message_id])
+
+        msg = await bot.send_message(chat_id=chat_id, text=text)
+        self.sends += 1
+        user_data["summary_msg_id"] = msg.message_id
+        message_cleaner.track(chat_id, [msg.message_id])
+
+    def forget(self, chat_id, user_data):
+        """الملخص التالي يبدأ برسالة جديدة أسفل المحادثة بدل تعديل رسالة قديمة"""
+        self._latest.pop(chat_id, None)
+        user_data.pop("summary_msg_id", None)
+
+    async def close(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
+        self._latest.clear()
+        logger.info(f"🧾 رسائل الملخص: {self.edits} تعديل، {self.sends} إرسال، {self.skipped} تحديث مدمج")
+
+
+cart_summaries = SummaryMessages()
+
+
 
 async def show_invalid_choice(update: Update, options: list[str], prompt: str, state: int) -> int:
     """يعيد المستخدم لنفس الحالة في حال كتب شيئًا خارج الخيارات المتاحة."""
@@ -118,29 +300,130 @@ async def show_invalid_choice(update: Update, options: list[str], prompt: str, s
 
 
 
-# دالة لتحديث حالة الطلب في قاعدة البيانات المشتركة
-async def update_order_status(order_id, status, bot_type):
-    async with get_db_connection() as conn:
-        async with conn.cursor() as cursor:
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            # تحديث الحالة وتوقيت آخر مزامنة حسب نوع البوت
-            if bot_type == "user":
-                await cursor.execute(
-                    "INSERT INTO order_status (order_id, status, last_sync_user_bot) "
-                    "VALUES (%s, %s, %s) "
-                    "ON DUPLICATE KEY UPDATE status = %s, last_sync_user_bot = %s",
-                    (order_id, status, current_time, status, current_time)
-                )
-            else:  # restaurant
-                await cursor.execute(
-                    "INSERT INTO order_status (order_id, status, last_sync_restaurant_bot) "
-                    "VALUES (%s, %s, %s) "
-                    "ON DUPLICATE KEY UPDATE status = %s, last_sync_restaurant_bot = %s",
-                    (order_id, status, current_time, status, current_time)
-                )
-            
-        await conn.commit()
+# ===== دورة حياة الطلب =====
+# pending: بانتظار الكاشير، accepted: قيد التحضير، out_for_delivery: مع الدليفري
+ORDER_TRANSITIONS = {
+    "pending": {"accepted", "rejected", "cancelled"},
+    "accepted": {"out_for_delivery", "delivered", "cancelled"},
+    "out_for_delivery": {"delivered", "cancelled"},
+    "delivered": set(),
+    "rejected": set(),
+    "cancelled": set(),
+}
+ACTIVE_ORDER_STATES = ("pending", "accepted", "out_for_delivery")
+ACTIVE_ORDER_MAX_AGE_HOURS = 6  # طلب نشط أقدم من ذلك يُعتبر منسيًا ولا يمنع طلبًا جديدًا
+ORDER_NOT_CANCELLABLE_TEXT = "⚠️ ما عاد فيك تلغي هالطلب، حالته تغيرت (وصل أو انرفض أو انلغى قبل)."
+
+
+def channel_matches(channel, chat):
+    """هل المحادثة chat هي قناة المطعم المخزنة في restaurants.channel (معرف رقمي أو @username)"""
+    channel = str(channel or "").strip()
+    if channel.lstrip("-").isdigit():
+        return int(channel) == chat.id
+    return bool(chat.username) and channel.lstrip("@").lower() == chat.username.lower()
+
+
+async def transition_order(order_id, new_status, source, details=None, chat=None):
+    """نقل الطلب لحالة جديدة إذا كان الانتقال مسموحًا، مع تسجيله في order_events.
+
+    مع chat (تحديثات الكاشير) يُرفض الانتقال إذا لم تكن المحادثة قناة مطعم الطلب.
+    يعيد {"user_id", "from_status", "order_number"} عند التطبيق، أو None إذا كان الطلب غير موجود
+    أو الانتقال غير مسموح (مثل رسالة كاشير مكررة).
+    """
+    try:
+        async with get_db_connection() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        SELECT o.user_id, o.status, o.order_number, r.channel
+                        FROM user_orders o
+                        JOIN restaurants r ON r.id = o.restaurant_id
+                        WHERE o.order_id = %s
+                        FOR UPDATE
+                    """, (order_id,))
+                    row = await cursor.fetchone()
+                    if row and chat is not None and not channel_matches(row[3], chat):
+                        await conn.rollback()
+                        logger.warning(f"🚫 رفض تحديث الطلب {order_id} من محادثة ليست قناة مطعمه: {chat.id}")
+                        return None
+                    if not row or new_status not in ORDER_TRANSITIONS.get(row[1], ()):
+                        await conn.rollback()
+                        if row:
+                            logger.info(f"↩️ تجاهل انتقال الطلب {order_id}: {row[1]} -> {new_status}")
+                        return None
+
+                    user_id, from_status, order_number, _ = row
+                    await cursor.execute("""
+                        UPDATE user_orders SET status = %s, status_updated_at = NOW(3)
+                        WHERE order_id = %s
+                    """, (new_status, order_id))
+                    await cursor.execute("""
+                        INSERT INTO order_events (order_id, from_status, to_status, source, details)
+                        VALUES (%s, %s, %s, %s, %s)
+                    """, (
+                        order_id, from_status, new_status, source,
+                        json.dumps(details, ensure_ascii=False) if details else None
+                    ))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        logger.info(f"📦 الطلب {order_id}: {from_status} -> {new_status} ({source})")
+        return {"user_id": user_id, "from_status": from_status, "order_number": order_number}
+    except Exception as e:
+        logger.error(f"❌ خطأ أثناء تحديث حالة الطلب {order_id}: {e}", exc_info=True)
+        return None
+
+
+# محلل رسائل الكاشير النصية: نمط واحد مُجمَّع يمر على النص مرة واحدة ويلتقط كل الحقول
+CASHIER_POST_RE = re.compile(
+    r"معرف الطلب:?\s*[`\"']?(?P<order_id>[\w\-]+)"
+    r"|order_id:?\s*[`\"']?(?P<order_id_alt>[\w\-]+)"
+    r"|رقم الطلب:?\s*[`\"']?(?P<order_number>\d+)"
+    r"|order_number:?\s*[`\"']?(?P<order_number_alt>\d+)"
+    r"|وقت التوصيل المتوقع:\s*(?P<eta>\d+)\s*دقيقة"
+    r"|الدليفري:\s*(?P<delivery_name>[^(\n]*?)\s*\((?P<delivery_phone>\d+)\)"
+    r"|(?P<rejected>تم رفض الطلب)"
+    r"|(?P<accepted>تم قبول الطلب|جاري تحضير الطلب)"
+    r"|(?P<out_for_delivery>الطلب أصبح جاهزًا للتوصيل)"
+)
+
+# عند وجود أكثر من عبارة حالة في الرسالة نفسها تُعتمد الأسبق هنا
+CASHIER_POST_STATUSES = ("rejected", "accepted", "out_for_delivery")
+
+
+class CashierPost:
+    """الحقول المستخرجة من رسالة كاشير في قناة المطعم"""
+    __slots__ = ("order_id", "order_number", "status", "eta", "delivery_name", "delivery_phone")
+
+    def __init__(self):
+        self.order_id = None
+        self.order_number = None
+        self.status = None
+        self.eta = None
+        self.delivery_name = None
+        self.delivery_phone = None
+
+
+def parse_cashier_post(text):
+    """تحليل رسالة الكاشير بمرور واحد؛ أول قيمة لكل حقل هي المعتمدة"""
+    post = CashierPost()
+    found = {}
+    for match in CASHIER_POST_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == "delivery_phone":
+            found.setdefault("delivery_name", match.group("delivery_name"))
+        found.setdefault(kind, match.group(kind))
+
+    post.order_id = found.get("order_id") or found.get("order_id_alt")
+    number = found.get("order_number") or found.get("order_number_alt")
+    post.order_number = int(number) if number else None
+    post.eta = int(found["eta"]) if "eta" in found else None
+    post.delivery_name = found.get("delivery_name")
+    post.delivery_phone = found.get("delivery_phone")
+    post.status = next((status for status in CASHIER_POST_STATUSES if status in found), None)
+    return post
 
 
 
@@ -246,6 +529,35 @@ def initialize_database():
         ) ENGINE=InnoDB;
     """)
 
+    # عداد الطلبات اليومي: الترقيم يبدأ من 1 لكل مطعم في كل يوم عمل
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS restaurant_daily_order_counter (
+            restaurant_id INT NOT NULL,
+            business_date DATE NOT NULL,
+            last_order_number INT DEFAULT 0 NOT NULL,
+            PRIMARY KEY (restaurant_id, business_date),
+            FOREIGN KEY (restaurant_id) REFERENCES restaurants(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+    """)
+
+    # صندوق إرسال الطلبات لقنوات المطاعم: يُكتب مع الطلب في نفس المعاملة
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            order_id VARCHAR(255) NOT NULL,
+            channel_id VARCHAR(64) NOT NULL,
+            kind VARCHAR(16) NOT NULL,
+            payload JSON NOT NULL,
+            attempts INT DEFAULT 0 NOT NULL,
+            next_attempt_at DATETIME(3) DEFAULT CURRENT_TIMESTAMP(3) NOT NULL,
+            last_error VARCHAR(255),
+            sent_at DATETIME(3) NULL,
+            created_at DATETIME(3) DEFAULT CURRENT_TIMESTAMP(3) NOT NULL,
+            INDEX idx_order_outbox_due (sent_at, next_attempt_at),
+            INDEX idx_order_outbox_order (order_id)
+        ) ENGINE=InnoDB;
+    """)
+
     # سجل الطلبات
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS user_orders (
@@ -255,12 +567,56 @@ def initialize_database():
             city_id INT NOT NULL,
             order_number INT NOT NULL,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            status_updated_at DATETIME(3) NULL,
+            INDEX idx_user_orders_user_status (user_id, status),
             FOREIGN KEY (user_id) REFERENCES user_data(user_id) ON DELETE CASCADE,
             FOREIGN KEY (restaurant_id) REFERENCES restaurants(id) ON DELETE CASCADE,
             FOREIGN KEY (city_id) REFERENCES cities(id) ON DELETE CASCADE
         ) ENGINE=InnoDB;
     """)
 
+    # حالة الطلب الحالية لقواعد البيانات المنشأة قبل إضافة الأعمدة
+    cursor.execute("SHOW COLUMNS FROM user_orders LIKE 'status'")
+    if not cursor.fetchone():
+        cursor.execute("""
+            ALTER TABLE user_orders
+                ADD COLUMN status VARCHAR(20) NOT NULL DEFAULT 'pending',
+                ADD COLUMN status_updated_at DATETIME(3) NULL,
+                ADD INDEX idx_user_orders_user_status (user_id, status)
+        """)
+
+    # سجل أحداث الطلبات (إضافة فقط)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            order_id VARCHAR(255) NOT NULL,
+            from_status VARCHAR(20) NULL,
+            to_status VARCHAR(20) NOT NULL,
+            source VARCHAR(16) NOT NULL,
+            details JSON NULL,
+            ts DATETIME(3) DEFAULT CURRENT_TIMESTAMP(3) NOT NULL,
+            INDEX idx_order_events_order_ts (order_id, ts),
+            FOREIGN KEY (order_id) REFERENCES user_orders(order_id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+    """)
+
+    # محتوى الطلبات: سطر لكل (وجبة، قياس) مع السعر وقت الطلب
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS order_items (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            order_id VARCHAR(255) NOT NULL,
+            meal_id INT NULL,
+            name VARCHAR(255) NOT NULL,
+            size VARCHAR(100) NOT NULL DEFAULT 'default',
+            unit_price INT NOT NULL DEFAULT 0,
+            qty INT NOT NULL DEFAULT 1,
+            INDEX idx_order_items_order (order_id),
+            INDEX idx_order_items_meal (meal_id),
+            FOREIGN KEY (order_id) REFERENCES user_orders(order_id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+    """)
+
     # التقييمات
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS restaurant_ratings (
@@ -276,6 +632,26 @@ def initialize_database():
         ) ENGINE=InnoDB;
     """)
 
+    # ملخص التقييمات (يُحدّث مع كل تقييم بدل إعادة الحساب عند كل عرض)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS restaurant_rating_summary (
+            restaurant_id INT PRIMARY KEY,
+            rating_count INT NOT NULL DEFAULT 0,
+            rating_sum INT NOT NULL DEFAULT 0,
+            avg_rating DECIMAL(4,2) AS (IF(rating_count > 0, rating_sum / rating_count, 0)) STORED,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            FOREIGN KEY (restaurant_id) REFERENCES restaurants(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB;
+    """)
+
+    # تعبئة الملخص للمطاعم التي ليس لها ملخص بعد (أول تشغيل بعد إضافة الجدول)
+    cursor.execute("""
+        INSERT IGNORE INTO restaurant_rating_summary (restaurant_id, rating_count, rating_sum)
+        SELECT restaurant_id, COUNT(*), COALESCE(SUM(rating), 0)
+        FROM restaurant_ratings
+        GROUP BY restaurant_id
+    """)
+
     # حالة المحادثة
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS conversation_states (
@@ -285,6 +661,38 @@ def initialize_database():
         ) ENGINE=InnoDB;
     """)
 
+    # بيانات user_data المحفوظة عبر MySQLPersistence
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSON NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB;
+    """)
+
+    # مراحل ConversationHandler لكل محادثة
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name VARCHAR(64) NOT NULL,
+            conv_key VARCHAR(64) NOT NULL,
+            state JSON NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, conv_key)
+        ) ENGINE=InnoDB;
+    """)
+
+    # نسخ الكتالوج التي يرفعها بوت الإدارة عند كل تعديل
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_version (
+            scope VARCHAR(16) NOT NULL,
+            scope_id INT NOT NULL DEFAULT 0,
+            version BIGINT NOT NULL DEFAULT 1,
+            updated_at TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+            PRIMARY KEY (scope, scope_id),
+            INDEX idx_catalog_version_updated (updated_at)
+        ) ENGINE=InnoDB;
+    """)
+
     # السلة
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS shopping_carts (
@@ -346,44 +754,229 @@ DB_NAME = "telegram_bot"
 
 DB_PATH = "database.db"
 
-# إنشاء تجمع اتصالات
-# استبدال تجمع اتصالات SQLite بتجمع اتصالات MySQL
+# إعدادات تجمع الاتصالات
+DB_POOL_MIN_SIZE = 2            # عدد الاتصالات الجاهزة دائماً
+DB_POOL_MAX_SIZE = 20           # الحد الأقصى للاتصالات المفتوحة
+DB_POOL_ACQUIRE_TIMEOUT = 10    # أقصى انتظار (ثانية) للحصول على اتصال
+DB_POOL_PING_AFTER = 30         # فحص الاتصال بـ ping إذا بقي خاملاً أكثر من هذه المدة
+DB_POOL_MAX_IDLE = 300          # إغلاق الاتصال الخامل بعد هذه المدة (أقل من wait_timeout في MySQL)
+DB_POOL_MAX_LIFETIME = 3600     # إعادة تدوير الاتصال بعد هذا العمر مهما كان
+DB_POOL_HEALTH_INTERVAL = 60    # دورية فحص صحة التجمع
+
+
+# تجمع اتصالات MySQL مع فحص الاتصال عند السحب وإعادة التدوير
 class DBConnectionPool:
-    def __init__(self, max_connections=20):  # ← هنا زدت العدد من 10 إلى 20
-        self.max_connections = max_connections
-        self.connections = []
-        self.semaphore = asyncio.Semaphore(max_connections)
+    def __init__(self, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 acquire_timeout=DB_POOL_ACQUIRE_TIMEOUT, ping_after=DB_POOL_PING_AFTER,
+                 max_idle=DB_POOL_MAX_IDLE, max_lifetime=DB_POOL_MAX_LIFETIME):
+        self.min_size = min_size
+        self.max_connections = max_size
+        self.acquire_timeout = acquire_timeout
+        self.ping_after = ping_after
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+
+        self.connections = deque()  # الاتصالات الخاملة (آخر اتصال مُعاد يُسحب أولاً)
+        self.semaphore = asyncio.Semaphore(max_size)
+        self._created_at = {}  # conn -> وقت الإنشاء
+        self._last_used = {}   # conn -> آخر وقت إعادة للتجمع
+        self._in_use = set()
+        self._health_task = None
+        self._closed = False
+
+        # إحصائيات لمعايرة حجم التجمع وقت الضغط
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._discarded = 0
+        self._opened = 0
+
+    async def _open_connection(self):
+        conn = await aiomysql.connect(
+            host=DB_HOST,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            db=DB_NAME,
+            port=DB_PORT,
+            charset='utf8mb4',
+            autocommit=True
+        )
+        # تعيين مستوى العزل إلى READ COMMITTED
+        async with conn.cursor() as cursor:
+            await cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        self._created_at[conn] = time.monotonic()
+        self._opened += 1
+        return conn
+
+    def _forget(self, conn):
+        self._created_at.pop(conn, None)
+        self._last_used.pop(conn, None)
+        self._in_use.discard(conn)
+
+    async def _discard(self, conn):
+        """إغلاق اتصال تالف أو منتهي الصلاحية دون إعادته للتجمع"""
+        self._forget(conn)
+        self._discarded += 1
+        try:
+            await conn.ensure_closed()
+        except Exception:
+            conn.close()
+
+    def _is_expired(self, conn, now):
+        if conn.closed:
+            return True
+        if now - self._created_at.get(conn, now) > self.max_lifetime:
+            return True
+        return now - self._last_used.get(conn, now) > self.max_idle
 
     async def get_connection(self):
-        await self.semaphore.acquire()
-        if not self.connections:
-            conn = await aiomysql.connect(
-                host=DB_HOST,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                db=DB_NAME,
-                port=DB_PORT,
-                charset='utf8mb4',
-                autocommit=True  # ✅ تم التفعيل هنا
-            )
-            # تعيين مستوى العزل إلى READ COMMITTED
-            async with conn.cursor() as cursor:
-                await cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            logger.error(f"⏳ انتهت مهلة انتظار اتصال من التجمع بعد {self.acquire_timeout} ثانية ({self.stats()})")
+            raise
+
+        waited = time.monotonic() - started
+        self._checkouts += 1
+        self._total_wait += waited
+        self._max_wait = max(self._max_wait, waited)
+
+        try:
+            while self.connections:
+                conn = self.connections.pop()
+                now = time.monotonic()
+                if self._is_expired(conn, now):
+                    await self._discard(conn)
+                    continue
+
+                # فحص الاتصال فقط إذا بقي خاملاً مدة كافية ليكون قد انقطع
+                if now - self._last_used.get(conn, now) > self.ping_after:
+                    try:
+                        await conn.ping(reconnect=False)
+                    except Exception as e:
+                        logger.warning(f"⚠️ اتصال MySQL ميت في التجمع، سيتم استبداله: {e}")
+                        await self._discard(conn)
+                        continue
+
+                self._in_use.add(conn)
+                return conn
+
+            conn = await self._open_connection()
+            self._in_use.add(conn)
             return conn
-        return self.connections.pop()
+        except Exception:
+            self.semaphore.release()
+            raise
 
+    async def release_connection(self, conn, broken=False):
+        try:
+            if broken or self._closed or conn.closed or self._is_expired(conn, time.monotonic()):
+                await self._discard(conn)
+                return
 
-    async def release_connection(self, conn):
-        self.connections.append(conn)
-        self.semaphore.release()
+            # عدم إعادة اتصال بمعاملة مفتوحة إلى التجمع
+            if conn.get_transaction_status():
+                try:
+                    await conn.rollback()
+                except Exception:
+                    await self._discard(conn)
+                    return
+
+            self._in_use.discard(conn)
+            self._last_used[conn] = time.monotonic()
+            self.connections.append(conn)
+        finally:
+            self.semaphore.release()
 
     @asynccontextmanager
     async def connection(self):
         conn = await self.get_connection()
+        broken = False
         try:
             yield conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            # خطأ على مستوى الاتصال: لا نعيد هذا الاتصال للتجمع
+            broken = True
+            raise
         finally:
-            await self.release_connection(conn)
+            await self.release_connection(conn, broken=broken)
+
+    async def health_check(self):
+        """فحص دوري: إغلاق الاتصالات الخاملة والقديمة وفحص الباقي وإكمال الحد الأدنى"""
+        now = time.monotonic()
+        kept = deque()
+        while self.connections:
+            conn = self.connections.popleft()
+            if self._is_expired(conn, now):
+                await self._discard(conn)
+                continue
+            if now - self._last_used.get(conn, now) > self.ping_after:
+                try:
+                    await conn.ping(reconnect=False)
+                except Exception as e:
+                    logger.warning(f"⚠️ فشل ping لاتصال خامل: {e}")
+                    await self._discard(conn)
+                    continue
+                self._last_used[conn] = time.monotonic()
+            kept.append(conn)
+        # أي اتصال أُعيد أثناء الفحص يبقى في المقدمة
+        kept.extend(self.connections)
+        self.connections = kept
+
+        # الاحتفاظ بالحد الأدنى من الاتصالات الجاهزة دون تجاوز الحد الأقصى
+        while (not self._closed
+               and len(self.connections) < self.min_size
+               and len(self.connections) + len(self._in_use) < self.max_connections):
+            try:
+                conn = await self._open_connection()
+            except Exception as e:
+                logger.error(f"❌ فشل فتح اتصال جديد بقاعدة البيانات: {e}")
+                break
+            self._last_used[conn] = time.monotonic()
+            self.connections.append(conn)
+
+        logger.info(f"🩺 حالة تجمع MySQL: {self.stats()}")
+
+    async def _health_loop(self, interval):
+        while not self._closed:
+            await asyncio.sleep(interval)
+            try:
+                await self.health_check()
+            except Exception as e:
+                logger.error(f"❌ خطأ أثناء فحص تجمع الاتصالات: {e}", exc_info=True)
+
+    async def start(self, health_interval=DB_POOL_HEALTH_INTERVAL):
+        """فتح الحد الأدنى من الاتصالات وتشغيل الفحص الدوري"""
+        self._closed = False
+        await self.health_check()
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop(health_interval))
+
+    async def close(self):
+        self._closed = True
+        if self._health_task:
+            self._health_task.cancel()
+            self._health_task = None
+        while self.connections:
+            await self._discard(self.connections.pop())
+
+    def stats(self):
+        """إحصائيات التجمع، أهمها زمن انتظار السحب لمعايرة الحجم وقت الذروة"""
+        avg_wait = (self._total_wait / self._checkouts) if self._checkouts else 0.0
+        return {
+            "free": len(self.connections),
+            "in_use": len(self._in_use),
+            "max_size": self.max_connections,
+            "checkouts": self._checkouts,
+            "avg_wait_ms": round(avg_wait * 1000, 2),
+            "max_wait_ms": round(self._max_wait * 1000, 2),
+            "timeouts": self._timeouts,
+            "opened": self._opened,
+            "discarded": self._discarded,
+        }
 
 # استخدام تجمع الاتصالات
 db_pool = DBConnectionPool()
@@ -391,26 +984,101 @@ db_pool = DBConnectionPool()
 
 @asynccontextmanager
 async def get_db_connection():
-    print("🌀 دخلنا get_db_connection")
-    conn = await db_pool.get_connection()
-    print(f"🔗 نتيجة get_connection: {conn}")
-
-    try:
+    async with db_pool.connection() as conn:
         yield conn
-    finally:
-        print("🧹 سيتم تحرير الاتصال")
-        await db_pool.release_connection(conn)
 
 
 
 
 
 
-async def get_user_lock(user_id):
-    """الحصول على قفل خاص بمستخدم معين"""
-    if user_id not in user_state_lock:
-        user_state_lock[user_id] = Lock()
-    return user_state_lock[user_id]
+USER_LOCK_MAX_TRACKED = 1000  # أقصى عدد مستخدمين نحتفظ بعدّاد انتظارهم
+
+
+class UserLockRegistry:
+    """أقفال لكل مستخدم تُحذف تلقائيًا عندما لا يحملها أو ينتظرها أحد"""
+
+    def __init__(self, max_tracked=USER_LOCK_MAX_TRACKED):
+        self.max_tracked = max_tracked
+        self._locks = {}  # user_id -> [Lock, عدد الحاملين والمنتظرين]
+        self.acquired = 0
+        self.contended = 0
+        self.contention_by_flow = Counter()
+        self.contention_by_user = Counter()
+
+    def _record_contention(self, user_id, flow):
+        self.contended += 1
+        self.contention_by_flow[flow] += 1
+        self.contention_by_user[user_id] += 1
+        if len(self.contention_by_user) > self.max_tracked:
+            # الإبقاء على الأكثر انتظارًا فقط حتى لا يكبر العداد بلا حدود
+            self.contention_by_user = Counter(dict(self.contention_by_user.most_common(self.max_tracked // 2)))
+        logger.info(f"🔒 انتظار على قفل المستخدم {user_id} في {flow}")
+
+    @asynccontextmanager
+    async def hold(self, user_id, flow="default"):
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self._record_contention(user_id, flow)
+            async with entry[0]:
+                self.acquired += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def stats(self):
+        return {
+            "active": len(self._locks),
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "top_flows": self.contention_by_flow.most_common(5),
+            "top_users": self.contention_by_user.most_common(5),
+        }
+
+
+user_locks = UserLockRegistry()
+
+# ترقيم الطلبات
+ORDER_NUMBERS_RESET_DAILY = True  # False: ترقيم متصل لكل مطعم دون تصفير
+BUSINESS_DAY_START_HOUR = 0       # الساعة التي يبدأ عندها يوم العمل الجديد (الطلبات قبلها تتبع اليوم السابق)
+
+
+def current_business_date(now=None):
+    now = now or datetime.now(pytz.timezone("Asia/Damascus"))
+    return (now - timedelta(hours=BUSINESS_DAY_START_HOUR)).date()
+
+
+async def allocate_order_number(cursor, restaurant_id: int) -> int:
+    """حجز رقم الطلب التالي للمطعم بعبارة واحدة دون SELECT ... FOR UPDATE.
+
+    LAST_INSERT_ID(expr) يعيد الرقم الجديد في رد العبارة نفسها، فيبقى قفل صف العداد
+    لأقصر مدة ممكنة. مع الترقيم اليومي يُنشأ صف جديد لكل (مطعم، يوم عمل) فلا حاجة لمهمة تصفير.
+    """
+    if ORDER_NUMBERS_RESET_DAILY:
+        await cursor.execute("""
+            INSERT INTO restaurant_daily_order_counter (restaurant_id, business_date, last_order_number)
+            VALUES (%s, %s, LAST_INSERT_ID(1))
+            ON DUPLICATE KEY UPDATE last_order_number = LAST_INSERT_ID(last_order_number + 1)
+        """, (restaurant_id, current_business_date()))
+    else:
+        await cursor.execute("""
+            INSERT INTO restaurant_order_counter (restaurant_id, last_order_number)
+            VALUES (%s, LAST_INSERT_ID(1))
+            ON DUPLICATE KEY UPDATE last_order_number = LAST_INSERT_ID(last_order_number + 1)
+        """, (restaurant_id,))
+
+    next_number = cursor.lastrowid
+    if not next_number:
+        await cursor.execute("SELECT LAST_INSERT_ID()")
+        next_number = (await cursor.fetchone())[0]
+    return next_number
+
 
 async def get_next_order_number(restaurant_id: int) -> int:
     try:
@@ -418,27 +1086,7 @@ async def get_next_order_number(restaurant_id: int) -> int:
             await conn.begin()
             try:
                 async with conn.cursor() as cursor:
-                    # قفل الصف
-                    await cursor.execute(
-                        "SELECT last_order_number FROM restaurant_order_counter WHERE restaurant_id = %s FOR UPDATE",
-                        (restaurant_id,)
-                    )
-                    result = await cursor.fetchone()
-
-                    if result is None:
-                        next_number = 1
-                        await cursor.execute(
-                            "INSERT INTO restaurant_order_counter (restaurant_id, last_order_number) VALUES (%s, %s)",
-                            (restaurant_id, next_number)
-                        )
-                    else:
-                        last_number = result[0]
-                        next_number = last_number + 1
-                        await cursor.execute(
-                            "UPDATE restaurant_order_counter SET last_order_number = %s WHERE restaurant_id = %s",
-                            (next_number, restaurant_id)
-                        )
-
+                    next_number = await allocate_order_number(cursor, restaurant_id)
                 await conn.commit()
                 return next_number
             except Exception as e:
@@ -450,21 +1098,307 @@ async def get_next_order_number(restaurant_id: int) -> int:
         raise
 
 
+async def place_order(user_id: int, restaurant_name: str, order_id: str, cart, build_dispatch=None):
+    """تسجيل الطلب باتصال واحد ومعاملة واحدة.
+
+    في المعاملة: بيانات المستخدم وحالة محادثته والمطعم باستعلام واحد، ثم حذف السلة،
+    ثم حجز الرقم وإدخال الطلب وأسطره في order_items ورسائل قناة المطعم في order_outbox.
+    build_dispatch(placed) تعيد [(kind, payload)] من بيانات الطلب المحجوز.
+    يعيد None إذا لم يكن المطعم موجودًا.
+    """
+    async with get_db_connection() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT r.id, r.channel, r.city_id,
+                           u.name, u.phone, u.location_text, u.latitude, u.longitude,
+                           cs.state_data
+                    FROM restaurants r
+                    LEFT JOIN user_data u ON u.user_id = %s
+                    LEFT JOIN conversation_states cs ON cs.user_id = %s
+                    WHERE r.name = %s
+                """, (user_id, user_id, restaurant_name))
+                row = await cursor.fetchone()
+                if not row:
+                    await conn.rollback()
+                    return None
+
+                (restaurant_id, restaurant_channel, city_id,
+                 name, phone, location_text, latitude, longitude, state_data) = row
+
+                try:
+                    user_state = json.loads(state_data) if state_data else {}
+                except (TypeError, ValueError):
+                    user_state = {}
+
+                await cursor.execute("DELETE FROM shopping_carts WHERE user_id = %s", (user_id,))
+
+                # حجز الرقم آخر المعاملة حتى يُقفل صف العداد حتى commit فقط
+                order_number = await allocate_order_number(cursor, restaurant_id)
+                await cursor.execute("""
+                    INSERT INTO user_orders (order_id, user_id, restaurant_id, city_id, order_number)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (order_id, user_id, restaurant_id, city_id, order_number))
+                await cursor.execute("""
+                    INSERT INTO order_events (order_id, from_status, to_status, source)
+                    VALUES (%s, NULL, 'pending', 'user')
+                """, (order_id,))
+                # executemany يحولها إلى INSERT واحد متعدد الصفوف
+                await cursor.executemany("""
+                    INSERT INTO order_items (order_id, meal_id, name, size, unit_price, qty)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, [
+                    (order_id, line.get("meal_id"), line["name"], line["size"], line["price"], line["qty"])
+                    for line in cart.lines.values()
+                ])
+
+                placed = {
+                    "order_number": order_number,
+                    "restaurant_id": restaurant_id,
+                    "restaurant_channel": restaurant_channel,
+                    "city_id": city_id,
+                    "name": name,
+                    "phone": phone,
+                    "location_text": location_text,
+                    "coords": {"latitude": latitude, "longitude": longitude} if latitude and longitude else None,
+                    "user_state": user_state,
+                }
+                dispatch = build_dispatch(placed) if build_dispatch else []
+                if dispatch and not restaurant_channel:
+                    logger.error(f"🚨 المطعم {restaurant_name} بلا قناة، الطلب {order_id} لن يصل للكاشير")
+                    dispatch = []
+                if dispatch:
+                    await cursor.executemany("""
+                        INSERT INTO order_outbox (order_id, channel_id, kind, payload)
+                        VALUES (%s, %s, %s, %s)
+                    """, [
+                        (order_id, str(restaurant_channel), kind, json.dumps(payload, ensure_ascii=False))
+                        for kind, payload in dispatch
+                    ])
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+    # الحذف في المعاملة يجعل الطلب والسلة متسقين، وتفريغ الذاكرة المؤقتة يمنع
+    # كتابة مؤجلة قديمة من إعادة السلة بعده
+    cart_cache.clear(user_id)
+    if dispatch:
+        order_outbox.notify()
+    return placed
+
+
+# إعدادات صندوق إرسال الطلبات
+ORDER_OUTBOX_POLL_INTERVAL = 2    # ثانية، فحص دوري احتياطي إلى جانب التنبيه الفوري
+ORDER_OUTBOX_BATCH = 50
+ORDER_OUTBOX_MAX_ATTEMPTS = 12    # بعدها تبقى الرسالة في الجدول للمراجعة اليدوية
+ORDER_OUTBOX_MAX_BACKOFF = 300    # ثانية
+
+
+class OrderOutbox:
+    """إرسال رسائل الطلبات المسجلة في order_outbox إلى قنوات المطاعم مع إعادة المحاولة.
+
+    الرسائل تُرسل بالتتابع داخل كل قناة (الموقع قبل نص الطلب) وبالتوازي بين القنوات.
+    التسليم "مرة على الأقل": إذا توقف البوت بين الإرسال والتعليم تُعاد الرسالة بعد التشغيل.
+    """
+
+    def __init__(self):
+        self.bot = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._paused_until = {}  # channel_id -> وقت انتهاء RetryAfter (monotonic)
+        self.sent = 0
+        self.failed = 0
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def _send(self, order_id, channel_id, kind, payload):
+        chat_id = int(channel_id) if channel_id.lstrip("-").isdigit() else channel_id
+        await telegram_limiter.acquire()
+        if kind == "location":
+            await self.bot.send_location(chat_id=chat_id, latitude=payload["latitude"], longitude=payload["longitude"])
+        else:
+            await self.bot.send_message(
+                chat_id=chat_id,
+                text=payload["text"],
+                parse_mode=payload.get("parse_mode"),
+                reply_markup=cashier_order_keyboard(order_id) if payload.get("cashier_actions") else None
+            )
+
+    async def _drain_channel(self, rows, sent_ids, failures, deferred):
+        blocked_orders = set()
+        for outbox_id, order_id, channel_id, kind, payload, attempts in rows:
+            # القناة تحت حظر RetryAfter: نؤجل باقي رسائلها دون احتساب محاولة
+            pause = self._paused_until.get(channel_id, 0) - time.monotonic()
+            if pause > 0:
+                deferred.append((math.ceil(pause), outbox_id))
+                continue
+            # لا نرسل نص الطلب إذا فشل موقعه، حتى يبقى ترتيبهما في القناة
+            if order_id in blocked_orders:
+                continue
+            try:
+                await self._send(order_id, channel_id, kind, json.loads(payload))
+                sent_ids.append(outbox_id)
+            except RetryAfter as e:
+                blocked_orders.add(order_id)
+                self._paused_until[channel_id] = time.monotonic() + e.retry_after
+                failures.append((e.retry_after, f"RetryAfter {e.retry_after}", outbox_id))
+            except Exception as e:
+                blocked_orders.add(order_id)
+                delay = min(ORDER_OUTBOX_MAX_BACKOFF, 2 ** attempts)
+                failures.append((delay, str(e)[:255], outbox_id))
+                logger.warning(f"⚠️ فشل إرسال الطلب {order_id} إلى {channel_id} (المحاولة {attempts + 1}): {e}")
+
+    async def drain(self):
+        """إرسال دفعة من الرسائل المستحقة؛ يعيد عدد الرسائل التي أُرسلت"""
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT o.id, o.order_id, o.channel_id, o.kind, o.payload, o.attempts
+                    FROM order_outbox o
+                    WHERE o.sent_at IS NULL AND o.next_attempt_at <= NOW(3) AND o.attempts < %s
+                      AND NOT EXISTS (
+                          -- رسالة أسبق لنفس الطلب مؤجلة لإعادة المحاولة؛ التي توقفت نهائيًا لا تحجز
+                          -- ما بعدها، فيصل نص الطلب للكاشير ولو بدون الموقع
+                          SELECT 1 FROM order_outbox p
+                          WHERE p.order_id = o.order_id AND p.id < o.id AND p.sent_at IS NULL
+                            AND p.next_attempt_at > NOW(3) AND p.attempts < %s
+                      )
+                    ORDER BY o.id
+                    LIMIT %s
+                """, (ORDER_OUTBOX_MAX_ATTEMPTS, ORDER_OUTBOX_MAX_ATTEMPTS, ORDER_OUTBOX_BATCH))
+                rows = await cursor.fetchall()
+        if not rows:
+            return 0
+
+        by_channel = defaultdict(list)
+        for row in rows:
+            by_channel[row[2]].append(row)
+
+        sent_ids, failures, deferred = [], [], []
+        await asyncio.gather(*(
+            self._drain_channel(channel_rows, sent_ids, failures, deferred)
+            for channel_rows in by_channel.values()
+        ))
+
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                if sent_ids:
+                    placeholders = ", ".join(["%s"] * len(sent_ids))
+                    await cursor.execute(
+                        f"UPDATE order_outbox SET sent_at = NOW(3) WHERE id IN ({placeholders})",
+                        sent_ids
+                    )
+                if failures:
+                    await cursor.executemany("""
+                        UPDATE order_outbox
+                        SET attempts = attempts + 1,
+                            next_attempt_at = NOW(3) + INTERVAL %s SECOND,
+                            last_error = %s
+                        WHERE id = %s
+                    """, failures)
+                if deferred:
+                    await cursor.executemany(
+                        "UPDATE order_outbox SET next_attempt_at = NOW(3) + INTERVAL %s SECOND WHERE id = %s",
+                        deferred
+                    )
+
+        self.sent += len(sent_ids)
+        self.failed += len(failures)
+        rows_by_id = {row[0]: row for row in rows}
+        for _, error, outbox_id in failures:
+            _, order_id, channel_id, kind, _, attempts = rows_by_id[outbox_id]
+            if attempts + 1 >= ORDER_OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"🚨 توقف إرسال رسالة الطلب {outbox_id} بعد {ORDER_OUTBOX_MAX_ATTEMPTS} محاولة: {error}")
+                await self._alert_gave_up(order_id, channel_id, kind, error)
+        return len(sent_ids)
+
+    async def _alert_gave_up(self, order_id, channel_id, kind, error):
+        """تنبيه الإدارة بأن رسالة طلب لن تصل للمطعم ويجب متابعتها يدويًا"""
+        what = "موقع الطلب (سيُرسل النص بدونه)" if kind == "location" else "نص الطلب"
+        try:
+            await self.bot.send_message(
+                chat_id=ERRORS_CHANNEL,
+                text=(
+                    f"🚨 تعذر إرسال {what} إلى قناة المطعم {channel_id} "
+                    f"بعد {ORDER_OUTBOX_MAX_ATTEMPTS} محاولة.\n"
+                    f"📌 معرف الطلب: {order_id}\n"
+                    f"❗ آخر خطأ: {error}"
+                )
+            )
+        except Exception as e:
+            logger.error(f"❌ تعذر تنبيه الإدارة بتوقف إرسال الطلب {order_id}: {e}")
+
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=ORDER_OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                # دفعة ممتلئة تعني أن هناك المزيد
+                while await self.drain() >= ORDER_OUTBOX_BATCH:
+                    pass
+            except Exception as e:
+                logger.error(f"❌ خطأ في صندوق إرسال الطلبات: {e}", exc_info=True)
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        logger.info(f"📮 صندوق الطلبات: أُرسلت {self.sent} رسالة، فشلت {self.failed} محاولة")
+
+
+order_outbox = OrderOutbox()
+
+
 
 
 
 async def update_conversation_state(user_id, key, value):
     """تحديث قيمة محددة في حالة المحادثة"""
+    return await update_conversation_state_fields(user_id, {key: value})
+
+
+async def update_conversation_state_fields(user_id, fields):
+    """تحديث عدة مفاتيح في حالة المحادثة باستعلام واحد دون إعادة كتابة كامل JSON"""
     user_id = int(user_id)
-    try:
-        # الحصول على الحالة الحالية
-        current_state = await get_conversation_state(user_id)
+    if not fields:
+        return True
 
-        # تحديث القيمة
-        current_state[key] = value
+    serialized = serialize_conversation_state(fields)
+    object_args = ", ".join(["%s, %s"] * len(serialized))
+    set_args = ", ".join(["%s, %s"] * len(serialized))
+    object_params = [part for k, v in serialized.items() for part in (k, v)]
+    set_params = [part for k, v in serialized.items() for part in (f'$."{k}"', v)]
 
-        # حفظ الحالة المحدثة
-        return await save_conversation_state(user_id, current_state)
+    try:
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                # السطر الجديد يُنشأ بالمفاتيح المطلوبة فقط، والموجود تُعدّل مفاتيحه في مكانها
+                await cursor.execute(
+                    f"""
+                    INSERT INTO conversation_states (user_id, state_data)
+                    VALUES (%s, JSON_OBJECT({object_args}))
+                    ON DUPLICATE KEY UPDATE
+                        state_data = JSON_SET(COALESCE(state_data, JSON_OBJECT()), {set_args})
+                    """,
+                    [user_id, *object_params, *set_params]
+                )
+            await conn.commit()
+        return True
     except Exception as e:
         logger.error(f"خطأ في تحديث حالة المحادثة: {e}")
         return False
@@ -512,16 +1446,18 @@ class RateLimiter:
         self.calls = deque()
 
     async def acquire(self):
-        now = time.time()
+        while True:
+            now = time.time()
 
-        # إزالة الطلبات القديمة
-        while self.calls and self.calls[0] < now - self.period:
-            self.calls.popleft()
+            # إزالة الطلبات القديمة
+            while self.calls and self.calls[0] < now - self.period:
+                self.calls.popleft()
 
-        # إذا وصلنا للحد الأقصى، انتظر
-        if len(self.calls) >= self.max_calls:
-            wait_time = self.calls[0] + self.period - now
-            await asyncio.sleep(wait_time)
+            if len(self.calls) < self.max_calls:
+                break
+
+            # إذا وصلنا للحد الأقصى، انتظر ثم أعد الفحص (قد يسبقنا منتظر آخر)
+            await asyncio.sleep(self.calls[0] + self.period - now)
 
         # تسجيل الطلب الجديد
         self.calls.append(time.time())
@@ -537,61 +1473,137 @@ async def send_message_with_rate_limit(chat_id, text, **kwargs):
 
 
 
-async def save_cart_to_db(user_id, cart_data):
-    logger.warning(f"🧠 [save_cart_to_db] user_id = {user_id}, type = {type(user_id)}")
-    try:
-        # تأكد من أن user_id هو integer
-        user_id = int(user_id)
-        
-        json_data = json.dumps(cart_data, ensure_ascii=False)
-        logger.warning(f"📤 [save_cart_to_db] البيانات للحفظ: {json_data}")
+# إعدادات ذاكرة السلال المؤقتة
+CART_CACHE_MAX_USERS = 5000      # أقصى عدد سلال محفوظة في الذاكرة
+CART_CACHE_TTL = 1800            # ثانية قبل إعادة تحميل السلة من القاعدة
+CART_FLUSH_INTERVAL = 0.5        # نافذة تجميع الكتابات قبل إرسالها للقاعدة
+CART_FLUSH_BATCH = 200           # أقصى عدد مستخدمين في استعلام كتابة واحد
+CART_FLUSH_RETRY_DELAY = 5       # انتظار إضافي بعد فشل الكتابة
 
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                # استخدام INSERT ... ON DUPLICATE KEY UPDATE بدلاً من REPLACE INTO
-                await cursor.execute(
-                    """
-                    INSERT INTO shopping_carts (user_id, cart_data)
-                    VALUES (%s, %s)
-                    ON DUPLICATE KEY UPDATE cart_data = VALUES(cart_data)
-                    """,
-                    (user_id, json_data)
-                )
-            await conn.commit()
 
-            # قراءة البيانات مباشرة بعد الكتابة باستخدام نفس الاتصال
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT cart_data FROM shopping_carts WHERE user_id = %s", (user_id,))
-                check = await cursor.fetchone()
-                logger.warning(f"🔍 تحقق بعد الحفظ: {check}")
-                
-                # تخزين البيانات المقروءة في متغير عالمي أو في context.user_data
-                if check and check[0]:
-                    cart_data_read = check[0]
-                    if isinstance(cart_data_read, bytes):
-                        cart_data_read = cart_data_read.decode("utf-8")
-                    cart = json.loads(cart_data_read)
-                    # يمكن تخزين هذه القيمة في مكان آمن للاستخدام اللاحق
+class Cart:
+    """سلة مضغوطة: سطر واحد لكل (meal_id, size) مع الكمية، والمجموع وعدد القطع يُحدَّثان مع كل تعديل"""
 
-        return True
+    __slots__ = ("lines", "total", "count")
 
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء حفظ السلة في قاعدة البيانات: {e}", exc_info=True)
-        return False
+    def __init__(self):
+        self.lines = {}   # (meal_id أو الاسم للعناصر القديمة, size) -> سطر بالكمية
+        self.total = 0
+        self.count = 0
 
+    @staticmethod
+    def _key(item):
+        meal_id = item.get("meal_id")
+        return (meal_id if meal_id is not None else item.get("name"), item.get("size", "default"))
 
+    @staticmethod
+    def label(line):
+        return f"{line['name']} ({line['size']})" if line["size"] != "default" else line["name"]
 
+    @classmethod
+    def from_data(cls, data):
+        """بناء السلة من الشكل المخزن، مع تحويل السلال القديمة (عنصر لكل قطعة) تلقائيًا"""
+        if isinstance(data, cls):
+            return data.copy()
+        cart = cls()
+        if isinstance(data, dict):
+            for line in data.get("items", []):
+                cart.add(line, line.get("qty", 1))
+        elif isinstance(data, list):
+            for item in data:
+                cart.add(item)
+        return cart
 
+    def to_data(self):
+        return {
+            "items": [dict(line) for line in self.lines.values()],
+            "total": self.total,
+            "count": self.count,
+        }
 
-async def get_cart_from_db(user_id):
-    logger.warning(f"🧠 [get_cart_from_db] user_id = {user_id}, type = {type(user_id)}")
-    try:
-        # تأكد من أن user_id هو integer
-        user_id = int(user_id)
-        
-        # زيادة التأخير قبل القراءة لضمان اكتمال عمليات الكتابة السابقة
-        await asyncio.sleep(0.3)
-        
+    def copy(self):
+        cart = Cart()
+        cart.lines = {key: dict(line) for key, line in self.lines.items()}
+        cart.total = self.total
+        cart.count = self.count
+        return cart
+
+    def add(self, item, qty=1):
+        key = self._key(item)
+        line = self.lines.get(key)
+        if line is None:
+            line = self.lines[key] = {
+                "meal_id": item.get("meal_id"),
+                "name": item.get("name", "غير معروف"),
+                "size": item.get("size", "default"),
+                "price": item.get("price", 0) or 0,
+                "qty": 0,
+            }
+        line["qty"] += qty
+        self.total += line["price"] * qty
+        self.count += qty
+        return line
+
+    def remove_last(self, meal_id, meal_name=None):
+        """إنقاص قطعة واحدة من آخر سطر مطابق للوجبة، يعيد القطعة المحذوفة أو None"""
+        for key in reversed(self.lines):
+            line = self.lines[key]
+            if line["meal_id"] == meal_id or (meal_name and line["name"] == meal_name):
+                line["qty"] -= 1
+                self.total -= line["price"]
+                self.count -= 1
+                if line["qty"] <= 0:
+                    del self.lines[key]
+                return dict(line, qty=1)
+        return None
+
+    def summary_text(self):
+        return "\n".join(f"{line['qty']} × {self.label(line)}" for line in self.lines.values())
+
+    def items_for_message(self):
+        return [
+            {"name": self.label(line), "quantity": line["qty"], "price": line["price"]}
+            for line in self.lines.values()
+        ]
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __len__(self):
+        return self.count
+
+
+class CartCache:
+    """ذاكرة مؤقتة لسلال التسوق: القراءة من الذاكرة والكتابة إلى shopping_carts بشكل مؤجل ومجمّع"""
+
+    def __init__(self, max_users=CART_CACHE_MAX_USERS, ttl=CART_CACHE_TTL,
+                 flush_interval=CART_FLUSH_INTERVAL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._carts = OrderedDict()   # user_id -> (Cart, loaded_at)
+        self._pending = {}            # user_id -> Cart أو None للحذف، لا يُطرد قبل الكتابة
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+        self.coalesced = 0
+
+    def _remember(self, user_id, cart):
+        self._carts[user_id] = (cart, time.monotonic())
+        self._carts.move_to_end(user_id)
+        while len(self._carts) > self.max_users:
+            self._carts.popitem(last=False)
+
+    def _queue(self, user_id, cart):
+        if user_id in self._pending:
+            self.coalesced += 1
+        self._pending[user_id] = cart
+        self._wakeup.set()
+
+    async def _load(self, user_id):
         async with get_db_connection() as conn:
             async with conn.cursor() as cursor:
                 await cursor.execute(
@@ -599,50 +1611,454 @@ async def get_cart_from_db(user_id):
                     (user_id,)
                 )
                 result = await cursor.fetchone()
-                
-                if result and result[0]:
-                    cart_data = result[0]
-                    if isinstance(cart_data, bytes):
-                        cart_data = cart_data.decode("utf-8")
-                    cart = json.loads(cart_data)
-                    logger.warning(f"📤 [get_cart_from_db] نتيجة: {result}")
-                    logger.warning(f"✅ تم تحويل JSON: {cart}")
-                    return cart
-                return []
+
+        if result and result[0]:
+            cart_data = result[0]
+            if isinstance(cart_data, bytes):
+                cart_data = cart_data.decode("utf-8")
+            return Cart.from_data(json.loads(cart_data))
+        return Cart()
+
+    async def get(self, user_id):
+        entry = self._carts.get(user_id)
+        if entry and time.monotonic() - entry[1] <= self.ttl:
+            self._carts.move_to_end(user_id)
+            self.hits += 1
+            return entry[0].copy()
+
+        if user_id in self._pending:
+            # السلة طُردت من الذاكرة قبل أن تُكتب، النسخة المعلقة هي الأحدث
+            cart = self._pending[user_id] or Cart()
+        else:
+            self.misses += 1
+            started = time.monotonic()
+            cart = await self._load(user_id)
+            entry = self._carts.get(user_id)
+            if entry and entry[1] >= started:
+                # تعدلت السلة أثناء انتظار القراءة، نسخة الذاكرة هي الأحدث
+                return entry[0].copy()
+            if user_id in self._pending:
+                cart = self._pending[user_id] or Cart()
+
+        self._remember(user_id, cart)
+        return cart.copy()
+
+    def set(self, user_id, cart):
+        cart = Cart.from_data(cart)
+        self._remember(user_id, cart)
+        self._queue(user_id, cart)
+
+    # العمليات التالية لا تحتوي أي await بين قراءة السلة وتعديلها،
+    # لذلك لا يمكن لضغطتين متتاليتين أن تتداخلا وتضيّعا عنصرًا
+
+    async def append_item(self, user_id, item):
+        """إضافة عنصر إلى نهاية السلة وإرجاع السلة بعد الإضافة"""
+        cart = await self.get(user_id)
+        cart.add(item)
+        self.set(user_id, cart)
+        return cart
+
+    async def remove_last(self, user_id, meal_id, meal_name=None):
+        """حذف قطعة من آخر سطر مطابق للوجبة، يعيد (السلة، القطعة المحذوفة أو None)"""
+        cart = await self.get(user_id)
+        removed = cart.remove_last(meal_id, meal_name)
+        if removed:
+            self.set(user_id, cart)
+        return cart, removed
+
+    def clear(self, user_id):
+        self._remember(user_id, Cart())
+        self._queue(user_id, None)
+
+    async def _write(self, batch):
+        upserts = [(uid, json.dumps(cart.to_data(), ensure_ascii=False)) for uid, cart in batch.items() if cart is not None]
+        deletes = [uid for uid, cart in batch.items() if cart is None]
+
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                if upserts:
+                    placeholders = ", ".join(["(%s, %s)"] * len(upserts))
+                    await cursor.execute(
+                        f"""
+                        INSERT INTO shopping_carts (user_id, cart_data)
+                        VALUES {placeholders}
+                        ON DUPLICATE KEY UPDATE cart_data = VALUES(cart_data)
+                        """,
+                        [value for row in upserts for value in row]
+                    )
+                if deletes:
+                    placeholders = ", ".join(["%s"] * len(deletes))
+                    await cursor.execute(
+                        f"DELETE FROM shopping_carts WHERE user_id IN ({placeholders})",
+                        deletes
+                    )
+            await conn.commit()
+
+    async def flush(self):
+        """كتابة كل السلال المعلقة إلى القاعدة، يعيد False إذا بقي شيء لم يُكتب"""
+        async with self._flush_lock:
+            while self._pending:
+                batch = dict(list(self._pending.items())[:CART_FLUSH_BATCH])
+                for uid in batch:
+                    del self._pending[uid]
+                try:
+                    await self._write(batch)
+                    self.flushed += len(batch)
+                except BaseException as e:
+                    # إعادة الدفعة للانتظار ما لم تصل نسخة أحدث لنفس المستخدم، حتى عند الإلغاء
+                    for uid, cart in batch.items():
+                        self._pending.setdefault(uid, cart)
+                    if not isinstance(e, Exception):
+                        raise
+                    logger.error(f"❌ فشل حفظ {len(batch)} سلة في قاعدة البيانات: {e}")
+                    return False
+        return True
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            if not await self.flush():
+                self._wakeup.set()
+                await asyncio.sleep(CART_FLUSH_RETRY_DELAY)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """إيقاف الكتابة الدورية وتفريغ كل ما تبقى قبل إغلاق الاتصالات"""
+        if self._task:
+            # الإلغاء تحت قفل الكتابة: ننتظر انتهاء الدفعة الجارية بدل قطعها في منتصفها
+            async with self._flush_lock:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+            self._task = None
+        if not await self.flush():
+            logger.error(f"❌ بقيت {len(self._pending)} سلة غير محفوظة عند الإيقاف")
+        logger.info(
+            f"🛒 ذاكرة السلال: hits={self.hits}, misses={self.misses}, "
+            f"flushed={self.flushed}, coalesced={self.coalesced}"
+        )
+
+
+cart_cache = CartCache()
+
+
+async def save_cart_to_db(user_id, cart_data):
+    """حفظ السلة في الذاكرة وجدولة كتابتها إلى قاعدة البيانات"""
+    try:
+        cart_cache.set(int(user_id), cart_data)
+        return True
     except Exception as e:
-        logger.error(f"❌ خطأ في get_cart_from_db: {e}")
-        return []
+        logger.error(f"❌ خطأ أثناء حفظ السلة: {e}", exc_info=True)
+        return False
 
 
+async def get_cart_from_db(user_id):
+    """جلب السلة من الذاكرة، أو من قاعدة البيانات عند عدم وجودها"""
+    try:
+        return await cart_cache.get(int(user_id))
+    except Exception as e:
+        logger.error(f"❌ خطأ في get_cart_from_db: {e}")
+        return Cart()
 
 
 async def delete_cart_from_db(user_id):
-    user_id = int(user_id)
-    """حذف سلة التسوق من قاعدة البيانات"""
+    """حذف سلة التسوق من الذاكرة وجدولة حذفها من قاعدة البيانات"""
     try:
-        # تأكد من أن user_id هو integer
-        user_id = int(user_id)
-        
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(
-                    "DELETE FROM shopping_carts WHERE user_id = %s",
-                    (user_id,)
-                )
-            await conn.commit()
-            
-            # تحقق من الحذف
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT 1 FROM shopping_carts WHERE user_id = %s", (user_id,))
-                check = await cursor.fetchone()
-                logger.warning(f"🔍 تحقق بعد الحذف: {check}")
-                
+        cart_cache.clear(int(user_id))
         return True
     except Exception as e:
         logger.error(f"خطأ في حذف سلة التسوق: {e}")
         return False
 
 
+class MealCard:
+    """بطاقة عرض جاهزة لوجبة: النص ولوحة الأزرار تُبنى مرة واحدة لكل نسخة من صف الوجبة"""
+
+    __slots__ = ("row", "meal_id", "name", "text", "reply_markup", "image_file_id")
+
+    def __init__(self, row):
+        meal_id, name, caption, image_file_id, size_json, price = row
+        self.row = row
+        self.meal_id = meal_id
+        self.name = name
+        self.image_file_id = image_file_id
+
+        try:
+            sizes = json.loads(size_json or "[]") if isinstance(size_json, (str, bytes)) else (size_json or [])
+        except (TypeError, ValueError):
+            sizes = []
+
+        buttons = []
+        if sizes:
+            # جميع أزرار القياسات في صف واحد بنص "القياس السعر"
+            buttons.append([
+                InlineKeyboardButton(
+                    f"{opt['name']} {opt['price']}",
+                    callback_data=f"add_meal_with_size:{meal_id}:{opt['name']}"
+                )
+                for opt in sizes
+            ])
+        else:
+            buttons.append([
+                InlineKeyboardButton(f"➕ أضف للسلة ({price})", callback_data=f"add_meal_with_size:{meal_id}:default")
+            ])
+        # زر حذف اللمسة الأخيرة في صف مستقل
+        buttons.append([
+            InlineKeyboardButton("❌ حذف اللمسة الأخيرة", callback_data=f"remove_specific_meal:{meal_id}:last")
+        ])
+        # InlineKeyboardMarkup غير قابل للتعديل في هذه النسخة من المكتبة لذا يمكن مشاركته بين الرسائل
+        self.reply_markup = InlineKeyboardMarkup(buttons)
+
+        text = f"🍽️ {name}\n\n{caption}" if caption else f"🍽️ {name}"
+        if price:
+            text += f"\n💰 السعر: {price} ل.س"
+        self.text = text
+
+
+# إعدادات ذاكرة الكتالوج المؤقتة
+CATALOG_CACHE_MAX_AGE = 300  # ثانية، حد أقصى لعمر أي بيانات كتالوج في الذاكرة
+CATALOG_VERSION_POLL_INTERVAL = 1  # ثانية بين كل فحص لجدول catalog_version
+
+
+class CatalogCache:
+    """ذاكرة قراءة للكتالوج (محافظات، مدن، مطاعم، فئات، وجبات) مع إبطال صريح وعمر أقصى"""
+
+    def __init__(self, max_age=CATALOG_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self._entries = {}     # (kind, key) -> (value, loaded_at, tags)
+        self._generation = 0   # يزداد مع كل إبطال حتى لا تُخزن قراءة بدأت قبله
+        self._cards = {}       # meal_id -> MealCard لآخر نسخة معروضة من الوجبة
+        self._versions = {}    # (scope, scope_id) -> آخر نسخة رأيناها في catalog_version
+        self._versions_loaded = False
+        self._poll_task = None
+        self.hits = 0
+        self.misses = 0
+        self.remote_invalidations = 0
+
+    async def _get(self, kind, key, loader):
+        entry = self._entries.get((kind, key))
+        if entry and time.monotonic() - entry[1] <= self.max_age:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        generation = self._generation
+        value, tags = await loader()
+        if generation == self._generation:
+            self._entries[(kind, key)] = (value, time.monotonic(), tags)
+        return value
+
+    @staticmethod
+    async def _fetchall(query, params=()):
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query, params)
+                return await cursor.fetchall()
+
+    # ===== الإبطال =====
+
+    def invalidate(self, kind=None, key=None):
+        """إبطال مدخل محدد، أو كل مدخلات نوع معين، أو كامل الكتالوج"""
+        self._generation += 1
+        if kind is None and key is None:
+            self._cards.clear()
+        for cache_key in list(self._entries):
+            if (kind is None or cache_key[0] == kind) and (key is None or cache_key[1] == key):
+                del self._entries[cache_key]
+
+    def invalidate_tag(self, tag):
+        """إبطال كل ما يخص مطعمًا أو مدينة، مثل ("restaurant", 5) أو ("city", 2)"""
+        self._generation += 1
+        for cache_key, entry in list(self._entries.items()):
+            if tag in entry[2]:
+                del self._entries[cache_key]
+
+    # ===== المزامنة مع بوت الإدارة =====
+
+    async def poll_versions(self):
+        """مقارنة نسخ catalog_version بآخر ما رأيناه وإبطال ما تغير فقط.
+
+        المقارنة بقيمة النسخة لا بـ updated_at: معاملة الإدارة قد تلتزم بعد ثوانٍ من رفع النسخة
+        (رسائل تيليجرام قبل commit)، فيحمل الصف وقتًا أقدم من آخر فحص. الجدول صف لكل مطعم/مدينة فقط.
+        """
+        first_poll = not self._versions_loaded
+        rows = await self._fetchall("SELECT scope, scope_id, version FROM catalog_version")
+
+        for scope, scope_id, version in rows:
+            if self._versions.get((scope, scope_id)) == version:
+                continue
+            self._versions[(scope, scope_id)] = version
+            if first_poll:
+                continue
+
+            self.remote_invalidations += 1
+            if scope == "all":
+                self.invalidate()
+            else:
+                self.invalidate_tag((scope, scope_id))
+            logger.info(f"🔄 إبطال الكتالوج بعد تعديل من الإدارة: {scope}/{scope_id} (نسخة {version})")
+        self._versions_loaded = True
+
+    async def _poll_loop(self, interval):
+        while True:
+            try:
+                await self.poll_versions()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر فحص نسخ الكتالوج: {e}")
+            await asyncio.sleep(interval)
+
+    def start(self, interval=CATALOG_VERSION_POLL_INTERVAL):
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(self._poll_loop(interval))
+
+    async def close(self):
+        if self._poll_task:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+    # ===== المحافظات والمدن =====
+
+    async def provinces(self):
+        """[(id, name)] لكل المحافظات"""
+        async def load():
+            rows = await self._fetchall("SELECT id, name FROM provinces ORDER BY id")
+            return [tuple(row) for row in rows], {("geo", 0)}
+        return await self._get("provinces", None, load)
+
+    async def province_id(self, name):
+        for province_id, province_name in await self.provinces():
+            if province_name == name:
+                return province_id
+        return None
+
+    async def cities(self, province_id):
+        """[(id, name)] لمدن محافظة"""
+        async def load():
+            rows = await self._fetchall(
+                "SELECT id, name FROM cities WHERE province_id = %s ORDER BY id", (province_id,)
+            )
+            return [tuple(row) for row in rows], {("geo", 0)}
+        return await self._get("cities", province_id, load)
+
+    # ===== المطاعم =====
+
+    async def city_restaurants(self, city_id):
+        """مطاعم المدينة مع التجميد والتقييم، بنفس شكل get_city_restaurants"""
+        async def load():
+            restaurants = await get_city_restaurants(city_id)
+            tags = {("city", city_id)} | {("restaurant", r["id"]) for r in restaurants}
+            return restaurants, tags
+        return await self._get("city_restaurants", city_id, load)
+
+    async def restaurant(self, restaurant_id):
+        """بيانات مطعم واحد كقاموس، أو None إذا لم يكن موجودًا"""
+        async def load():
+            rows = await self._fetchall("""
+                SELECT id, name, city_id, channel, open_hour, close_hour, is_frozen
+                FROM restaurants
+                WHERE id = %s
+            """, (restaurant_id,))
+            if not rows:
+                return None, {("restaurant", restaurant_id)}
+            rid, name, city_id, channel, open_hour, close_hour, is_frozen = rows[0]
+            restaurant = {
+                "id": rid,
+                "name": name,
+                "city_id": city_id,
+                "channel": channel,
+                "open_hour": open_hour,
+                "close_hour": close_hour,
+                "is_frozen": bool(is_frozen),
+            }
+            return restaurant, {("restaurant", rid), ("city", city_id)}
+        return await self._get("restaurant", restaurant_id, load)
+
+    # ===== الفئات والوجبات =====
+
+    async def categories(self, restaurant_id):
+        """[(id, name)] لفئات مطعم مرتبة بالاسم"""
+        async def load():
+            rows = await self._fetchall(
+                "SELECT id, name FROM categories WHERE restaurant_id = %s ORDER BY name", (restaurant_id,)
+            )
+            return [tuple(row) for row in rows], {("restaurant", restaurant_id)}
+        return await self._get("categories", restaurant_id, load)
+
+    async def meals(self, category_id):
+        """[(id, name, caption, image_file_id, size_options, price)] لوجبات فئة"""
+        async def load():
+            # LEFT JOIN من الفئة حتى نعرف المطعم حتى لو كانت الفئة فارغة
+            rows = await self._fetchall("""
+                SELECT m.id, m.name, m.caption, m.image_file_id, m.size_options, m.price, c.restaurant_id
+                FROM categories c
+                LEFT JOIN meals m ON m.category_id = c.id
+                WHERE c.id = %s
+                ORDER BY m.id
+            """, (category_id,))
+            tags = {("restaurant", row[6]) for row in rows} or {("category", category_id)}
+            return [tuple(row[:6]) for row in rows if row[0] is not None], tags
+        return await self._get("meals", category_id, load)
+
+    async def meal(self, meal_id):
+        """بيانات وجبة واحدة كقاموس، أو None إذا لم تكن موجودة"""
+        async def load():
+            rows = await self._fetchall("""
+                SELECT m.id, m.name, m.price, m.size_options, m.category_id, c.restaurant_id
+                FROM meals m
+                JOIN categories c ON c.id = m.category_id
+                WHERE m.id = %s
+            """, (meal_id,))
+            if not rows:
+                return None, {("meal", meal_id)}
+            mid, name, price, size_options, category_id, restaurant_id = rows[0]
+            meal = {
+                "id": mid,
+                "name": name,
+                "price": price,
+                "size_options": size_options,
+                "category_id": category_id,
+                "restaurant_id": restaurant_id,
+            }
+            return meal, {("restaurant", restaurant_id)}
+        return await self._get("meal", meal_id, load)
+
+    async def meal_cards(self, category_id):
+        """بطاقات وجبات فئة جاهزة للإرسال؛ تُعاد بناء البطاقة فقط إذا تغير صف الوجبة"""
+        cards = []
+        for row in await self.meals(category_id):
+            card = self._cards.get(row[0])
+            if card is None or card.row != row:
+                card = MealCard(row)
+                self._cards[row[0]] = card
+            cards.append(card)
+        return cards
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "cards": len(self._cards),
+            "hits": self.hits,
+            "misses": self.misses,
+            "remote_invalidations": self.remote_invalidations,
+        }
+
+
+catalog_cache = CatalogCache()
+
+
 
 
 
@@ -675,49 +2091,40 @@ async def retry_with_backoff(func, *args, max_retries=5, initial_wait=0.5, **kwa
 
 
 
-async def delete_cart_from_db(user_id):
-    """حذف سلة التسوق من قاعدة البيانات"""
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("DELETE FROM user_carts WHERE user_id = %s", (user_id,))
-            await conn.commit()
-    except Exception as e:
-        logger.error(f"خطأ في حذف السلة: {e}")
+def serialize_conversation_state(state_data):
+    """تحويل القيم إلى الشكل المخزن في conversation_states (نصوص، والمعقد منها JSON)"""
+    serialized_data = {}
+    for k, v in state_data.items():
+        if isinstance(v, (dict, list, set)):
+            serialized_data[k] = json.dumps(list(v) if isinstance(v, set) else v)
+        elif isinstance(v, datetime):
+            serialized_data[k] = v.isoformat()
+        else:
+            serialized_data[k] = str(v)
+    return serialized_data
 
 
 async def save_conversation_state(user_id, state_data):
+    """حفظ حالة المحادثة كاملة في قاعدة البيانات (استبدال الحالة السابقة)"""
     user_id = int(user_id)
-    """حفظ حالة المحادثة في قاعدة البيانات"""
-    user_lock = await get_user_lock(user_id)
-    async with user_lock:  # استخدام قفل خاص بالمستخدم
-        # تحويل البيانات المعقدة إلى JSON
-        serialized_data = {}
-        for k, v in state_data.items():
-            if isinstance(v, (dict, list, set)):
-                serialized_data[k] = json.dumps(v)
-            elif isinstance(v, datetime):
-                serialized_data[k] = v.isoformat()
-            else:
-                serialized_data[k] = str(v)
+    json_data = json.dumps(serialize_conversation_state(state_data), ensure_ascii=False)
 
-        # حفظ البيانات في قاعدة البيانات
-        try:
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    # تحويل البيانات إلى JSON
-                    json_data = json.dumps(serialized_data, ensure_ascii=False)
-
-                    # استخدام REPLACE INTO لإضافة أو تحديث البيانات
-                    await cursor.execute(
-                        "REPLACE INTO conversation_states (user_id, state_data) VALUES (%s, %s)",
-                        (user_id, json_data)
-                    )
-                await conn.commit()
-            return True
-        except Exception as e:
-            logger.error(f"خطأ في حفظ حالة المحادثة: {e}")
-            return False
+    try:
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                # استعلام واحد ذري، لا حاجة لقفل المستخدم ولا لحذف+إدراج REPLACE INTO
+                await cursor.execute(
+                    """
+                    INSERT INTO conversation_states (user_id, state_data) VALUES (%s, %s)
+                    ON DUPLICATE KEY UPDATE state_data = VALUES(state_data)
+                    """,
+                    (user_id, json_data)
+                )
+            await conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"خطأ في حفظ حالة المحادثة: {e}")
+        return False
 
 
 
@@ -764,6 +2171,209 @@ async def get_conversation_state(user_id):
 
 
 
+# إعدادات حفظ بيانات المحادثة
+USER_PERSISTENCE_UPDATE_INTERVAL = 5   # كل كم ثانية يسلّم PTB بيانات المستخدمين المعدّلة
+USER_PERSISTENCE_FLUSH_DELAY = 1       # نافذة تجميع التغييرات قبل كتابتها
+USER_PERSISTENCE_RETRY_DELAY = 5       # انتظار إضافي بعد فشل الكتابة
+
+
+def _encode_persisted_value(value):
+    """تحويل القيم غير القابلة لـ JSON داخل user_data مع إمكانية استعادة نوعها"""
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, set):
+        return {"__set__": list(value)}
+    # لا نُسقط بيانات المستخدم كلها بسبب قيمة واحدة، لكن النوع لن يُستعاد بعد إعادة التشغيل
+    logger.warning(f"⚠️ قيمة من النوع {type(value).__name__} في user_data ستُحفظ كنص: {value!r:.100}")
+    return str(value)
+
+
+def _decode_persisted_value(obj):
+    if len(obj) == 1 and "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    if len(obj) == 1 and "__set__" in obj:
+        return set(obj["__set__"])
+    return obj
+
+
+class MySQLPersistence(BasePersistence):
+    """حفظ user_data وحالات المحادثة في MySQL، مع تجميع المستخدمين المعدّلين في كتابة واحدة"""
+
+    def __init__(self, update_interval=USER_PERSISTENCE_UPDATE_INTERVAL,
+                 flush_delay=USER_PERSISTENCE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self._dirty_users = {}           # user_id -> JSON أو None للحذف
+        self._dirty_conversations = {}   # (name, key) -> JSON للحالة أو None عند انتهاء المحادثة
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    # ===== القراءة عند بدء التشغيل =====
+
+    async def get_user_data(self):
+        user_data = {}
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT user_id, data FROM bot_user_data")
+                rows = await cursor.fetchall()
+
+        for user_id, data in rows:
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            try:
+                user_data[user_id] = json.loads(data, object_hook=_decode_persisted_value)
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر قراءة بيانات المستخدم {user_id} المحفوظة: {e}")
+        logger.info(f"💾 تم تحميل بيانات {len(user_data)} مستخدم")
+        return user_data
+
+    async def get_conversations(self, name):
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    "SELECT conv_key, state FROM bot_conversations WHERE name = %s",
+                    (name,)
+                )
+                rows = await cursor.fetchall()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # ===== تسجيل التغييرات (بدون أي اتصال بالقاعدة) =====
+
+    async def update_user_data(self, user_id, data):
+        try:
+            self._dirty_users[user_id] = json.dumps(data, default=_encode_persisted_value, ensure_ascii=False)
+        except Exception as e:
+            logger.error(f"❌ تعذر تحويل بيانات المستخدم {user_id} إلى JSON: {e}")
+            return
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        state = json.dumps(new_state) if new_state is not None else None
+        self._dirty_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # ===== الكتابة المجمّعة =====
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        while self._dirty_users or self._dirty_conversations:
+            await asyncio.sleep(self.flush_delay)
+            if not await self._write_pending():
+                await asyncio.sleep(USER_PERSISTENCE_RETRY_DELAY)
+
+    async def _write_pending(self):
+        async with self._flush_lock:
+            users, self._dirty_users = self._dirty_users, {}
+            conversations, self._dirty_conversations = self._dirty_conversations, {}
+            if not users and not conversations:
+                return True
+
+            user_rows = [(uid, data) for uid, data in users.items() if data is not None]
+            dropped_users = [uid for uid, data in users.items() if data is None]
+            conversation_rows = [(name, key, state) for (name, key), state in conversations.items() if state is not None]
+            ended_conversations = [(name, key) for (name, key), state in conversations.items() if state is None]
+
+            try:
+                async with get_db_connection() as conn:
+                    await conn.begin()
+                    try:
+                        async with conn.cursor() as cursor:
+                            # executemany يحول INSERT إلى استعلام واحد متعدد الصفوف
+                            if user_rows:
+                                await cursor.executemany("""
+                                    INSERT INTO bot_user_data (user_id, data) VALUES (%s, %s)
+                                    ON DUPLICATE KEY UPDATE data = VALUES(data)
+                                """, user_rows)
+                            if dropped_users:
+                                placeholders = ", ".join(["%s"] * len(dropped_users))
+                                await cursor.execute(
+                                    f"DELETE FROM bot_user_data WHERE user_id IN ({placeholders})",
+                                    dropped_users
+                                )
+                            if conversation_rows:
+                                await cursor.executemany("""
+                                    INSERT INTO bot_conversations (name, conv_key, state) VALUES (%s, %s, %s)
+                                    ON DUPLICATE KEY UPDATE state = VALUES(state)
+                                """, conversation_rows)
+                            if ended_conversations:
+                                placeholders = ", ".join(["(%s, %s)"] * len(ended_conversations))
+                                await cursor.execute(
+                                    f"DELETE FROM bot_conversations WHERE (name, conv_key) IN ({placeholders})",
+                                    [value for pair in ended_conversations for value in pair]
+                                )
+                        await conn.commit()
+                    except Exception:
+                        await conn.rollback()
+                        raise
+                return True
+            except BaseException as e:
+                # إعادة التغييرات للانتظار ما لم تصل نسخة أحدث، حتى عند الإلغاء
+                for uid, data in users.items():
+                    self._dirty_users.setdefault(uid, data)
+                for conv, state in conversations.items():
+                    self._dirty_conversations.setdefault(conv, state)
+                if not isinstance(e, Exception):
+                    raise
+                logger.error(
+                    f"❌ فشل حفظ بيانات {len(users)} مستخدم و{len(conversations)} محادثة: {e}"
+                )
+                return False
+
+    async def flush(self):
+        """يُستدعى من PTB عند الإيقاف: كتابة كل ما تبقى قبل إغلاق الاتصالات"""
+        if self._flush_task and not self._flush_task.done():
+            # الإلغاء تحت قفل الكتابة حتى لا تُقطع دفعة جارية في منتصفها
+            async with self._flush_lock:
+                self._flush_task.cancel()
+                try:
+                    await self._flush_task
+                except asyncio.CancelledError:
+                    pass
+        if not await self._write_pending():
+            logger.error("❌ بقيت بيانات محادثة غير محفوظة عند الإيقاف")
+
+
+
 async def add_cancellation_record(user_id, reason=None):
     """إضافة سجل إلغاء جديد"""
     try:
@@ -824,8 +2434,6 @@ from asyncio import Lock
 # إنشاء أقفال للعمليات الحرجة
 db_lock = Lock()  # قفل للعمليات على قاعدة البيانات
 
-user_state_lock = {}  # قفل لكل مستخدم على حدة
-
 
 
 ADMIN_MEDIA_CHANNEL = -1002659459294  
@@ -1161,13 +2769,11 @@ async def verify_code(update: Update, context: CallbackContext) -> int:
                         (user_id, name, phone, name, phone)
                     )
 
-                    await cursor.execute("SELECT name FROM provinces")
-                    rows = await cursor.fetchall()
-                    provinces = [row[0] for row in rows]
-                    context.user_data["valid_provinces"] = provinces.copy()
-
                 await conn.commit()
 
+            provinces = [province_name for _, province_name in await catalog_cache.provinces()]
+            context.user_data["valid_provinces"] = provinces.copy()
+
         except Exception as e:
             logger.error(f"Database error in verify_code: {e}")
             await update.message.reply_text("❌ حدث خطأ أثناء حفظ بياناتك. حاول لاحقًا.")
@@ -1205,26 +2811,19 @@ async def handle_province(update: Update, context: CallbackContext) -> int:
         return ASK_PROVINCE
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                # جلب معرف المحافظة
-                await cursor.execute("SELECT id FROM provinces WHERE name = %s", (province,))
-                result = await cursor.fetchone()
+        # جلب معرف المحافظة
+        province_id = await catalog_cache.province_id(province)
 
-                if not result:
-                    await update.message.reply_text("⚠️ حدث خطأ أثناء جلب المدن. حاول مرة أخرى.")
-                    return ASK_PROVINCE
-
-                province_id = result[0]
-                context.user_data['province_id'] = province_id
-                context.user_data['province_name'] = province
+        if not province_id:
+            await update.message.reply_text("⚠️ حدث خطأ أثناء جلب المدن. حاول مرة أخرى.")
+            return ASK_PROVINCE
 
-                # جلب المدن المرتبطة
-                await cursor.execute("SELECT id, name FROM cities WHERE province_id = %s", (province_id,))
-                rows = await cursor.fetchall()
+        context.user_data['province_id'] = province_id
+        context.user_data['province_name'] = province
 
-        cities = [(row[0], row[1]) for row in rows]
-        city_names = [row[1] for row in rows]
+        # جلب المدن المرتبطة
+        cities = await catalog_cache.cities(province_id)
+        city_names = [name for _, name in cities]
         city_names += ["وين مدينتي ؟ 😟", "عودة ➡️"]  # ✅ إضافة زر العودة
 
         context.user_data['city_map'] = {name: cid for cid, name in cities}
@@ -1250,13 +2849,8 @@ async def handle_city(update: Update, context: CallbackContext) -> int:
         context.user_data.pop('province_id', None)
         context.user_data.pop('province_name', None)
 
-        try:
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT name FROM provinces")
-                    rows = await cursor.fetchall()
-
-            provinces = [row[0] for row in rows]
+        try:
+            provinces = [name for _, name in await catalog_cache.provinces()]
             provinces.append("عودة ➡️")  # ✅ إضافة زر العودة
 
             reply_markup = ReplyKeyboardMarkup([[p] for p in provinces], resize_keyboard=True)
@@ -1322,20 +2916,12 @@ async def handle_custom_city(update: Update, context: CallbackContext) -> int:
                 await update.message.reply_text("⚠️ لم يتم العثور على المحافظة. يرجى اختيارها من جديد.")
                 return ASK_PROVINCE
 
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT id FROM provinces WHERE name = %s", (province,))
-                    result = await cursor.fetchone()
-
-                    if not result:
-                        await update.message.reply_text("⚠️ لم يتم العثور على المحافظة. يرجى اختيارها من جديد.")
-                        return ASK_PROVINCE
-
-                    province_id = result[0]
-                    await cursor.execute("SELECT name FROM cities WHERE province_id = %s", (province_id,))
-                    rows = await cursor.fetchall()
+            province_id = await catalog_cache.province_id(province)
+            if not province_id:
+                await update.message.reply_text("⚠️ لم يتم العثور على المحافظة. يرجى اختيارها من جديد.")
+                return ASK_PROVINCE
 
-            cities = [row[0] for row in rows]
+            cities = [name for _, name in await catalog_cache.cities(province_id)]
             city_options = cities + ["وين مدينتي ؟ 😟", "عودة ➡️"]
             reply_markup = ReplyKeyboardMarkup([[city] for city in city_options], resize_keyboard=True)
             await update.message.reply_text("بأي مدينة ؟ 😁", reply_markup=reply_markup)
@@ -1374,20 +2960,12 @@ async def handle_custom_city(update: Update, context: CallbackContext) -> int:
 
     # ✅ إعادة المستخدم لاختيار المدينة من القائمة
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT id FROM provinces WHERE name = %s", (province,))
-                result = await cursor.fetchone()
-
-                if not result:
-                    await update.message.reply_text("⚠️ لم يتم العثور على المحافظة. يرجى اختيارها من جديد.")
-                    return ASK_PROVINCE
-
-                province_id = result[0]
-                await cursor.execute("SELECT name FROM cities WHERE province_id = %s", (province_id,))
-                rows = await cursor.fetchall()
+        province_id = await catalog_cache.province_id(province)
+        if not province_id:
+            await update.message.reply_text("⚠️ لم يتم العثور على المحافظة. يرجى اختيارها من جديد.")
+            return ASK_PROVINCE
 
-        cities = [row[0] for row in rows]
+        cities = [name for _, name in await catalog_cache.cities(province_id)]
         city_options = cities + ["وين مدينتي ؟ 😟", "عودة ➡️"]
         reply_markup = ReplyKeyboardMarkup([[city] for city in city_options], resize_keyboard=True)
         await update.message.reply_text("بأي مدينة ؟ 😁", reply_markup=reply_markup)
@@ -1633,7 +3211,7 @@ async def handle_confirmation(update: Update, context: CallbackContext) -> int:
                 await conn.commit()
 
 
-            # ✅ حفظ حالة المستخدم بعد التسجيل
+            # ✅ حفظ حالة المستخدم بعد التسجيل (استبدال كامل: لا تبقى ملاحظات أو مواقع مؤقتة قديمة)
             await save_conversation_state(user_id, {
                 "name": name,
                 "phone": phone,
@@ -1881,13 +3459,10 @@ async def main_menu(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
 
     # 🧹 حذف أي رسائل تفاعلية سابقة (من نحن، الدعم، FAQ...)
-    for key in ["support_sticker_id", "support_msg_id", "about_us_msg_id", "faq_msg_id", "faq_answer_msg_id"]:
-        msg_id = context.user_data.pop(key, None)
-        if msg_id:
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg_id)
-            except:
-                pass
+    message_cleaner.schedule(update.effective_chat.id, [
+        context.user_data.pop(key, None)
+        for key in ["support_sticker_id", "support_msg_id", "about_us_msg_id", "faq_msg_id", "faq_answer_msg_id"]
+    ])
 
     # ✅ إرسال بكج إذا مر وقت طويل بدون طلب
     await maybe_send_package(update, context)
@@ -1963,7 +3538,7 @@ async def main_menu(update: Update, context: CallbackContext) -> int:
             'orders', 'order_confirmed', 'selected_restaurant', 'restaurant_map',
             'selected_restaurant_id', 'selected_restaurant_name',
             'selected_category_id', 'selected_category_name', 'go_ad_restaurant_name',
-            'current_meal_messages', 'conversation_state'
+            'current_meal_messages', 'meal_carousel', 'summary_msg_id', 'conversation_state'
         ]:
             context.user_data.pop(key, None)
 
@@ -1971,8 +3546,7 @@ async def main_menu(update: Update, context: CallbackContext) -> int:
             async with get_db_connection() as conn:
                 async with conn.cursor() as cursor:
                     # 🗑️ حذف السلة
-                    await cursor.execute("DELETE FROM shopping_carts WHERE user_id = %s", (user_id,))
-                    await conn.commit()
+                    await delete_cart_from_db(user_id)
 
                     # التحقق من الحظر
                     await cursor.execute("SELECT phone FROM user_data WHERE user_id = %s", (user_id,))
@@ -1995,28 +3569,14 @@ async def main_menu(update: Update, context: CallbackContext) -> int:
                         return await start(update, context)
 
                     city_id = row[0]
-                    await cursor.execute("SELECT id, name, is_frozen FROM restaurants WHERE city_id = %s", (city_id,))
-                    rows = await cursor.fetchall()
 
-                    if not rows:
-                        await update.message.reply_text("❌ لا يوجد مطاعم حالياً في مدينتك.")
-                        return MAIN_MENU
+            city_restaurants = await catalog_cache.city_restaurants(city_id)
+            if not city_restaurants:
+                await update.message.reply_text("❌ لا يوجد مطاعم حالياً في مدينتك.")
+                return MAIN_MENU
 
-                    # ✅ عرض المطاعم
-                    restaurants = []
-                    restaurant_map = {}
-                    for restaurant_id, name, is_frozen in rows:
-                        if is_frozen:
-                            continue
-                        await cursor.execute(
-                            "SELECT COUNT(*), AVG(rating) FROM restaurant_ratings WHERE restaurant_id = %s",
-                            (restaurant_id,)
-                        )
-                        rating_data = await cursor.fetchone()
-                        avg = round(rating_data[1], 1) if rating_data and rating_data[0] > 0 else 0
-                        label = f"{name} ⭐ ({avg})"
-                        restaurants.append(label)
-                        restaurant_map[label] = {"id": restaurant_id, "name": name}
+            # ✅ عرض المطاعم
+            restaurants, restaurant_map = build_restaurant_choices(city_restaurants)
 
             if not restaurants:
                 await update.message.reply_text("❌ جميع المطاعم في مدينتك مجمدة حالياً.")
@@ -2040,6 +3600,46 @@ async def main_menu(update: Update, context: CallbackContext) -> int:
 
 
 
+async def get_city_restaurants(city_id: int) -> list:
+    """جلب مطاعم المدينة مع حالة التجميد وإحصائيات التقييم باستعلام واحد"""
+    async with get_db_connection() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute("""
+                SELECT r.id, r.name, r.is_frozen, s.rating_count, s.avg_rating
+                FROM restaurants r
+                LEFT JOIN restaurant_rating_summary s ON s.restaurant_id = r.id
+                WHERE r.city_id = %s
+                ORDER BY r.id
+            """, (city_id,))
+            rows = await cursor.fetchall()
+
+    return [
+        {
+            "id": restaurant_id,
+            "name": name,
+            "is_frozen": bool(is_frozen),
+            "rating_count": rating_count or 0,
+            "avg_rating": float(avg_rating) if avg_rating is not None else 0.0
+        }
+        for restaurant_id, name, is_frozen, rating_count, avg_rating in rows
+    ]
+
+
+def build_restaurant_choices(restaurants: list) -> tuple[list, dict]:
+    """بناء أزرار المطاعم غير المجمدة مع متوسط التقييم وخريطة الزر ← المطعم"""
+    labels = []
+    restaurant_map = {}
+    for restaurant in restaurants:
+        if restaurant["is_frozen"]:
+            continue
+        avg = round(restaurant["avg_rating"], 1) if restaurant["rating_count"] > 0 else 0
+        label = f"{restaurant['name']} ⭐ ({avg})"
+        labels.append(label)
+        restaurant_map[label] = {"id": restaurant["id"], "name": restaurant["name"]}
+    return labels, restaurant_map
+
+
+
 def chunk_buttons(buttons, cols=2):
     return [buttons[i:i + cols] for i in range(0, len(buttons), cols)]
 
@@ -2047,19 +3647,13 @@ def chunk_buttons(buttons, cols=2):
 
 
 async def clear_main_menu_context(update: Update, context: CallbackContext):
-    for key in [
-        "support_sticker_id", "support_msg_id",
-        "about_us_msg_id", "faq_msg_id", "faq_answer_msg_id"
-    ]:
-        msg_id = context.user_data.pop(key, None)
-        if msg_id:
-            try:
-                await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=msg_id
-                )
-            except:
-                pass
+    message_cleaner.schedule(update.effective_chat.id, [
+        context.user_data.pop(key, None)
+        for key in [
+            "support_sticker_id", "support_msg_id",
+            "about_us_msg_id", "faq_msg_id", "faq_answer_msg_id"
+        ]
+    ])
 
 
 
@@ -2155,7 +3749,6 @@ async def handle_faq_back(update: Update, context: CallbackContext) -> None:
 async def handle_restaurant_selection(update: Update, context: CallbackContext) -> int:
     selected_option = update.message.text
     restaurant_map = context.user_data.get('restaurant_map', {})
-    user_id = update.effective_user.id
 
     # 🛡️ التحقق من الخيارات الخاصة
     if selected_option == "مطعمي المفضل وينو ؟ 😕":
@@ -2202,26 +3795,19 @@ async def handle_restaurant_selection(update: Update, context: CallbackContext)
     restaurant_name = restaurant_data["name"]
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT is_frozen FROM restaurants WHERE id = %s", (restaurant_id,))
-                result = await cursor.fetchone()
-                if not result:
-                    await update.message.reply_text("❌ لم يتم العثور على حالة المطعم.")
-                    return SELECT_RESTAURANT
+        restaurant = await catalog_cache.restaurant(restaurant_id)
+        if not restaurant:
+            await update.message.reply_text("❌ لم يتم العثور على حالة المطعم.")
+            return SELECT_RESTAURANT
 
-                is_frozen = result[0]
-                if is_frozen:
-                    await update.message.reply_text(f"❌ المطعم {restaurant_name} خارج الخدمة مؤقتاً.")
-                    return SELECT_RESTAURANT
+        if restaurant["is_frozen"]:
+            await update.message.reply_text(f"❌ المطعم {restaurant_name} خارج الخدمة مؤقتاً.")
+            return SELECT_RESTAURANT
 
         # ✅ تخزين المطعم والمتابعة
         context.user_data["selected_restaurant_id"] = restaurant_id
         context.user_data["selected_restaurant_name"] = restaurant_name
         context.user_data["selected_restaurant"] = restaurant_name
-        
-        # حفظ المطعم المختار في حالة المحادثة أيضاً
-        await update_conversation_state(user_id, 'selected_restaurant', restaurant_name)
 
         await show_restaurant_categories(update, context)  # ← تعرض الفئات
         return ORDER_CATEGORY  # ← تحدد المرحلة القادمة
@@ -2242,24 +3828,16 @@ async def check_restaurant_availability(restaurant_id: int) -> bool:
         damascus_time = datetime.now(pytz.timezone("Asia/Damascus"))
         now_hour = damascus_time.hour + damascus_time.minute / 60
 
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT open_hour, close_hour, is_frozen
-                    FROM restaurants
-                    WHERE id = %s
-                """, (restaurant_id,))
-                result = await cursor.fetchone()
+        restaurant = await catalog_cache.restaurant(restaurant_id)
 
-        if not result:
+        if not restaurant:
             logger.warning(f"⚠️ المطعم غير موجود: {restaurant_id}")
             return False
 
-        open_hour, close_hour, is_frozen = result
-        if is_frozen:
+        if restaurant["is_frozen"]:
             return False
 
-        return open_hour <= now_hour < close_hour
+        return restaurant["open_hour"] <= now_hour < restaurant["close_hour"]
 
     except Exception as e:
         logger.exception(f"❌ خطأ في check_restaurant_availability: {e}")
@@ -2273,19 +3851,18 @@ async def show_restaurant_categories(update: Update, context: CallbackContext) -
         return MAIN_MENU
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT name FROM restaurants WHERE id = %s", (restaurant_id,))
-                row = await cursor.fetchone()
-                if not row:
-                    await update.message.reply_text("❌ لم يتم العثور على اسم المطعم.")
-                    return MAIN_MENU
+        restaurant = await catalog_cache.restaurant(restaurant_id)
+        if not restaurant:
+            await update.message.reply_text("❌ لم يتم العثور على اسم المطعم.")
+            return MAIN_MENU
 
-                restaurant_name = row[0]
-                context.user_data["selected_restaurant_name"] = restaurant_name
+        restaurant_name = restaurant["name"]
+        context.user_data["selected_restaurant_name"] = restaurant_name
+        # مطعم جديد يبدأ برسالة كاروسيل وملخص جديدين أسفل المحادثة
+        context.user_data.pop("meal_carousel", None)
+        cart_summaries.forget(update.effective_chat.id, context.user_data)
 
-                await cursor.execute("SELECT id, name FROM categories WHERE restaurant_id = %s ORDER BY name", (restaurant_id,))
-                rows = await cursor.fetchall()
+        rows = await catalog_cache.categories(restaurant_id)
 
         if not rows:
             await update.message.reply_text("❌ لا توجد فئات لهذا المطعم حالياً.")
@@ -2337,33 +3914,19 @@ async def handle_order_flow_help(update: Update, context: CallbackContext):
 
 
 async def has_active_order(user_id: int) -> bool:
-    """
-    التحقق من وجود طلب نشط للمستخدم.
-    يشمل الحالات:
-    - قيد التوصيل
-    - بانتظار الكاشير
-    - جاري المعالجة
-    - pending
-    - in_progress
-    """
+    """التحقق من وجود طلب نشط للمستخدم (بانتظار الكاشير، قيد التحضير، أو مع الدليفري)"""
     try:
         async with get_db_connection() as conn:
             async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT status FROM orders 
-                    WHERE user_id = %s 
-                    ORDER BY id DESC 
+                placeholders = ", ".join(["%s"] * len(ACTIVE_ORDER_STATES))
+                await cursor.execute(f"""
+                    SELECT 1 FROM user_orders
+                    WHERE user_id = %s
+                      AND status IN ({placeholders})
+                      AND timestamp >= NOW() - INTERVAL %s HOUR
                     LIMIT 1
-                """, (user_id,))
-                row = await cursor.fetchone()
-
-        if not row:
-            return False
-
-        return row[0] in [
-            "قيد التوصيل", "بانتظار الكاشير", "جاري المعالجة",
-            "pending", "in_progress"
-        ]
+                """, (user_id, *ACTIVE_ORDER_STATES, ACTIVE_ORDER_MAX_AGE_HOURS))
+                return await cursor.fetchone() is not None
 
     except Exception as e:
         logger.error(f"❌ Error checking active order for user {user_id}: {e}")
@@ -2388,26 +3951,7 @@ async def handle_missing_restaurant(update: Update, context: CallbackContext) ->
                 city_id = row[0]
 
                 # ✅ جلب المطاعم المتاحة
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT id, name, is_frozen FROM restaurants WHERE city_id = %s", (city_id,))
-                    rows = await cursor.fetchall()
-
-                restaurants = []
-                restaurant_map = {}
-
-                for rest_id, name, is_frozen in rows:
-                    if is_frozen:
-                        continue
-
-                    async with conn.cursor() as cursor:
-                        await cursor.execute("SELECT COUNT(*), AVG(rating) FROM restaurant_ratings WHERE restaurant_id = %s", (rest_id,))
-                        rating_data = await cursor.fetchone()
-
-                    avg = round(rating_data[1], 1) if rating_data and rating_data[0] > 0 else 0
-                    label = f"{name} ⭐ ({avg})"
-
-                    restaurants.append(label)
-                    restaurant_map[name] = {"id": rest_id, "name": name}
+                restaurants, restaurant_map = build_restaurant_choices(await catalog_cache.city_restaurants(city_id))
 
                 restaurants += ["القائمة الرئيسية 🪧", "مطعمي المفضل وينو ؟ 😕"]
                 context.user_data["restaurant_map"] = restaurant_map
@@ -2458,25 +4002,7 @@ async def handle_missing_restaurant(update: Update, context: CallbackContext) ->
                 await update.message.reply_text("❌ حدث خطأ أثناء إرسال اسم المطعم. يرجى المحاولة لاحقاً.")
 
             # ✅ بعد إرسال المطعم، نعيد عرض المطاعم كالسابق
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT id, name, is_frozen FROM restaurants WHERE city_id = %s", (city_id,))
-                rows = await cursor.fetchall()
-
-            restaurants = []
-            restaurant_map = {}
-
-            for rest_id, name, is_frozen in rows:
-                if is_frozen:
-                    continue
-
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT COUNT(*), AVG(rating) FROM restaurant_ratings WHERE restaurant_id = %s", (rest_id,))
-                    rating_data = await cursor.fetchone()
-
-                avg = round(rating_data[1], 1) if rating_data and rating_data[0] > 0 else 0
-                label = f"{name} ⭐ ({avg})"
-                restaurants.append(label)
-                restaurant_map[name] = {"id": rest_id, "name": name}
+            restaurants, restaurant_map = build_restaurant_choices(await catalog_cache.city_restaurants(city_id))
 
             restaurants += ["القائمة الرئيسية 🪧", "مطعمي المفضل وينو ؟ 😕"]
             context.user_data["restaurant_map"] = restaurant_map
@@ -2521,35 +4047,30 @@ async def process_category_selection(update: Update, context: CallbackContext) -
     context.user_data["selected_category_id"] = category_id
     context.user_data["selected_category_name"] = category_name
 
-    # حذف الرسائل السابقة للوجبات إن وجدت
-    old_messages = context.user_data.pop("current_meal_messages", [])
-    for msg_id in old_messages:
-        try:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=msg_id)
-        except Exception as e:
-            logger.error(f"❌ فشل في حذف رسالة قديمة: {e}")
+    # حذف الرسائل السابقة للوجبات إن وجدت (طلب deleteMessages واحد في الخلفية)
+    message_cleaner.schedule(update.effective_chat.id, context.user_data.pop("current_meal_messages", []))
 
     # إنشاء قائمة جديدة لتخزين معرفات الرسائل الجديدة
     context.user_data["current_meal_messages"] = []
 
-    # عرض رسالة انتظار
-    wait_message = await update.message.reply_text("⏳ جاري تحميل الوجبات...")
+    # في وضع الكاروسيل يكون تبديل الفئة تعديلًا واحدًا للرسالة القائمة، فلا حاجة لرسالة انتظار
+    # ولا لإعادة إرسال لوحة الفئات الظاهرة أصلًا
+    carousel_open = MEAL_DISPLAY_MODE == "carousel" and bool(context.user_data.get("meal_carousel"))
+    wait_message = None if carousel_open else await update.message.reply_text("⏳ جاري تحميل الوجبات...")
 
     try:
         await show_meals_in_category(update, context)
-        
+
+        if carousel_open:
+            context.user_data["conversation_state"] = ORDER_MEAL
+            return ORDER_MEAL
+
         # حذف رسالة الانتظار
-        try:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=wait_message.message_id)
-        except:
-            pass
+        message_cleaner.schedule(update.effective_chat.id, [wait_message.message_id])
 
         # عرض أزرار الفئات
         restaurant_id = context.user_data.get("selected_restaurant_id")
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT id, name FROM categories WHERE restaurant_id = %s", (restaurant_id,))
-                categories = await cursor.fetchall()
+        categories = await catalog_cache.categories(restaurant_id)
 
         category_map = {}
         for cat_id, name in categories:
@@ -2573,10 +4094,8 @@ async def process_category_selection(update: Update, context: CallbackContext) -
     except Exception as e:
         import traceback
         logger.error(f"❌ خطأ في process_category_selection: {traceback.format_exc()}")
-        try:
-            await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=wait_message.message_id)
-        except:
-            pass
+        if wait_message:
+            message_cleaner.schedule(update.effective_chat.id, [wait_message.message_id])
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="❌ حدث خطأ أثناء تحميل الوجبات. يرجى المحاولة لاحقاً."
@@ -2623,85 +4142,58 @@ async def handle_add_meal_with_size(update: Update, context: CallbackContext) ->
         # ⬅️ تخزين meal_id مؤقتًا في user_data (في حال احتجناه لاحقًا)
         context.user_data["meal_id_str"] = meal_id_str
 
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT name, price, size_options
-                    FROM meals
-                    WHERE id = %s
-                """, (meal_id,))
-                result = await cursor.fetchone()
+        meal = await catalog_cache.meal(meal_id)
+        if not meal:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="❌ لم يتم العثور على الوجبة."
+            )
+            return ORDER_MEAL
 
-                if not result:
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text="❌ لم يتم العثور على الوجبة."
-                    )
-                    return ORDER_MEAL
+        meal_name, base_price, size_options_json = meal["name"], meal["price"], meal["size_options"]
 
-                meal_name, base_price, size_options_json = result
+        try:
+            size_options = json.loads(size_options_json or "[]")
+        except Exception as e:
+            logger.error(f"❌ فشل في قراءة size_options: {e}")
+            size_options = []
+
+        price = base_price or 0
+        if size != "default":
+            for opt in size_options:
+                if opt.get("name") == size:
+                    price = opt.get("price", price)
+                    break
+
+        # ✅ item_data يتضمن meal_id
+        item_data = {
+            "name": meal_name,
+            "size": size,
+            "price": price,
+            "meal_id": meal_id
+        }
 
-                try:
-                    size_options = json.loads(size_options_json or "[]")
-                except Exception as e:
-                    logger.error(f"❌ فشل في قراءة size_options: {e}")
-                    size_options = []
-
-                price = base_price or 0
-                if size != "default":
-                    for opt in size_options:
-                        if opt.get("name") == size:
-                            price = opt.get("price", price)
-                            break
-
-                # ✅ item_data يتضمن meal_id
-                item_data = {
-                    "name": meal_name,
-                    "size": size,
-                    "price": price,
-                    "meal_id": meal_id
-                }
+        logger.info(f"🛒 item_data المحضر للإضافة إلى السلة: {item_data}")
 
-                logger.info(f"🛒 item_data المحضر للإضافة إلى السلة: {item_data}")
+        # ✅ إضافة للسلة
+        cart = await add_item_to_cart(user_id, item_data, context)
+        total_price = cart.total
 
-                # ✅ إضافة للسلة
-                orders, total_price = await add_item_to_cart(user_id, item_data, context)
-                context.user_data["orders"] = orders
-                context.user_data["temporary_total_price"] = total_price
+        # 📝 بناء ملخص جديد
+        summary_text = cart.summary_text()
 
-                # 🧹 حذف رسالة الملخص السابقة إن وجدت
-                msg_id = context.user_data.pop("summary_msg_id", None)
-                if msg_id:
-                    try:
-                        await context.bot.delete_message(update.effective_chat.id, msg_id)
-                    except:
-                        pass
-
-                # 📝 بناء ملخص جديد
-                summary_counter = defaultdict(int)
-                for item in orders:
-                    label = f"{item['name']} ({item['size']})" if item["size"] != "default" else item["name"]
-                    summary_counter[label] += 1
-
-                summary_lines = [f"{count} × {label}" for label, count in summary_counter.items()]
-                summary_text = "\n".join(summary_lines)
-
-                text = (
-                    f"✅ تمت إضافة: {item_data['name']} ({item_data['size']})\n\n"
-                    f"🛒 طلبك حتى الآن:\n{summary_text}\n\n"
-                    f"💰 المجموع: {total_price} ل.س\n"
-                    f"عندما تنتهي اختر ✅ تم من الأسفل"
-                )
+        text = (
+            f"✅ تمت إضافة: {item_data['name']} ({item_data['size']})\n\n"
+            f"🛒 طلبك حتى الآن:\n{summary_text}\n\n"
+            f"💰 المجموع: {total_price} ل.س\n"
+            f"عندما تنتهي اختر ✅ تم من الأسفل"
+        )
 
-                msg = await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=text
-                )
-                context.user_data["summary_msg_id"] = msg.message_id
-                await update_conversation_state(user_id, "summary_msg_id", msg.message_id)
+        # ✏️ تعديل رسالة الملخص القائمة (أو إرسالها أول مرة)
+        cart_summaries.update(context.bot, update.effective_chat.id, context.user_data, text)
 
-                logger.info("✅ تم تنفيذ handle_add_meal_with_size بنجاح.")
-                return ORDER_MEAL
+        logger.info("✅ تم تنفيذ handle_add_meal_with_size بنجاح.")
+        return ORDER_MEAL
 
     except Exception as e:
         logger.error(f"❌ استثناء في handle_add_meal_with_size: {e}", exc_info=True)
@@ -2720,139 +4212,540 @@ async def add_item_to_cart(user_id: int, item_data: dict, context: CallbackConte
     user_id = int(user_id)
     
     try:
-        cart = await get_cart_from_db(user_id) or []
-        
         # تأكد من تخزين معرف الوجبة في item_data إذا كان متاحاً
         if 'meal_id' not in item_data and 'meal_id_str' in context.user_data:
             item_data['meal_id'] = int(context.user_data['meal_id_str'])
         
-        cart.append(item_data)
-        
-        saved = await save_cart_to_db(user_id, cart)
-        if not saved:
-            logger.warning(f"⚠️ لم يتم حفظ السلة للمستخدم {user_id}")
+        cart = await cart_cache.append_item(user_id, item_data)
         
         # حفظ نسخة محلية من السلة
-        context.user_data["cart"] = cart
-        
-        total_price = sum(item.get("price", 0) for item in cart)
-        return cart, total_price
+        context.user_data["orders"] = cart.to_data()
+        context.user_data["temporary_total_price"] = cart.total
+        return cart
         
     except Exception as e:
         logger.error(f"❌ خطأ داخل add_item_to_cart: {e}", exc_info=True)
-        return [], 0
+        return Cart()
+
+
+
+
+
+
+
+
+
+async def handle_remove_specific_meal(update: Update, context: CallbackContext) -> int:
+    user_id = update.effective_user.id
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        # استخراج معلومات الوجبة من callback_data
+        _, meal_id_str, _ = query.data.split(":")
+        meal_id = int(meal_id_str)
+        
+        cart = await get_cart_from_db(user_id)
+        
+        if not cart:
+            await query.answer("❌ لا توجد وجبات في سلتك!")
+            return ORDER_MEAL
+        
+        # استرجاع اسم الوجبة من الكتالوج
+        meal = await catalog_cache.meal(meal_id)
+        if not meal:
+            await query.answer("❌ لم يتم العثور على الوجبة!")
+            return ORDER_MEAL
+        meal_name = meal["name"]
+        
+        # حذف آخر وجبة مطابقة في السلة (من النهاية إلى البداية)
+        cart, removed_item = await cart_cache.remove_last(user_id, meal_id, meal_name)
+        
+        if not removed_item:
+            await query.answer("❌ لم يتم العثور على الوجبة في سلتك!")
+            return ORDER_MEAL
+        
+        # تحديث النسخة المحلية
+        context.user_data["orders"] = cart.to_data()
+        context.user_data["temporary_total_price"] = cart.total
+        
+        # تأكيد الحذف للمستخدم
+        size_text = f" ({removed_item.get('size')})" if removed_item.get('size') != "default" else ""
+        await query.answer(f"✅ تم حذف: {removed_item.get('name')}{size_text}")
+        
+        # إعداد ملخص جديد
+        summary_text = cart.summary_text()
+        total_price = cart.total
+        
+        # تحديث رسالة الملخص في مكانها
+        if cart:
+            text = (
+                f"🛒 طلبك بعد الحذف:\n{summary_text}\n\n"
+                f"💰 المجموع: {total_price} ل.س\n"
+                f"عندما تنتهي اختر ✅ تم من الأسفل"
+            )
+        else:
+            text = "✅ تم حذف آخر وجبة. سلتك الآن فارغة."
+        
+        cart_summaries.update(context.bot, update.effective_chat.id, context.user_data, text)
+        
+        return ORDER_MEAL
+        
+    except Exception as e:
+        logger.error(f"❌ خطأ في handle_remove_specific_meal: {e}", exc_info=True)
+        await query.answer("❌ حدث خطأ أثناء حذف الوجبة")
+        return ORDER_MEAL
+
+
+
+
+
+
+
+
+
+
+# إعدادات تحويل صور القناة إلى file_id
+MEDIA_MIGRATION_BATCH = 50   # عدد الوجبات في كل دفعة من ترحيل الصور القديمة
+MEDIA_MIGRATION_DELAY = 1    # ثانية بين الدفعات حتى لا نزاحم المستخدمين على حد تيليجرام
+MEDIA_CHANNEL_RATE = 20      # حد تيليجرام للقناة الواحدة ~20 رسالة في الدقيقة (توجيه + حذف لكل صورة)
+
+
+def is_channel_media_ref(image_file_id):
+    """الصور القديمة مخزنة كرقم رسالة في ADMIN_MEDIA_CHANNEL بدل file_id"""
+    return bool(image_file_id) and str(image_file_id).lstrip("-").isdigit()
+
+
+class MediaResolver:
+    """تحويل رسائل صور القناة إلى file_id مرة واحدة وحفظه في جدول meals"""
+
+    def __init__(self):
+        self._file_ids = {}    # message_id في القناة -> file_id
+        self._failed = set()   # رسائل ليست صورًا أو محذوفة، لا نعيد محاولتها في هذه الجلسة
+        self._inflight = {}    # message_id -> Future لمنع تحويل نفس الرسالة مرتين بالتوازي
+        self._queued = OrderedDict()  # meal_id -> (المرجع، category_id) لوجبات عُرضت وتنتظر التحويل
+        self._wakeup = asyncio.Event()
+        self._channel_limiter = RateLimiter(max_calls=MEDIA_CHANNEL_RATE, period=60)
+        self._migration_task = None
+        self.resolved = 0
+
+    async def _forward_for_file_id(self, bot, message_id):
+        # لا توجد getMessage في Bot API، لذلك نعيد توجيه الرسالة داخل القناة نفسها
+        # لنقرأ الصورة من الرسالة المعادة ثم نحذفها
+        await self._channel_limiter.acquire()
+        forwarded = await bot.forward_message(
+            chat_id=ADMIN_MEDIA_CHANNEL,
+            from_chat_id=ADMIN_MEDIA_CHANNEL,
+            message_id=message_id,
+            disable_notification=True
+        )
+        try:
+            return forwarded.photo[-1].file_id if forwarded.photo else None
+        finally:
+            try:
+                await self._channel_limiter.acquire()
+                await bot.delete_message(chat_id=ADMIN_MEDIA_CHANNEL, message_id=forwarded.message_id)
+            except Exception:
+                pass
+
+    async def file_id(self, bot, message_id, raise_retry_after=False):
+        """file_id لصورة رسالة القناة، أو None إذا تعذر التحويل.
+
+        مع raise_retry_after يُعاد رفع RetryAfter ليتوقف المستدعي مدة الانتظار ثم يعيد المحاولة.
+        """
+        message_id = int(message_id)
+        if message_id in self._file_ids:
+            return self._file_ids[message_id]
+        if message_id in self._failed:
+            return None
+        if message_id in self._inflight:
+            return await asyncio.shield(self._inflight[message_id])
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[message_id] = future
+        file_id = None
+        try:
+            await telegram_limiter.acquire()
+            file_id = await self._forward_for_file_id(bot, message_id)
+            if not file_id:
+                # الرسالة موجودة لكنها ليست صورة
+                self._failed.add(message_id)
+        except RetryAfter as e:
+            # لا نعتبرها فشلًا دائمًا، ستُعاد المحاولة في العرض التالي
+            logger.warning(f"⏳ تأجيل تحويل صورة القناة {message_id} لمدة {e.retry_after} ثانية")
+            if raise_retry_after:
+                raise
+        except BadRequest as e:
+            # رسالة محذوفة أو غير صالحة: فشل دائم في هذه الجلسة
+            logger.error(f"❌ تعذر تحويل صورة القناة {message_id}: {e}")
+            self._failed.add(message_id)
+        except Exception as e:
+            # مهلة أو خطأ شبكة: مؤقت، ستُعاد المحاولة لاحقًا
+            logger.warning(f"⚠️ تعذر تحويل صورة القناة {message_id} مؤقتًا: {e}")
+        finally:
+            if file_id:
+                self._file_ids[message_id] = file_id
+            del self._inflight[message_id]
+            future.set_result(file_id)
+        return file_id
+
+    @staticmethod
+    async def _store(rows):
+        """rows: [(meal_id, المرجع القديم, file_id)] — حفظ file_id مع إبقاء رقم الرسالة في image_message_id"""
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany("""
+                    UPDATE meals
+                    SET image_file_id = %s,
+                        image_message_id = IF(COALESCE(image_message_id, 0) = 0, %s, image_message_id)
+                    WHERE id = %s AND image_file_id = %s
+                """, [(file_id, int(ref), meal_id, str(ref)) for meal_id, ref, file_id in rows])
+
+    def queue_cards(self, category_id, cards):
+        """جدولة تحويل صور القناة لبطاقات معروضة الآن؛ العرض نفسه يرسلها بـ copy_message ولا ينتظر"""
+        for card in cards:
+            if is_channel_media_ref(card.image_file_id) and int(card.image_file_id) not in self._failed:
+                self._queued[card.meal_id] = (card.image_file_id, category_id)
+        if self._queued:
+            self._wakeup.set()
+
+    async def _file_id_waiting(self, bot, ref):
+        """file_id مع انتظار RetryAfter وإعادة نفس المرجع بدل تجاوزه"""
+        while True:
+            try:
+                return await self.file_id(bot, ref, raise_retry_after=True)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def _resolve_queued(self, bot):
+        """تحويل الوجبات التي عُرضت مؤخرًا قبل غيرها"""
+        while self._queued:
+            meal_id, (ref, category_id) = self._queued.popitem(last=False)
+            file_id = await self._file_id_waiting(bot, ref)
+            if not file_id:
+                continue
+            try:
+                await self._store([(meal_id, ref, file_id)])
+                self.resolved += 1
+            except Exception as e:
+                logger.error(f"❌ تعذر حفظ file_id للوجبة {meal_id}: {e}")
+            catalog_cache.invalidate("meals", category_id)
+
+    async def migrate(self, bot):
+        """ترحيل دفعي لكل الوجبات التي ما زالت صورها مراجع رسائل في القناة"""
+        last_id = 0
+        while True:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        SELECT id, image_file_id
+                        FROM meals
+                        WHERE id > %s AND image_file_id REGEXP '^-?[0-9]+$'
+                        ORDER BY id
+                        LIMIT %s
+                    """, (last_id, MEDIA_MIGRATION_BATCH))
+                    batch = await cursor.fetchall()
+            if not batch:
+                break
+            last_id = batch[-1][0]
+
+            rows = []
+            for meal_id, ref in batch:
+                await self._resolve_queued(bot)
+                file_id = await self._file_id_waiting(bot, ref)
+                if file_id:
+                    rows.append((meal_id, ref, file_id))
+            if rows:
+                await self._store(rows)
+                self.resolved += len(rows)
+            await asyncio.sleep(MEDIA_MIGRATION_DELAY)
+
+        if self.resolved:
+            catalog_cache.invalidate("meals")
+        logger.info(f"🖼️ انتهى ترحيل صور القناة: {self.resolved} وجبة، تعذر {len(self._failed)} رسالة")
+
+    async def _run_migration(self, bot):
+        try:
+            await self.migrate(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ فشل ترحيل صور القناة: {e}", exc_info=True)
+
+        # بعد الترحيل: تحويل ما يُجدول من مسار العرض (وجبات أُضيفت لاحقًا بمراجع قناة)
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                await self._resolve_queued(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ فشل تحويل صور القناة المجدولة: {e}", exc_info=True)
+
+    def start_migration(self, bot):
+        if self._migration_task is None or self._migration_task.done():
+            self._migration_task = asyncio.create_task(self._run_migration(bot))
+
+    async def close(self):
+        if self._migration_task:
+            self._migration_task.cancel()
+            try:
+                await self._migration_task
+            except asyncio.CancelledError:
+                pass
+            self._migration_task = None
+
+
+media_resolver = MediaResolver()
+
+
+# إعدادات إرسال بطاقات الوجبات
+MEAL_SEND_CONCURRENCY = 4   # عدد طلبات الإرسال الجارية في نفس الوقت لمحادثة واحدة
+MEAL_SEND_CHAT_BURST = 30   # تيليجرام يسمح بدفعات قصيرة في المحادثة الخاصة بمعدل ~رسالة/ثانية،
+MEAL_SEND_CHAT_PERIOD = 30  # وما يتجاوزها يُعالج بـ RetryAfter في _send_meal_card
+MEAL_SEND_CHAT_LIMITERS_MAX = 10000  # عدد المحادثات التي نحتفظ بمحدداتها
+MEAL_SEND_MAX_RETRIES = 3
+TELEGRAM_CAPTION_LIMIT = 1024  # أطول تعليق مسموح على صورة
+MEAL_DISPLAY_MODE = "list"  # "list": رسالة لكل وجبة، "carousel": رسالة واحدة تتنقل بين الوجبات
+
+
+def caption_fits(card):
+    return len(card.text) <= TELEGRAM_CAPTION_LIMIT
+
+
+async def _send_meal_photo(bot, chat_id, card):
+    """الصورة وحدها (بدون تعليق أو أزرار) عندما يكون النص أطول من حد التعليق"""
+    if card.image_file_id.startswith("AgAC"):
+        msg = await bot.send_photo(chat_id=chat_id, photo=card.image_file_id)
+    else:
+        msg = await bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=ADMIN_MEDIA_CHANNEL,
+            message_id=int(card.image_file_id)
+        )
+    return msg.message_id
+
+
+async def _send_meal_card(bot, chat_id, card, reply_markup=None, extra_ids=None):
+    """إرسال بطاقة وجبة وإرجاع معرف الرسالة التي تحمل الأزرار، أو None إذا فشل حتى الإرسال النصي.
+
+    إذا كان النص أطول من حد التعليق تُرسل الصورة أولًا ثم النص برسالة منفصلة،
+    ويُضاف معرف الصورة إلى extra_ids.
+    """
+    reply_markup = reply_markup or card.reply_markup
+    for attempt in range(MEAL_SEND_MAX_RETRIES):
+        try:
+            if card.image_file_id and not caption_fits(card):
+                photo_id = await _send_meal_photo(bot, chat_id, card)
+                if extra_ids is not None:
+                    extra_ids.append(photo_id)
+                msg = await bot.send_message(
+                    chat_id=chat_id,
+                    text=card.text,
+                    reply_markup=reply_markup,
+                    parse_mode="HTML"
+                )
+            elif card.image_file_id and card.image_file_id.startswith("AgAC"):  # file_id مباشر
+                msg = await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=card.image_file_id,
+                    caption=card.text,
+                    reply_markup=reply_markup,
+                    parse_mode="HTML"
+                )
+            elif card.image_file_id:  # message_id رقمي من القناة: نسخ الصورة مع النص والأزرار في طلب واحد
+                msg = await bot.copy_message(
+                    chat_id=chat_id,
+                    from_chat_id=ADMIN_MEDIA_CHANNEL,
+                    message_id=int(card.image_file_id),
+                    caption=card.text,
+                    reply_markup=reply_markup,
+                    parse_mode="HTML"
+                )
+            else:
+                msg = await bot.send_message(chat_id=chat_id, text=card.text, reply_markup=reply_markup)
+            return msg.message_id
+        except RetryAfter as e:
+            logger.warning(f"⏳ تجاوز حد تيليجرام أثناء عرض '{card.name}'، انتظار {e.retry_after} ثانية")
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"❌ فشل في عرض الوجبة '{card.name}': {e}")
+            break
+
+    try:
+        msg = await bot.send_message(chat_id=chat_id, text=card.text, reply_markup=reply_markup)
+        return msg.message_id
+    except Exception as e:
+        logger.error(f"❌ فشل الإرسال النصي للوجبة '{card.name}': {e}")
+        return None
+
+
+# محدد معدل وقفل إرسال مشتركان لكل محادثة، حتى لا يأخذ كل عرض متداخل حصة مستقلة
+_chat_send_slots = OrderedDict()
+
+
+def chat_send_slot(chat_id):
+    """(قفل الإرسال، محدد المعدل) الخاصان بالمحادثة"""
+    slot = _chat_send_slots.get(chat_id)
+    if slot is None:
+        slot = (asyncio.Lock(), RateLimiter(max_calls=MEAL_SEND_CHAT_BURST, period=MEAL_SEND_CHAT_PERIOD))
+        _chat_send_slots[chat_id] = slot
+        if len(_chat_send_slots) > MEAL_SEND_CHAT_LIMITERS_MAX:
+            _chat_send_slots.popitem(last=False)
+    else:
+        _chat_send_slots.move_to_end(chat_id)
+    return slot
 
 
+async def send_meal_cards(bot, chat_id, cards, concurrency=MEAL_SEND_CONCURRENCY):
+    """إرسال بطاقات الوجبات بطلبات متوازية محدودة مع الحفاظ على ترتيبها في المحادثة.
 
+    الطلبات تنطلق بالترتيب (القفل عادل) لكن قد تصل لتيليجرام بترتيب مختلف، لذلك نتحقق
+    من تزايد معرفات الرسائل ونعيد إرسال الجزء المقلوب بالتتابع في الحالة النادرة.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    dispatch_lock, chat_limiter = chat_send_slot(chat_id)
+    extras = [[] for _ in cards]  # صور الوجبات التي أُرسل نصها منفصلًا
+
+    async def send(index, card):
+        async with semaphore:
+            async with dispatch_lock:
+                await chat_limiter.acquire()
+                await telegram_limiter.acquire()
+            return await _send_meal_card(bot, chat_id, card, extra_ids=extras[index])
+
+    message_ids = await asyncio.gather(*(send(index, card) for index, card in enumerate(cards)))
+
+    sent = [(index, message_id) for index, message_id in enumerate(message_ids) if message_id is not None]
+    inverted = next((pos for pos in range(1, len(sent)) if sent[pos][1] < sent[pos - 1][1]), None)
+    if inverted is not None:
+        # أول بطاقة ظهرت بعد البطاقة التي سبقتها في الوصول، ومنها نعيد الإرسال
+        resend_from = next(index for index, message_id in sent if message_id > sent[inverted][1])
+        logger.info(f"🔁 إعادة ترتيب {len(cards) - resend_from} بطاقة وجبة في المحادثة {chat_id}")
+        stale = [message_id for message_id in message_ids[resend_from:] if message_id is not None]
+        stale += [message_id for ids in extras[resend_from:] for message_id in ids]
+        for message_id in stale:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except Exception:
+                pass
+        for index in range(resend_from, len(cards)):
+            extras[index] = []
+            message_ids[index] = await _send_meal_card(bot, chat_id, cards[index], extra_ids=extras[index])
 
+    message_ids = [message_id for message_id in message_ids if message_id is not None]
+    message_cleaner.track(chat_id, message_ids + [message_id for ids in extras for message_id in ids])
+    return message_ids
 
 
+def meal_carousel_markup(card, category_id, index, total):
+    """أزرار البطاقة نفسها مع صف تنقل بين وجبات الفئة"""
+    nav_row = [
+        InlineKeyboardButton("◀️", callback_data=f"meal_page:{category_id}:{(index - 1) % total}"),
+        InlineKeyboardButton(f"{index + 1}/{total}", callback_data=f"meal_page:{category_id}:{index}"),
+        InlineKeyboardButton("▶️", callback_data=f"meal_page:{category_id}:{(index + 1) % total}"),
+    ]
+    return InlineKeyboardMarkup(list(card.reply_markup.inline_keyboard) + [nav_row])
 
 
+async def show_meal_carousel(bot, chat_id, user_data, category_id, cards, index=0):
+    """عرض وجبة واحدة من الفئة في رسالة الكاروسيل، بتعديلها في مكانها متى أمكن.
 
-async def handle_remove_specific_meal(update: Update, context: CallbackContext) -> int:
-    user_id = update.effective_user.id
-    query = update.callback_query
-    await query.answer()
-    
-    try:
-        # استخراج معلومات الوجبة من callback_data
-        _, meal_id_str, _ = query.data.split(":")
-        meal_id = int(meal_id_str)
-        
-        # استرجاع السلة من قاعدة البيانات
-        cart = await get_cart_from_db(user_id) or []
-        
-        if not cart:
-            await query.answer("❌ لا توجد وجبات في سلتك!")
-            return ORDER_MEAL
-        
-        # استرجاع اسم الوجبة من قاعدة البيانات
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT name FROM meals WHERE id = %s", (meal_id,))
-                result = await cursor.fetchone()
-                if not result:
-                    await query.answer("❌ لم يتم العثور على الوجبة!")
-                    return ORDER_MEAL
-                meal_name = result[0]
-        
-        # البحث عن آخر وجبة مطابقة في السلة (من النهاية إلى البداية)
-        removed = False
-        removed_item = None
-        
-        # البحث من النهاية للبداية للعثور على آخر وجبة مطابقة
-        for i in range(len(cart) - 1, -1, -1):
-            item = cart[i]
-            if item.get('name') == meal_name or item.get('meal_id') == meal_id:
-                removed_item = cart.pop(i)
-                removed = True
-                break
-        
-        if not removed:
-            await query.answer("❌ لم يتم العثور على الوجبة في سلتك!")
-            return ORDER_MEAL
-        
-        # حفظ السلة المحدثة
-        await save_cart_to_db(user_id, cart)
-        await asyncio.sleep(0.3)  # تأخير صغير للتأكد من حفظ البيانات
-        
-        # تحديث النسخة المحلية
-        context.user_data["orders"] = cart
-        context.user_data["cart"] = cart
-        
-        # تأكيد الحذف للمستخدم
-        size_text = f" ({removed_item.get('size')})" if removed_item.get('size') != "default" else ""
-        await query.answer(f"✅ تم حذف: {removed_item.get('name')}{size_text}")
-        
-        # إعداد ملخص جديد
-        summary_counter = defaultdict(int)
-        for item in cart:
-            label = f"{item['name']} ({item['size']})" if item['size'] != "default" else item['name']
-            summary_counter[label] += 1
-        
-        summary_lines = [f"{count} × {label}" for label, count in summary_counter.items()]
-        summary_text = "\n".join(summary_lines)
-        total_price = sum(item.get('price', 0) for item in cart)
-        
-        # حذف رسالة الملخص السابقة إن وُجدت
-        old_msg_id = context.user_data.get("summary_msg_id")
-        if old_msg_id:
-            try:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=old_msg_id)
-            except:
-                pass
-        
-        # إرسال رسالة الملخص الجديدة
-        if cart:
-            text = (
-                f"🛒 طلبك بعد الحذف:\n{summary_text}\n\n"
-                f"💰 المجموع: {total_price} ل.س\n"
-                f"عندما تنتهي اختر ✅ تم من الأسفل"
+    تعديل الصورة يحتاج file_id، لذلك الوجبات المخزنة كرسالة في القناة وتغيير نوع الرسالة
+    بين نص وصورة يعودان إلى حذف الرسالة وإرسال بديلة.
+    """
+    card = cards[index]
+    reply_markup = meal_carousel_markup(card, category_id, index, len(cards))
+    # النص الطويل يُرسل منفصلًا عن الصورة، فتكون رسالة الكاروسيل نصية
+    is_photo = bool(card.image_file_id and card.image_file_id.startswith("AgAC")) and caption_fits(card)
+    is_media = bool(card.image_file_id) and caption_fits(card)
+
+    carousel = user_data.get("meal_carousel") or {}
+    message_id = carousel.get("message_id")
+    extra_ids = carousel.get("extra_ids") or []
+
+    # رسالة بصورة منفصلة فوقها لا تُعدّل في مكانها، وإلا بقيت صورة الوجبة السابقة
+    if message_id and extra_ids:
+        edited = False
+    elif message_id and is_photo and carousel.get("media"):
+        try:
+            await bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=message_id,
+                media=InputMediaPhoto(media=card.image_file_id, caption=card.text, parse_mode="HTML"),
+                reply_markup=reply_markup
             )
-        else:
-            text = "✅ تم حذف آخر وجبة. سلتك الآن فارغة."
-        
-        msg = await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=text
-        )
-        context.user_data["summary_msg_id"] = msg.message_id
-        
-        return ORDER_MEAL
-        
-    except Exception as e:
-        logger.error(f"❌ خطأ في handle_remove_specific_meal: {e}", exc_info=True)
-        await query.answer("❌ حدث خطأ أثناء حذف الوجبة")
-        return ORDER_MEAL
-
+            edited = True
+        except BadRequest as e:
+            edited = "not modified" in str(e)
+    elif message_id and not is_media and not carousel.get("media"):
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=card.text,
+                reply_markup=reply_markup
+            )
+            edited = True
+        except BadRequest as e:
+            edited = "not modified" in str(e)
+    else:
+        edited = False
+
+    if not edited:
+        if message_id:
+            message_cleaner.schedule(chat_id, [message_id] + extra_ids)
+        extra_ids = []
+        message_id = await _send_meal_card(bot, chat_id, card, reply_markup=reply_markup, extra_ids=extra_ids)
+        message_cleaner.track(chat_id, extra_ids)
+        # الإرسال النصي الاحتياطي ينتج رسالة نصية حتى لو كانت للوجبة صورة
+        is_media = is_media and message_id is not None
+
+    user_data["meal_carousel"] = {
+        "message_id": message_id,
+        "extra_ids": extra_ids,
+        "media": is_media,
+        "category_id": category_id,
+        "index": index,
+    }
+    return edited
 
 
+async def handle_meal_carousel_page(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
 
+    try:
+        _, category_id_str, index_str = query.data.split(":")
+        category_id = int(category_id_str)
+        cards = await catalog_cache.meal_cards(category_id)
+    except Exception as e:
+        logger.error(f"❌ خطأ في handle_meal_carousel_page: {e}", exc_info=True)
+        await query.answer()
+        return ORDER_MEAL
 
+    # الرد على الضغطة مرة واحدة فقط، بالنص المناسب
+    if not cards:
+        await query.answer("❌ لا توجد وجبات في هذه الفئة.")
+        return ORDER_MEAL
+    await query.answer()
 
+    try:
+        carousel = context.user_data.get("meal_carousel") or {}
+        if carousel.get("message_id") != query.message.message_id:
+            # ضغطة على رسالة كاروسيل أقدم: نعدّلها هي بدل الرسالة المحفوظة
+            context.user_data["meal_carousel"] = {
+                "message_id": query.message.message_id,
+                "media": bool(query.message.photo),
+            }
 
+        media_resolver.queue_cards(category_id, cards)
+        index = int(index_str) % len(cards)
+        await show_meal_carousel(context.bot, update.effective_chat.id, context.user_data, category_id, cards, index)
+    except Exception as e:
+        logger.error(f"❌ خطأ في handle_meal_carousel_page: {e}", exc_info=True)
 
+    return ORDER_MEAL
 
 
 async def show_meals_in_category(update: Update, context: CallbackContext):
@@ -2864,106 +4757,21 @@ async def show_meals_in_category(update: Update, context: CallbackContext):
         return
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT id, name, caption, image_file_id, size_options, price
-                    FROM meals
-                    WHERE category_id = %s
-                """, (category_id,))
-                meals = await cursor.fetchall()
+        cards = await catalog_cache.meal_cards(category_id)
 
-        if not meals:
+        if not cards:
             await update.message.reply_text("❌ لا توجد وجبات في هذه الفئة.")
             return
 
-        meal_messages = []
-        ADMIN_MEDIA_CHANNEL = -1002659459294  # تأكد من تعريفه
-
-        for meal in meals:
-            meal_id, name, caption, image_file_id, size_json, price = meal
-            try:
-                sizes = json.loads(size_json or "[]")
-            except:
-                sizes = []
-
-            buttons = []
-
-            if sizes:
-                # تعديل: وضع جميع أزرار القياسات في صف واحد أفقي مع تبسيط النص
-                size_buttons = []
-                for opt in sizes:
-                    # تبسيط النص ليكون "القياس السعر" فقط بدون رموز
-                    size_buttons.append(
-                        InlineKeyboardButton(
-                            f"{opt['name']} {opt['price']}",
-                            callback_data=f"add_meal_with_size:{meal_id}:{opt['name']}"
-                        )
-                    )
-                # إضافة جميع أزرار القياسات في صف واحد
-                buttons.append(size_buttons)
-            else:
-                # في حال لا يوجد قياسات، أضف زر إضافة للسلة
-                buttons.append([
-                    InlineKeyboardButton(f"➕ أضف للسلة ({price})", callback_data=f"add_meal_with_size:{meal_id}:default")
-                ])
-
-            # ✅ زر حذف اللمسة الأخيرة في صف مستقل
-            buttons.append([
-                InlineKeyboardButton("❌ حذف اللمسة الأخيرة", callback_data=f"remove_specific_meal:{meal_id}:last")
-            ])
-
-            # إزالة زر "تم" من أزرار InlineKeyboard كما طلب المستخدم
-
-            reply_markup = InlineKeyboardMarkup(buttons)
-
-            # 🧠 بناء الكابشن
-            caption_text = f"🍽️ {name}\n\n{caption}" if caption else f"🍽️ {name}"
-            if price:
-                caption_text += f"\n💰 السعر: {price} ل.س"
+        # صور القناة القديمة تُرسل كما هي بـ copy_message، وتحويلها إلى file_id يجري في الخلفية
+        media_resolver.queue_cards(category_id, cards)
 
-            try:
-                if image_file_id:
-                    if image_file_id.startswith("AgAC"):  # file_id مباشر
-                        photo_msg = await context.bot.send_photo(
-                            chat_id=update.effective_chat.id,
-                            photo=image_file_id,
-                            caption=caption_text,
-                            reply_markup=reply_markup,
-                            parse_mode="HTML"
-                        )
-                        meal_messages.append(photo_msg.message_id)
-                    else:  # message_id رقمي من القناة
-                        copied = await context.bot.copy_message(
-                            chat_id=update.effective_chat.id,
-                            from_chat_id=ADMIN_MEDIA_CHANNEL,
-                            message_id=int(image_file_id)
-                        )
-                        meal_messages.append(copied.message_id)
-
-                        caption_msg = await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=caption_text,
-                            reply_markup=reply_markup,
-                            parse_mode="HTML"
-                        )
-                        meal_messages.append(caption_msg.message_id)
-                else:
-                    caption_msg = await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=caption_text,
-                        reply_markup=reply_markup
-                    )
-                    meal_messages.append(caption_msg.message_id)
-            except Exception as e:
-                logger.error(f"❌ فشل في عرض الوجبة '{name}': {e}")
-                msg = await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=caption_text,
-                    reply_markup=reply_markup
-                )
-                meal_messages.append(msg.message_id)
+        if MEAL_DISPLAY_MODE == "carousel":
+            await show_meal_carousel(context.bot, update.effective_chat.id, context.user_data, category_id, cards)
+            return
 
+        # معرفات الرسائل تُحفظ بترتيب العرض لحذفها لاحقًا عند تغيير الفئة
+        meal_messages = await send_meal_cards(context.bot, update.effective_chat.id, cards)
         context.user_data["current_meal_messages"] = meal_messages
     except Exception as e:
         logger.error(f"❌ خطأ في show_meals_in_category: {e}")
@@ -2973,24 +4781,17 @@ async def show_meals_in_category(update: Update, context: CallbackContext):
 
 
 async def handle_done_adding_meals(update: Update, context: CallbackContext) -> int:
-    orders = context.user_data.get("orders", [])
-    if not isinstance(orders, list) or not orders:
+    cart = Cart.from_data(context.user_data.get("orders"))
+    if not cart:
         await update.message.reply_text("❌ لم تقم بإضافة أي وجبة بعد.")
         return ORDER_MEAL
 
-    total_price = sum(item.get("price", 0) for item in orders)
+    total_price = cart.total
     context.user_data["temporary_total_price"] = total_price
+    cart_summaries.forget(update.effective_chat.id, context.user_data)
 
     # تنظيم الطلبات لتلخيصها
-    summary_counter = defaultdict(int)
-    for item in orders:
-        name = item.get("name", "غير معروف")
-        size = item.get("size", "default")
-        label = f"{name} ({size})" if size != "default" else name
-        summary_counter[label] += 1
-
-    summary_lines = [f"{count} × {label}" for label, count in summary_counter.items()]
-    summary_text = "\n".join(summary_lines)
+    summary_text = cart.summary_text()
 
     reply_markup = ReplyKeyboardMarkup(
         [
@@ -3023,48 +4824,6 @@ async def handle_done_adding_meals(update: Update, context: CallbackContext) ->
 
 
 
-async def fixed_orders_from_legacy_dict(orders_dict: dict) -> list:
-    fixed_orders = []
-
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                for key, count in orders_dict.items():
-                    try:
-                        name, size = key.rsplit(" (", 1)
-                        size = size.rstrip(")")
-                    except:
-                        name, size = key, "default"
-
-                    await cursor.execute("SELECT price, size_options FROM meals WHERE name = %s", (name.strip(),))
-                    result = await cursor.fetchone()
-
-                    price = 0
-                    if result:
-                        base_price, size_options_json = result
-                        if size != "default" and size_options_json:
-                            try:
-                                size_options = json.loads(size_options_json)
-                                for opt in size_options:
-                                    if opt["name"] == size:
-                                        price = opt["price"]
-                                        break
-                            except:
-                                price = base_price or 0
-                        else:
-                            price = base_price or 0
-
-                    for _ in range(count):
-                        fixed_orders.append({
-                            "name": name.strip(),
-                            "size": size.strip(),
-                            "price": price
-                        })
-
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء تحويل الطلبات القديمة: {e}")
-
-    return fixed_orders
 
 
 
@@ -3119,6 +4878,9 @@ async def handle_order_notes(update: Update, context: CallbackContext) -> int:
 async def emergency_order_recovery(user_id, context):
     """استرجاع بيانات الطلب في حالات الطوارئ"""
     try:
+        # التأكد من وصول آخر نسخة من السلة إلى القاعدة قبل القراءة المباشرة
+        await cart_cache.flush()
+
         # محاولة استرجاع البيانات من قاعدة البيانات
         async with get_db_connection() as conn:
             async with conn.cursor() as cursor:
@@ -3154,27 +4916,22 @@ async def ask_order_location(update: Update, context: CallbackContext) -> int:
     choice = update.message.text
     user_id = update.effective_user.id
 
-    orders = context.user_data.get('orders', [])
+    orders = context.user_data.get('orders')
     if not orders:
-        orders = await get_cart_from_db(user_id)
+        orders = (await get_cart_from_db(user_id)).to_data()
         context.user_data['orders'] = orders
 
     selected_restaurant = context.user_data.get('selected_restaurant')
-    if not selected_restaurant:
-        try:
-            state = await get_conversation_state(user_id)
-            selected_restaurant = state.get('selected_restaurant')
-            if selected_restaurant:
-                context.user_data['selected_restaurant'] = selected_restaurant
-        except Exception as e:
-            logger.error(f"❌ خطأ في استرجاع اسم المطعم: {e}")
 
-    if isinstance(orders, dict):
-        orders = await fixed_orders_from_legacy_dict(orders)
-        context.user_data["orders"] = orders
+    if isinstance(orders, dict) and "items" not in orders:
+        # الشكل القديم (اسم -> عدد) لا يحمل أسعارًا ولا meal_id، والسلة المخزنة هي المرجع
+        orders = await get_cart_from_db(user_id)
+
+    cart = Cart.from_data(orders)
+    context.user_data["orders"] = cart.to_data()
 
     if choice == "نفس الموقع يلي عطيتكن ياه بالاول 🌝":
-        if not orders:
+        if not cart:
             logger.error(f"❌ لا توجد طلبات للمستخدم {user_id}")
             await update.message.reply_text("❌ حدث خطأ في استرجاع تفاصيل الطلب: لا توجد وجبات في السلة.")
             return MAIN_MENU
@@ -3184,12 +4941,12 @@ async def ask_order_location(update: Update, context: CallbackContext) -> int:
             await update.message.reply_text("❌ حدث خطأ في استرجاع تفاصيل الطلب: لم يتم تحديد المطعم.")
             return MAIN_MENU
 
-        total_price = sum(item.get("price", 0) for item in orders)
+        total_price = cart.total
         context.user_data['temporary_total_price'] = total_price
 
         summary_lines = [
-            f"- {item['name']} ({item['size']}) - {item['price']} ل.س"
-            for item in orders
+            f"- {line['qty']} × {Cart.label(line)} - {line['price']} ل.س"
+            for line in cart.lines.values()
         ]
         summary_text = "\n".join(summary_lines)
 
@@ -3333,7 +5090,7 @@ async def ask_new_detailed_location(update: Update, context: CallbackContext) ->
 async def show_order_summary(update: Update, context: CallbackContext, is_new_location=False) -> int:
     orders = context.user_data.get("orders", [])
 
-    if isinstance(orders, dict):
+    if isinstance(orders, dict) and "items" not in orders:
         # تحويل الطلبات القديمة من dict إلى list of dicts
         converted = []
         for name_size, count in orders.items():
@@ -3347,22 +5104,19 @@ async def show_order_summary(update: Update, context: CallbackContext, is_new_lo
             for _ in range(count):
                 converted.append({"name": name.strip(), "size": size.strip(), "price": price})
         orders = converted
-        context.user_data["orders"] = orders
 
-    if not orders:
+    cart = Cart.from_data(orders)
+    context.user_data["orders"] = cart.to_data()
+
+    if not cart:
         await update.message.reply_text("❌ لا توجد وجبات في سلتك حالياً.")
         return ORDER_MEAL
 
-    total_price = sum(item['price'] for item in orders)
+    total_price = cart.total
     context.user_data['temporary_total_price'] = total_price
 
     # إعداد ملخص الطلب
-    summary_counter = defaultdict(int)
-    for item in orders:
-        label = f"{item['name']} ({item['size']})" if item['size'] != "default" else item['name']
-        summary_counter[label] += 1
-    summary_lines = [f"{count} × {label}" for label, count in summary_counter.items()]
-    summary_text = "\n".join(summary_lines)
+    summary_text = cart.summary_text()
 
     # إعداد وصف الموقع
     if is_new_location:
@@ -3400,7 +5154,8 @@ async def show_order_summary(update: Update, context: CallbackContext, is_new_lo
 
 
 async def handle_confirm_final_order(update: Update, context: CallbackContext) -> int:
-    return await process_confirm_final_order(update, context)
+    async with user_locks.hold(update.effective_user.id, "confirm_final_order"):
+        return await process_confirm_final_order(update, context)
 
 async def process_confirm_final_order(update, context):
     choice = update.message.text
@@ -3435,142 +5190,83 @@ async def process_confirm_final_order(update, context):
     context.user_data["is_order_processing"] = True
 
     if choice == "يلا عالسريع 🔥":
-        user_state = await get_conversation_state(user_id)
-        cart = await get_cart_from_db(user_id) or []
+        cart = await get_cart_from_db(user_id)
 
         if not cart:
             await update.message.reply_text("❌ لا توجد وجبات في سلتك حالياً.")
             context.user_data.pop("is_order_processing", None)
             return MAIN_MENU
 
-        order_id = str(uuid.uuid4())
-        logger.info(f"🔍 user_id: {user_id}, context.user_data: {context.user_data}")
-
-        # جلب الاسم ورقم الهاتف
-        name = phone = None
-        try:
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT name, phone FROM user_data WHERE user_id = %s", (user_id,))
-                    result = await cursor.fetchone()
-                    if result:
-                        name, phone = result
-        except Exception as e:
-            logger.error(f"❌ خطأ أثناء جلب الاسم من قاعدة البيانات: {e}")
-
-        name = name or user_state.get("name") or context.user_data.get("name") or "غير متوفر"
-        phone = phone or user_state.get("phone") or context.user_data.get("phone") or "غير متوفر"
-
-        # جلب الموقع من قاعدة البيانات
-        db_location_text = None
-        db_coords = None
-        try:
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT location_text, latitude, longitude FROM user_data WHERE user_id = %s", (user_id,))
-                    result = await cursor.fetchone()
-                    if result:
-                        db_location_text, lat, lon = result
-                        if lat and lon:
-                            db_coords = {"latitude": lat, "longitude": lon}
-        except Exception as e:
-            logger.error(f"❌ خطأ أثناء جلب الموقع من قاعدة البيانات: {e}")
-
-        db_area_name = db_detailed_location = None
-        if db_location_text:
-            if " - " in db_location_text:
-                db_area_name, db_detailed_location = db_location_text.split(" - ", 1)
-            else:
-                db_detailed_location = db_location_text
-
-        area_name = context.user_data.get("temporary_area_name") or user_state.get("temporary_area_name") or user_state.get("area_name") or db_area_name
-        detailed_location = context.user_data.get("temporary_detailed_location") or user_state.get("temporary_detailed_location") or user_state.get("detailed_location") or db_detailed_location
-        location_coords = context.user_data.get("temporary_location_coords") or user_state.get("temporary_location_coords") or user_state.get("location_coords") or db_coords
-
-        location_parts = []
-        if area_name:
-            location_parts.append(area_name.strip())
-        if detailed_location:
-            location_parts.append(detailed_location.strip())
-        location_text = " - ".join(location_parts) if location_parts else "الموقع غير محدد"
-
-        logger.info(f"📍 Final location: {location_text}")
-        logger.info(f"👤 Final name: {name} | 📱 {phone}")
-
         selected_restaurant = context.user_data.get("selected_restaurant")
         if not selected_restaurant:
             await update.message.reply_text("❌ لم يتم تحديد المطعم.")
             context.user_data.pop("is_order_processing", None)
             return MAIN_MENU
 
-        try:
-            async with get_db_connection() as conn:
-                async with conn.cursor() as cursor:
-                    await cursor.execute("""
-                        SELECT r.id, r.channel, c.id
-                        FROM restaurants r
-                        JOIN cities c ON r.city_id = c.id
-                        WHERE r.name = %s
-                    """, (selected_restaurant,))
-                    result = await cursor.fetchone()
-                    if not result:
-                        await update.message.reply_text("❌ لم يتم العثور على المطعم.")
-                        context.user_data.pop("is_order_processing", None)
-                        return MAIN_MENU
-
-                    restaurant_id, restaurant_channel, city_id = result
-
-                    await asyncio.sleep(0.2)
-                    order_number = await get_next_order_number(restaurant_id)
+        order_id = str(uuid.uuid4())
 
-                    await cursor.execute("""
-                        INSERT INTO user_orders (order_id, user_id, restaurant_id, city_id, order_number)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (order_id, user_id, restaurant_id, city_id, order_number))
+        total_price = cart.total
 
-                    logger.info(f"📦 بيانات الإدخال: order_id={order_id}, user_id={user_id}, restaurant_id={restaurant_id}, city_id={city_id}")
+        def build_dispatch(placed):
+            """رسائل قناة المطعم، تُبنى داخل معاملة الطلب بعد حجز رقمه"""
+            user_state = placed["user_state"]
+            name = placed["name"] or user_state.get("name") or context.user_data.get("name") or "غير متوفر"
+            phone = placed["phone"] or user_state.get("phone") or context.user_data.get("phone") or "غير متوفر"
 
-                await conn.commit()
-                logger.info("✅ تم تنفيذ commit بنجاح.")
-                async with conn.cursor() as cursor:
-                    await cursor.execute("SELECT * FROM user_orders WHERE order_id = %s", (order_id,))
-                    row = await cursor.fetchone()
-                    logger.info(f"🔍 تحقق من الإدخال: {row}")
+            db_area_name = db_detailed_location = None
+            if placed["location_text"]:
+                if " - " in placed["location_text"]:
+                    db_area_name, db_detailed_location = placed["location_text"].split(" - ", 1)
+                else:
+                    db_detailed_location = placed["location_text"]
 
+            area_name = context.user_data.get("temporary_area_name") or user_state.get("temporary_area_name") or user_state.get("area_name") or db_area_name
+            detailed_location = context.user_data.get("temporary_detailed_location") or user_state.get("temporary_detailed_location") or user_state.get("detailed_location") or db_detailed_location
+            location_coords = context.user_data.get("temporary_location_coords") or user_state.get("temporary_location_coords") or user_state.get("location_coords") or placed["coords"]
 
-            # تجهيز الطلب
-            summary_counter = defaultdict(int)
-            for item in cart:
-                key = (item["name"], item["size"], item["price"])
-                summary_counter[key] += 1
+            location_parts = []
+            if area_name:
+                location_parts.append(area_name.strip())
+            if detailed_location:
+                location_parts.append(detailed_location.strip())
+            location_text = " - ".join(location_parts) if location_parts else "الموقع غير محدد"
 
-            items_for_message = []
-            for (name_, size, price), quantity in summary_counter.items():
-                label = f"{name_} ({size})" if size != "default" else name_
-                items_for_message.append({"name": label, "quantity": quantity, "price": price})
+            logger.info(f"📍 Final location: {location_text}")
+            logger.info(f"👤 Final name: {name} | 📱 {phone}")
 
-            total_price = sum(item["price"] * item["quantity"] for item in items_for_message)
             notes = user_state.get("order_notes") or context.user_data.get("order_notes", "لا توجد ملاحظات.")
-
             order_text = create_new_order_message(
                 order_id=order_id,
-                order_number=order_number,
+                order_number=placed["order_number"],
                 user_name=name,
                 phone=phone,
                 address=location_text,
-                items=items_for_message,
+                items=cart.items_for_message(),
                 total_price=total_price,
                 notes=notes
             )
 
+            dispatch = []
             if location_coords:
-                await context.bot.send_location(
-                    chat_id=restaurant_channel,
-                    latitude=location_coords["latitude"],
-                    longitude=location_coords["longitude"]
-                )
+                dispatch.append(("location", {
+                    "latitude": location_coords["latitude"],
+                    "longitude": location_coords["longitude"]
+                }))
+            dispatch.append(("message", {"text": order_text, "parse_mode": "Markdown", "cashier_actions": True}))
+            return dispatch
+
+        try:
+            # المستخدم، المطعم، رقم الطلب، الإدخال، تفريغ السلة ورسائل القناة في معاملة واحدة؛
+            # الإرسال الفعلي للقناة يتم في الخلفية عبر order_outbox
+            placed = await place_order(user_id, selected_restaurant, order_id, cart, build_dispatch)
+            if not placed:
+                await update.message.reply_text("❌ لم يتم العثور على المطعم.")
+                context.user_data.pop("is_order_processing", None)
+                return MAIN_MENU
 
-            await send_message_with_retry(context.bot, restaurant_channel, text=order_text, parse_mode="Markdown")
+            order_number = placed["order_number"]
+            restaurant_channel = placed["restaurant_channel"]
+            logger.info(f"📦 تم تسجيل الطلب: order_id={order_id}, user_id={user_id}, restaurant_id={placed['restaurant_id']}, number={order_number}")
 
             context.user_data["order_data"] = {
                 "order_id": order_id,
@@ -3581,9 +5277,8 @@ async def process_confirm_final_order(update, context):
                 "total_price": total_price
             }
 
-            # 🧼 تحديث توقيت الطلب الأخير
+            # 🧼 تحديث توقيت الطلب الأخير (السلة حُذفت ضمن معاملة الطلب)
             context.user_data["last_order_timestamp"] = now
-            await delete_cart_from_db(user_id)
 
             reply_markup = ReplyKeyboardMarkup([
                 ["إلغاء ❌ بدي عدل"],
@@ -3626,39 +5321,199 @@ async def process_confirm_final_order(update, context):
         return MAIN_MENU
         
 
-    else:
-        await update.message.reply_text("❌ يرجى اختيار أحد الخيارات المتاحة.")
-        context.user_data.pop("is_order_processing", None)
-        return CONFIRM_FINAL_ORDER
+    else:
+        await update.message.reply_text("❌ يرجى اختيار أحد الخيارات المتاحة.")
+        context.user_data.pop("is_order_processing", None)
+        return CONFIRM_FINAL_ORDER
+
+
+async def get_last_order(user_id):
+    try:
+        async with get_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    SELECT o.order_id, o.order_number, o.timestamp, o.restaurant_id, r.name
+                    FROM user_orders o
+                    JOIN restaurants r ON o.restaurant_id = r.id
+                    WHERE o.user_id = %s
+                    ORDER BY o.timestamp DESC
+                    LIMIT 1
+                """, (user_id,))
+                row = await cursor.fetchone()
+                if row:
+                    return {
+                        "order_id": row[0],
+                        "order_number": row[1],
+                        "timestamp": row[2],
+                        "restaurant_id": row[3],
+                        "restaurant_name": row[4]
+                    }
+
+    except Exception as e:
+        logger.error(f"❌ خطأ في get_last_order: {e}")
+    return None
+
+
+
+
+async def notify_customer_order_status(bot, user_id, order_id, status, order_number=None,
+                                       delivery_time=None, delivery_name=None, delivery_phone=None):
+    """إشعار الزبون بحالة طلبه، مشترك بين أزرار الكاشير ورسائل القناة النصية"""
+    if status == "rejected":
+        message_text = (
+            "❌ *منعتذر، ما انقبل طلبك.*\n\n"
+            "السبب: ممكن معلوماتك ما مكتملة أو منطقتك بعيدة عن المطعم كتير.\n"
+            "فيك تعدل معلوماتك أو حاول من مطعم تاني.\n\n"
+            "🔥 إذا حسيت في شي غلط، اختار *التواصل مع الدعم 🎧* من القائمة وبيعالجولك وضعك عالسريع.\n\n"
+            f"📌 *معرف الطلب:* `{order_id}`"
+        )
+        await bot.send_sticker(
+            chat_id=user_id,
+            sticker="CAACAgIAAxkBAAEBxxFoM2f1BDjNy-9ivZQXi9S_YqTLaAACSDsAAhNy-UgXWLa5FO4pTzYE"
+        )
+        reply_markup = ReplyKeyboardMarkup([
+            ["اطلب عالسريع 🔥"],
+            ["لا بدي عدل 😐", "التواصل مع الدعم 🎧"],
+            ["من نحن 🏢", "أسئلة متكررة ❓"]
+        ], resize_keyboard=True)
+
+        await bot.send_message(
+            chat_id=user_id,
+            text=message_text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        )
+
+    elif status == "accepted":
+        message_text = (
+            "بسلم عليك المطعم 😄\n"
+            "وبقلك بلشنا بطلبك عالسريع 🔥\n\n"
+            f"🔢 رقم طلبك: {order_number}\n"
+            f"⏱️ وقت التوصيل المتوقع: {delivery_time or 'غير محدد'} دقيقة\n\n"
+            "رح نبعتلك مين بدو يوصلك ياه لعندك 🚴‍♂️ بس يجهز 🔥\n\n"
+            f"📌 *معرف الطلب:* `{order_id}`"
+        )
+
+        reply_markup = ReplyKeyboardMarkup([
+            ["وصل طلبي شكرا لكم 🙏"],
+            ["إلغاء الطلب بسبب مشكلة 🫢"]
+        ], resize_keyboard=True)
+
+        await bot.send_message(
+            chat_id=user_id,
+            text=message_text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup
+        )
+        await asyncio.sleep(0.2)  # ⏱️ تأخير بسيط لتحسين ترتيب العرض
+
+        await bot.send_sticker(
+            chat_id=user_id,
+            sticker="CAACAgIAAxkBAAEBxwtoM2b-lusvTTS2gHaC6p567Ri8QAAC6TkAAquXoElIPA20liWcHzYE"
+        )
+
+    elif status == "out_for_delivery":
+        if delivery_name or delivery_phone:
+            message_text = (
+                "🚚 *طلبك جاي عالسريع 🔥*\n\n"
+                f"مع *{delivery_name or 'غير معروف'}*\n"
+                f"وهي رقمو 📞 `{delivery_phone or 'لا يوجد رقم'}`\n\n"
+                "هلا طلع من المطعم وجاي لعندك خليك بمكانك جاهز لتلفونو 🤙\n"
+                "عطيناك رقمو اذا حبيت تسأل عن طلبك لسبب ضروري.\n"
+                "حاول ماتحكيه وهو عم يسوق ممكن تعرضو للخطر 🫣\n\n"
+                f"📌 *معرف الطلب:* `{order_id}`"
+            )
+        else:
+            message_text = (
+                "🚚 *طلبك جاي عالسريع 🔥*\n\n"
+                "هلا طلع من المطعم وجاي لعندك خليك بمكانك جاهز 🤙\n\n"
+                f"📌 *معرف الطلب:* `{order_id}`"
+            )
+        await bot.send_sticker(
+            chat_id=user_id,
+            sticker="CAACAgIAAxkBAAEBxw5oM2c2g216QRpeJjVncTYMihrQswACdhEAAsMAASlJLbkjGWa6Dog2BA"
+        )
+        await bot.send_message(
+            chat_id=user_id,
+            text=message_text,
+            parse_mode="Markdown"
+        )
+
+
+# أزرار الكاشير على رسالة الطلب: callback_data بالشكل ca:<إجراء>:<order_id> (أقل من 64 بايت)
+CASHIER_ACTIONS = {"a": "accepted", "r": "rejected", "d": "out_for_delivery"}
+CASHIER_ETA_CHOICES = (20, 30, 45, 60)  # دقائق، زر قبول لكل منها
+
+
+def cashier_order_keyboard(order_id, status="pending"):
+    """أزرار الإجراءات المتاحة للكاشير حسب حالة الطلب، أو None إذا لم يبقَ إجراء"""
+    if status == "pending":
+        return InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton(f"✅ {minutes}د", callback_data=f"ca:a{minutes}:{order_id}")
+                for minutes in CASHIER_ETA_CHOICES
+            ],
+            [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"ca:r:{order_id}")],
+        ])
+    if status == "accepted":
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("🚚 جاهز للتوصيل", callback_data=f"ca:d:{order_id}")]
+        ])
+    return None
+
 
+async def handle_cashier_action(update: Update, context: CallbackContext) -> None:
+    """ضغط الكاشير على زر في رسالة الطلب: انتقال الحالة وإشعار الزبون دون تحليل أي نص"""
+    query = update.callback_query
+    message = query.message
+    # الأزرار موجودة فقط على رسائل الطلبات في قنوات المطاعم؛ أي مصدر آخر يُتجاهل بصمت
+    if not message or message.chat.type != "channel" or not query.from_user:
+        return
 
-async def get_last_order(user_id):
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    SELECT o.order_id, o.order_number, o.timestamp, o.restaurant_id, r.name
-                    FROM user_orders o
-                    JOIN restaurants r ON o.restaurant_id = r.id
-                    WHERE o.user_id = %s
-                    ORDER BY o.timestamp DESC
-                    LIMIT 1
-                """, (user_id,))
-                row = await cursor.fetchone()
-                if row:
-                    return {
-                        "order_id": row[0],
-                        "order_number": row[1],
-                        "timestamp": row[2],
-                        "restaurant_id": row[3],
-                        "restaurant_name": row[4]
-                    }
+        _, action, order_id = query.data.split(":", 2)
+    except ValueError:
+        await query.answer()
+        return
 
+    status = CASHIER_ACTIONS.get(action[:1])
+    if not status:
+        await query.answer()
+        return
+    eta = int(action[1:]) if action[1:].isdigit() else None
+
+    # الضاغط يجب أن يكون من مشرفي القناة (الكاشير)، وليس مجرد مشترك
+    try:
+        member = await context.bot.get_chat_member(message.chat.id, query.from_user.id)
     except Exception as e:
-        logger.error(f"❌ خطأ في get_last_order: {e}")
-    return None
+        logger.warning(f"⚠️ تعذر التحقق من صلاحية {query.from_user.id} في القناة {message.chat.id}: {e}")
+        await query.answer()
+        return
+    if member.status not in ("administrator", "creator"):
+        await query.answer("🚫 هذا الإجراء للكاشير فقط.")
+        return
+
+    transition = await transition_order(order_id, status, "cashier", {
+        "by": query.from_user.id,
+        "eta": eta,
+    }, chat=message.chat)
+    if not transition:
+        await query.answer("⚠️ تم التعامل مع هذا الطلب مسبقًا.")
+        return
 
+    await query.answer("✅ تم")
+    try:
+        await query.edit_message_reply_markup(reply_markup=cashier_order_keyboard(order_id, status))
+    except Exception as e:
+        logger.warning(f"⚠️ تعذر تحديث أزرار الطلب {order_id}: {e}")
 
+    try:
+        await notify_customer_order_status(
+            context.bot, transition["user_id"], order_id, status,
+            order_number=transition["order_number"], delivery_time=eta
+        )
+    except Exception as e:
+        logger.error(f"❌ فشل إشعار الزبون بحالة الطلب {order_id}: {e}")
 
 
 async def handle_cashier_interaction(update: Update, context: CallbackContext) -> None:
@@ -3673,8 +5528,9 @@ async def handle_cashier_interaction(update: Update, context: CallbackContext) -
     text = channel_post.text
     logger.info(f"📩 استلمنا رسالة جديدة من القناة: {text}")
 
-    # ✅ استخراج معرف الطلب باستخدام الدالة الموحدة
-    order_id = extract_order_id(text)
+    # ✅ كل الحقول (المعرف، الرقم، الحالة، الوقت، الدليفري) من مرور واحد على النص
+    post = parse_cashier_post(text)
+    order_id = post.order_id
     if not order_id:
         logger.warning("⚠️ لم يتم العثور على معرف الطلب في الرسالة!")
         return
@@ -3682,105 +5538,63 @@ async def handle_cashier_interaction(update: Update, context: CallbackContext) -
     logger.info(f"🔍 البحث عن الطلب ID: {order_id}")
 
     try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT user_id FROM user_orders WHERE order_id = %s", (order_id,))
-                user_result = await cursor.fetchone()
-
-        if not user_result:
-            logger.warning(f"⚠️ لم يتم العثور على مستخدم لهذا الطلب: {order_id}")
-            return
+        # النص يُحلَّل مرة واحدة هنا، وبعدها الحالة مخزنة في user_orders و order_events
+        new_status = post.status
+        transition = None
+        if new_status:
+            details = {"message_id": channel_post.message_id}
+            transition = await transition_order(order_id, new_status, "cashier", details, chat=channel_post.chat)
+            if not transition and new_status == "out_for_delivery":
+                # الكاشير أعلن الجاهزية دون رسالة قبول: نمر بحالة accepted أولًا
+                if await transition_order(order_id, "accepted", "cashier", details, chat=channel_post.chat):
+                    transition = await transition_order(order_id, new_status, "cashier", details, chat=channel_post.chat)
+
+        if transition:
+            user_id = transition["user_id"]
+        else:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("""
+                        SELECT o.user_id, o.status, r.channel
+                        FROM user_orders o
+                        JOIN restaurants r ON r.id = o.restaurant_id
+                        WHERE o.order_id = %s
+                    """, (order_id,))
+                    user_result = await cursor.fetchone()
+
+            if not user_result:
+                logger.warning(f"⚠️ لم يتم العثور على مستخدم لهذا الطلب: {order_id}")
+                return
+            if not channel_matches(user_result[2], channel_post.chat):
+                logger.warning(f"🚫 تجاهل تحديث الطلب {order_id} من قناة ليست قناة مطعمه: {channel_post.chat.id}")
+                return
+            if new_status and user_result[1] != new_status:
+                # انتقال غير مسموح (مثل تحديث لطلب ملغى أو مُسلّم): لا نزعج الزبون به
+                logger.warning(f"⚠️ لم يُطبق تحديث الكاشير على الطلب {order_id}: {user_result[1]} -> {new_status}")
+                return
+            # نفس الحالة مكررة (مثل تصحيح وقت التوصيل) أو تحديث عام: نبلغ الزبون كما في السابق
+            user_id = user_result[0]
 
-        user_id = user_result[0]
         logger.info(f"📩 سيتم إرسال رسالة إلى المستخدم: {user_id}")
 
         # ✅ حالة: رفض الطلب
-        if "تم رفض الطلب" in text:
-            message_text = (
-                "❌ *منعتذر، ما انقبل طلبك.*\n\n"
-                "السبب: ممكن معلوماتك ما مكتملة أو منطقتك بعيدة عن المطعم كتير.\n"
-                "فيك تعدل معلوماتك أو حاول من مطعم تاني.\n\n"
-                "🔥 إذا حسيت في شي غلط، اختار *التواصل مع الدعم 🎧* من القائمة وبيعالجولك وضعك عالسريع.\n\n"
-                f"📌 *معرف الطلب:* `{order_id}`"
-            )
-            await context.bot.send_sticker(
-                chat_id=user_id,
-                sticker="CAACAgIAAxkBAAEBxxFoM2f1BDjNy-9ivZQXi9S_YqTLaAACSDsAAhNy-UgXWLa5FO4pTzYE"
-            )
-            reply_markup = ReplyKeyboardMarkup([
-                ["اطلب عالسريع 🔥"],
-                ["لا بدي عدل 😐", "التواصل مع الدعم 🎧"],
-                ["من نحن 🏢", "أسئلة متكررة ❓"]
-            ], resize_keyboard=True)
-
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message_text,
-                parse_mode="Markdown",
-                reply_markup=reply_markup
-            )
+        if new_status == "rejected":
+            await notify_customer_order_status(context.bot, user_id, order_id, "rejected")
 
         # ✅ حالة: قبول الطلب أو جاري تحضيره
-        elif "تم قبول الطلب" in text or "جاري تحضير الطلب" in text:
-            # استخراج رقم الطلب ووقت التوصيل من النص باستخدام الدالة الموحدة
-            order_number = extract_order_number(text)
-            match_time = re.search(r"⏱️ وقت التوصيل المتوقع:\s*(\d+)\s*دقيقة", text)
-        
-            delivery_time = match_time.group(1) if match_time else "غير محدد"
-        
-            message_text = (
-                "بسلم عليك المطعم 😄\n"
-                "وبقلك بلشنا بطلبك عالسريع 🔥\n\n"
-                f"🔢 رقم طلبك: {order_number}\n"
-                f"⏱️ وقت التوصيل المتوقع: {delivery_time} دقيقة\n\n"
-                "رح نبعتلك مين بدو يوصلك ياه لعندك 🚴‍♂️ بس يجهز 🔥\n\n"
-                f"📌 *معرف الطلب:* `{order_id}`"
-            )
-            
-            reply_markup = ReplyKeyboardMarkup([
-                ["وصل طلبي شكرا لكم 🙏"],
-                ["إلغاء الطلب بسبب مشكلة 🫢"]
-            ], resize_keyboard=True)
-
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message_text,
-                parse_mode="Markdown",
-                reply_markup=reply_markup
-            )
-            await asyncio.sleep(0.2)  # ⏱️ تأخير بسيط لتحسين ترتيب العرض
-
-            await context.bot.send_sticker(
-                chat_id=user_id,
-                sticker="CAACAgIAAxkBAAEBxwtoM2b-lusvTTS2gHaC6p567Ri8QAAC6TkAAquXoElIPA20liWcHzYE"
+        elif new_status == "accepted":
+            await notify_customer_order_status(
+                context.bot, user_id, order_id, "accepted",
+                order_number=post.order_number,
+                delivery_time=post.eta
             )
 
         # ✅ حالة: الطلب جاهز للتوصيل
-        elif "الطلب أصبح جاهزًا للتوصيل" in text:
-            # 🔍 استخراج اسم ورقم الدليفري
-            match_name = re.search(r"الدليفري:\s*(.*?)\s*\(", text)
-            match_phone = re.search(r"\((\d+)\)", text)
-        
-            delivery_name = match_name.group(1) if match_name else "غير معروف"
-            delivery_phone = match_phone.group(1) if match_phone else "لا يوجد رقم"
-        
-            message_text = (
-                "🚚 *طلبك جاي عالسريع 🔥*\n\n"
-                f"مع *{delivery_name}*\n"
-                f"وهي رقمو 📞 `{delivery_phone}`\n\n"
-                "هلا طلع من المطعم وجاي لعندك خليك بمكانك جاهز لتلفونو 🤙\n"
-                "عطيناك رقمو اذا حبيت تسأل عن طلبك لسبب ضروري.\n"
-                "حاول ماتحكيه وهو عم يسوق ممكن تعرضو للخطر 🫣\n\n"
-                f"📌 *معرف الطلب:* `{order_id}`"
-            )
-            await context.bot.send_sticker(
-                chat_id=user_id,
-                sticker="CAACAgIAAxkBAAEBxw5oM2c2g216QRpeJjVncTYMihrQswACdhEAAsMAASlJLbkjGWa6Dog2BA"
-            )
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message_text,
-                parse_mode="Markdown"
+        elif new_status == "out_for_delivery":
+            await notify_customer_order_status(
+                context.bot, user_id, order_id, "out_for_delivery",
+                delivery_name=post.delivery_name,
+                delivery_phone=post.delivery_phone
             )
 
         # ✅ حالة أخرى (تحديث عام)
@@ -3860,6 +5674,17 @@ async def handle_confirm_cancellation(update: Update, context: CallbackContext)
         order_number = order_data.get("order_number", "؟")
         user_name = update.effective_user.full_name
         restaurant_channel_id = order_data.get("channel_id")
+        if not await transition_order(order_id, "cancelled", "user", {"reason": "تأخر بالموافقة"}):
+            context.user_data["cancel_history"].pop()
+            for key in ['orders', 'selected_restaurant', 'order_data']:
+                context.user_data.pop(key, None)
+            reply_markup = ReplyKeyboardMarkup([
+                ["اطلب عالسريع 🔥"],
+                ["لا بدي عدل 😐", "التواصل مع الدعم 🎧"],
+                ["من نحن 🏢", "أسئلة متكررة ❓"]
+            ], resize_keyboard=True)
+            await update.message.reply_text(ORDER_NOT_CANCELLABLE_TEXT, reply_markup=reply_markup)
+            return MAIN_MENU
     
         if restaurant_channel_id:
             await context.bot.send_message(
@@ -4055,18 +5880,6 @@ async def handle_reminder(update: Update, context: CallbackContext) -> int:
 
                 restaurant_id, restaurant_channel = result
 
-                # ✅ تأكد من وجود المطعم في جدول العدادات
-                await cursor.execute(
-                    "SELECT last_order_number FROM restaurant_order_counter WHERE restaurant_id = %s",
-                    (restaurant_id,)
-                )
-                if not await cursor.fetchone():
-                    await cursor.execute(
-                        "INSERT INTO restaurant_order_counter (restaurant_id, last_order_number) VALUES (%s, %s)",
-                        (restaurant_id, 0)
-                    )
-                    await conn.commit()
-
         if restaurant_channel and order_number:
             await context.bot.send_message(
                 chat_id=restaurant_channel,
@@ -4124,10 +5937,20 @@ async def handle_final_cancellation(update: Update, context: CallbackContext) ->
         restaurant_channel = order_data.get("channel_id")
         restaurant_id = order_data.get("restaurant_id")
         user_name = update.effective_user.first_name or "مستخدم"
+        cancelled = await transition_order(order_id, "cancelled", "user", {"reason": "تأخر بالموافقة"})
 
         # نحذف البيانات من السياق
         context.user_data.pop("order_data", None)
 
+        if not cancelled:
+            reply_markup = ReplyKeyboardMarkup([
+                ["اطلب عالسريع 🔥"],
+                ["لا بدي عدل 😐", "التواصل مع الدعم 🎧"],
+                ["من نحن 🏢", "أسئلة متكررة ❓"]
+            ], resize_keyboard=True)
+            await update.message.reply_text(ORDER_NOT_CANCELLABLE_TEXT, reply_markup=reply_markup)
+            return MAIN_MENU
+
         # محاولة جلب القناة من قاعدة البيانات إذا لم تكن موجودة
         if not restaurant_channel and restaurant_id:
             try:
@@ -4296,6 +6119,7 @@ async def process_report_cancellation(update: Update, context: CallbackContext)
     selected_restaurant = order_data.get("selected_restaurant", "غير متوفر")
     order_time = order_data.get("timestamp", datetime.now())
     cancel_time = datetime.now()
+    cancelled = await transition_order(order_id, "cancelled", "user", {"reason": reason})
 
     # 📨 إرسال تقرير إلى قناة الإدارة
     report_message = (
@@ -4315,16 +6139,19 @@ async def process_report_cancellation(update: Update, context: CallbackContext)
 
     await send_message_with_retry(context.bot, "@reports_cancel", text=report_message)
 
-    # 📣 إشعار قناة المطعم
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT channel FROM restaurants WHERE name = %s", (selected_restaurant,))
-                result = await cursor.fetchone()
-                restaurant_channel = result[0] if result else None
-    except Exception as e:
-        logger.error(f"❌ فشل في جلب قناة المطعم: {e}")
-        restaurant_channel = None
+    # 📣 إشعار قناة المطعم، فقط إذا أُلغي الطلب فعلًا (وليس مُسلّمًا أو مرفوضًا مسبقًا)
+    restaurant_channel = None
+    if cancelled:
+        try:
+            async with get_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute("SELECT channel FROM restaurants WHERE name = %s", (selected_restaurant,))
+                    result = await cursor.fetchone()
+                    restaurant_channel = result[0] if result else None
+        except Exception as e:
+            logger.error(f"❌ فشل في جلب قناة المطعم: {e}")
+    else:
+        logger.warning(f"⚠️ تقرير إلغاء لطلب لم يعد قابلًا للإلغاء: {order_id}")
 
     if restaurant_channel:
         await context.bot.send_message(
@@ -4352,7 +6179,8 @@ async def process_report_cancellation(update: Update, context: CallbackContext)
     ], resize_keyboard=True)
 
     await update.message.reply_text(
-        "✅ تم إلغاء طلبك وإرسال تقرير بالمشكلة. شكراً لتفهمك ❤️.",
+        "✅ تم إلغاء طلبك وإرسال تقرير بالمشكلة. شكراً لتفهمك ❤️." if cancelled
+        else f"{ORDER_NOT_CANCELLABLE_TEXT}\n📄 وصلنا تقريرك ورح نراجعه.",
         reply_markup=reply_markup
     )
 
@@ -4726,10 +6554,8 @@ async def request_rating(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("ليس لديك طلبات سابقة للتقييم.")
         return MAIN_MENU
 
-    # ✅ تخزين البيانات في conversation_state للاحتياط
-    await update_conversation_state(user_id, "rating_order_id", order_info["order_id"])
-    await update_conversation_state(user_id, "rating_order_number", order_info["order_number"])
-    await update_conversation_state(user_id, "rating_restaurant_id", order_info["restaurant_id"])
+    if "وصل طلبي" in text:
+        await transition_order(order_info["order_id"], "delivered", "user")
 
     # ✅ تخزين البيانات محليًا داخل السياق لتستخدم لاحقًا في pending_rating
     context.user_data["order_data"] = {
@@ -4761,19 +6587,14 @@ async def handle_rating_comment(update: Update, context: CallbackContext) -> int
 
     pending = context.user_data.get("pending_rating")
     if not pending:
-        # محاولة جلب البيانات من قاعدة البيانات المؤقتة
-        try:
-            state = await get_conversation_state(user_id)
-            pending = {
-                "restaurant_id": state.get("rating_restaurant_id"),
-                "order_id": state.get("rating_order_id"),
-                "order_number": state.get("rating_order_number"),
-                "stars": state.get("rating_stars") or context.user_data.get("temp_rating")
-            }
-        except Exception as e:
-            logger.error(f"❌ فشل في جلب بيانات التقييم الاحتياطية: {e}")
-            await update.message.reply_text("❌ لم نتمكن من متابعة التقييم. يرجى المحاولة لاحقاً.")
-            return MAIN_MENU
+        # user_data محفوظة عبر MySQLPersistence، فنعتمد على بيانات الطلب المخزنة فيها
+        order_data = context.user_data.get("order_data", {})
+        pending = {
+            "restaurant_id": order_data.get("restaurant_id"),
+            "order_id": order_data.get("order_id"),
+            "order_number": order_data.get("order_number"),
+            "stars": context.user_data.get("temp_rating")
+        }
 
     # استخراج البيانات
     restaurant_id = pending.get("restaurant_id")
@@ -4822,37 +6643,48 @@ async def handle_rating_comment(update: Update, context: CallbackContext) -> int
 async def send_rating_to_restaurant(bot, user_id, order_id, order_number, restaurant_id, rating, comment=None):
     try:
         async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                # تحقق من وجود تقييم سابق للمستخدم لهذا المطعم
-                await cursor.execute(
-                    "SELECT id FROM restaurant_ratings WHERE restaurant_id = %s AND user_id = %s",
-                    (restaurant_id, user_id)
-                )
-                existing_rating = await cursor.fetchone()
-                
-                if existing_rating:
-                    # تحديث التقييم الموجود
-                    await cursor.execute(
-                        "UPDATE restaurant_ratings SET rating = %s, comment = %s, created_at = NOW() WHERE restaurant_id = %s AND user_id = %s",
-                        (rating, comment, restaurant_id, user_id)
-                    )
-                else:
-                    # إضافة تقييم جديد
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    # تحقق من وجود تقييم سابق للمستخدم لهذا المطعم
                     await cursor.execute(
-                        "INSERT INTO restaurant_ratings (restaurant_id, user_id, rating, comment) VALUES (%s, %s, %s, %s)",
-                        (restaurant_id, user_id, rating, comment)
+                        "SELECT rating FROM restaurant_ratings WHERE restaurant_id = %s AND user_id = %s FOR UPDATE",
+                        (restaurant_id, user_id)
                     )
-                
+                    existing_rating = await cursor.fetchone()
+
+                    if existing_rating:
+                        # تحديث التقييم الموجود
+                        await cursor.execute(
+                            "UPDATE restaurant_ratings SET rating = %s, comment = %s, created_at = NOW() WHERE restaurant_id = %s AND user_id = %s",
+                            (rating, comment, restaurant_id, user_id)
+                        )
+                        count_delta, sum_delta = 0, rating - (existing_rating[0] or 0)
+                    else:
+                        # إضافة تقييم جديد
+                        await cursor.execute(
+                            "INSERT INTO restaurant_ratings (restaurant_id, user_id, rating, comment) VALUES (%s, %s, %s, %s)",
+                            (restaurant_id, user_id, rating, comment)
+                        )
+                        count_delta, sum_delta = 1, rating
+
+                    # تحديث ملخص التقييمات ضمن نفس المعاملة
+                    await update_rating_summary(cursor, restaurant_id, count_delta, sum_delta)
+
                 await conn.commit()
-                
-                # جلب قناة المطعم لإرسال التقييم
-                await cursor.execute("SELECT channel FROM restaurants WHERE id = %s", (restaurant_id,))
-                result = await cursor.fetchone()
+            except Exception:
+                await conn.rollback()
+                raise
 
-        if not result:
+        # تحديث متوسط التقييم المعروض في قائمة المطاعم
+        catalog_cache.invalidate_tag(("restaurant", restaurant_id))
+
+        # جلب قناة المطعم لإرسال التقييم
+        restaurant = await catalog_cache.restaurant(restaurant_id)
+        if not restaurant:
             return False
 
-        channel_id = result[0]
+        channel_id = restaurant["channel"]
         stars = "⭐" * rating
         message = f"المستخدم {user_id} استلم طلبه رقم {order_number} وقام بتقييمه بـ {stars}\n🆔 معرف الطلب: {order_id}\n"
         if comment and comment.strip():
@@ -4866,6 +6698,71 @@ async def send_rating_to_restaurant(bot, user_id, order_id, order_number, restau
         return False
 
 
+async def update_rating_summary(cursor, restaurant_id, count_delta, sum_delta):
+    """تطبيق فرق العدد والمجموع على ملخص تقييم المطعم (يُستدعى داخل معاملة التقييم)"""
+    await cursor.execute(
+        """
+        INSERT INTO restaurant_rating_summary (restaurant_id, rating_count, rating_sum)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            rating_count = rating_count + VALUES(rating_count),
+            rating_sum = rating_sum + VALUES(rating_sum)
+        """,
+        (restaurant_id, count_delta, sum_delta)
+    )
+
+
+async def remove_user_ratings_from_summary(cursor, user_ids):
+    """طرح تقييمات المستخدمين من الملخص قبل حذفهم (الحذف المتسلسل لا يمر على update_rating_summary)"""
+    if not user_ids:
+        return
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    await cursor.execute(
+        f"""
+        UPDATE restaurant_rating_summary s
+        JOIN (
+            SELECT restaurant_id, COUNT(*) AS cnt, COALESCE(SUM(rating), 0) AS total
+            FROM restaurant_ratings
+            WHERE user_id IN ({placeholders})
+            GROUP BY restaurant_id
+        ) r ON r.restaurant_id = s.restaurant_id
+        SET s.rating_count = s.rating_count - r.cnt,
+            s.rating_sum = s.rating_sum - r.total
+        """,
+        list(user_ids)
+    )
+
+
+async def rebuild_rating_summary(restaurant_id=None):
+    """إعادة حساب ملخص التقييمات من جدول restaurant_ratings بالكامل (للإصلاح)"""
+    where = "WHERE restaurant_id = %s" if restaurant_id else ""
+    params = (restaurant_id,) if restaurant_id else ()
+
+    async with get_db_connection() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cursor:
+                await cursor.execute(f"DELETE FROM restaurant_rating_summary {where}", params)
+                await cursor.execute(
+                    f"""
+                    INSERT INTO restaurant_rating_summary (restaurant_id, rating_count, rating_sum)
+                    SELECT restaurant_id, COUNT(*), COALESCE(SUM(rating), 0)
+                    FROM restaurant_ratings
+                    {where}
+                    GROUP BY restaurant_id
+                    """,
+                    params
+                )
+                rebuilt = cursor.rowcount
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+
+    logger.info(f"✅ تمت إعادة بناء ملخص التقييمات لـ {rebuilt} مطعم")
+    return rebuilt
+
+
 
 
 async def handle_report_based_cancellation(update: Update, context: CallbackContext):
@@ -4937,9 +6834,15 @@ async def handle_report_based_cancellation(update: Update, context: CallbackCont
 async def reset_user_and_restart(user_id: int, context: ContextTypes.DEFAULT_TYPE):
     try:
         async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("DELETE FROM user_data WHERE user_id = %s", (user_id,))
-            await conn.commit()
+            await conn.begin()
+            try:
+                async with conn.cursor() as cursor:
+                    await remove_user_ratings_from_summary(cursor, [user_id])
+                    await cursor.execute("DELETE FROM user_data WHERE user_id = %s", (user_id,))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
 
         await context.bot.send_message(
             chat_id=user_id,
@@ -5215,78 +7118,34 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
 # يمكنك وضع معرف القناة هنا (مثال: -1001234567890)
 DEVELOPER_CHAT_ID = -1002586617686  # 👈 ضع معرف قناتك هنا
 
-async def check_and_refresh_mysql():
-    """التحقق من أن الاتصال بقاعدة البيانات ما زال فعالًا"""
-    global pool
-    try:
-        async with pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT 1")
-                await cursor.fetchone()
-        logger.info("✅ اتصال MySQL سليم.")
-    except Exception as e:
-        logger.warning(f"⚠️ فقد الاتصال بقاعدة البيانات: {e}")
-
-        # محاولة إعادة الاتصال
-        try:
-            pool.close()
-            await pool.wait_closed()
-            logger.info("🔄 إعادة إنشاء اتصال MySQL...")
-
-            pool = await aiomysql.create_pool(
-                host=DB_HOST,
-                port=DB_PORT,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                db=DB_NAME,
-                autocommit=True,
-                minsize=1,
-                maxsize=10,
-                pool_recycle=3600
-            )
-
-            logger.info("✅ تم إنشاء الاتصال الجديد بنجاح.")
-
-            # إرسال إشعار بالنجاح
-            if 'app' in globals():
-                await app.bot.send_message(
-                    chat_id=DEVELOPER_CHAT_ID,
-                    text="✅ تمت استعادة الاتصال بقاعدة البيانات بنجاح."
-                )
-
-        except Exception as err:
-            logger.error(f"❌ فشل في إعادة الاتصال بقاعدة البيانات: {err}")
-
-            # إرسال إشعار بالفشل
-            if 'app' in globals():
-                await app.bot.send_message(
-                    chat_id=DEVELOPER_CHAT_ID,
-                    text=f"❌ فشل في إعادة الاتصال بقاعدة البيانات:\n{err}"
-                )
+async def on_startup(application: Application):
+    """تجهيز الموارد المشتركة قبل بدء استقبال التحديثات"""
+    await db_pool.start()
+    cart_cache.start()
+    catalog_cache.start()
+    media_resolver.start_migration(application.bot)
+    message_cleaner.start(application.bot)
+    order_outbox.start(application.bot)
 
 
-def schedule_mysql_watchdog(application):
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(check_and_refresh_mysql, "interval", minutes=5)
-    scheduler.start()
+async def on_shutdown(application: Application):
+    """تحرير الموارد المشتركة عند إيقاف البوت"""
+    # تفريغ السلال المعلقة قبل إغلاق الاتصالات
+    await cart_cache.close()
+    await catalog_cache.close()
+    await media_resolver.close()
+    await cart_summaries.close()
+    await message_cleaner.close()
+    await order_outbox.close()
+    await db_pool.close()
+    logger.info(f"🔒 أقفال المستخدمين: {user_locks.stats()}")
+    logger.info(f"📚 ذاكرة الكتالوج: {catalog_cache.stats()}")
 
 
 
 
 
 
-async def reset_order_counters():
-    logger.info("🔄 بدء تصفير عدادات الطلبات")
-    try:
-        async with get_db_connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("UPDATE restaurants SET order_counter = 0")
-                await conn.commit()
-                logger.info("✅ تم تصفير العدادات لجميع المطاعم")
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء تصفير العدادات: {e}", exc_info=True)
-
-
 async def dev_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     context.user_data.clear()
@@ -5299,6 +7158,13 @@ async def dev_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 result = await cursor.fetchone()
                 phone = result[0] if result else None
 
+                # المستخدمون الذين سيُحذفون (الحالي ومن يحمل نفس الرقم) لطرح تقييماتهم من الملخص
+                deleted_users = [user_id]
+                if phone:
+                    await cursor.execute("SELECT user_id FROM user_data WHERE phone = %s", (phone,))
+                    deleted_users += [row[0] for row in await cursor.fetchall() if row[0] != user_id]
+                await remove_user_ratings_from_summary(cursor, deleted_users)
+
                 # حذف جميع بيانات المستخدم
                 await cursor.execute("DELETE FROM conversation_states WHERE user_id = %s", (user_id,))
                 await cursor.execute("DELETE FROM shopping_carts WHERE user_id = %s", (user_id,))
@@ -5309,6 +7175,9 @@ async def dev_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
             await conn.commit()
 
+        # منع أي كتابة معلقة للسلة من إعادة إنشائها بعد الحذف
+        await delete_cart_from_db(user_id)
+
         await update.message.reply_text("✅ تم مسح بياناتك بالكامل، جاري البدء من جديد 🔄")
         # إعادة التوجيه إلى start() مباشرة
         return await start(update, context)
@@ -5417,6 +7286,7 @@ conv_handler = ConversationHandler(
         ORDER_MEAL: [
             CallbackQueryHandler(handle_add_meal_with_size, pattern="^add_meal_with_size:"),
             CallbackQueryHandler(handle_remove_specific_meal, pattern="^remove_specific_meal:"),
+            CallbackQueryHandler(handle_meal_carousel_page, pattern="^meal_page:"),
             CallbackQueryHandler(handle_done_adding_meals, pattern="^done_adding_meals$"),
             MessageHandler(filters.Regex("^القائمة الرئيسية 🪧$"), return_to_main_menu),
             MessageHandler(filters.Regex("^تم ✅$"), handle_done_adding_meals),
@@ -5482,48 +7352,21 @@ conv_handler = ConversationHandler(
         ]
 
     },
-     fallbacks=[CommandHandler("cancel", start)]
+     fallbacks=[CommandHandler("cancel", start)],
+    name="user_conversation",
+    persistent=True
 )
 
 
-ORDER_ID_PATTERNS = [
-    r"معرف الطلب:?\s*[`\"']?([\w\d\-]+)[`\"']?",
-    r"🆔.*?معرف الطلب:?\s*[`\"']?([\w\d\-]+)[`\"']?",
-    r"🆔\s*معرف الطلب:\s*`([^`]+)`",  # تنسيق جديد
-    r"order_id:?\s*[`\"']?([\w\d\-]+)[`\"']?"
-]
-
-
-ORDER_NUMBER_PATTERNS = [
-    r"رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
-    r"🔢.*?رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
-    r"🔢\s*رقم الطلب:\s*`(\d+)`",  # تنسيق جديد
-    r"order_number:?\s*[`\"']?(\d+)[`\"']?"
-]
-
-def extract_order_id(text):
-    """استخراج معرف الطلب من النص"""
-    for pattern in ORDER_ID_PATTERNS:
-        match = re.search(pattern, text)
-        if match:
-            logger.info(f"🎯 تم التطابق مع: {pattern}")
-            return match.group(1)
-    logger.warning(f"⚠️ لم يتم استخراج معرف الطلب من:\n{text}")
-    return None
-
-def extract_order_number(text):
-    """استخراج رقم الطلب من النص"""
-    for pattern in ORDER_NUMBER_PATTERNS:
-        match = re.search(pattern, text)
-        if match:
-            return int(match.group(1))
-    return None
-
-
-    
-
 def run_user_bot () :
-    application = Application.builder().token("8035364090:AAFlQC5slPnNBMnFUxyyZzxS5ltWkWZZ6CM").build()
+    application = (
+        Application.builder()
+        .token("8035364090:AAFlQC5slPnNBMnFUxyyZzxS5ltWkWZZ6CM")
+        .persistence(MySQLPersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     print("✅ logging initialized")
     logger.info("🚀 تم تشغيل البوت بنجاح وهو جاهز لاستقبال الأوامر.")
 
@@ -5552,7 +7395,10 @@ def run_user_bot () :
         handle_report_based_cancellation
     ))
     
-    # 3. باقي الرسائل النصية من القناة (fallback handler)
+    # أزرار الكاشير على رسائل الطلبات
+    application.add_handler(CallbackQueryHandler(handle_cashier_action, pattern="^ca:"))
+
+    # 3. باقي الرسائل النصية من القناة (مسار احتياطي للردود النصية القديمة)
     application.add_handler(MessageHandler(
         filters.ChatType.CHANNEL & filters.TEXT,
         handle_cashier_interaction
@@ -5578,17 +7424,89 @@ def run_user_bot () :
     # قاعدة البيانات إن وُجدت
     initialize_database()  # إذا كانت غير async
 
-    # المهام المجدولة
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(reset_order_counters, CronTrigger(hour=0, minute=0))
-    scheduler.start()
-
-    schedule_mysql_watchdog(application)
-
     # تشغيل البوت
     application.run_polling()
 
+async def run_rating_summary_rebuild():
+    """أمر صيانة: python3 user.py rebuild_rating_summary [restaurant_id]"""
+    restaurant_id = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    try:
+        await rebuild_rating_summary(restaurant_id)
+    finally:
+        await db_pool.close()
+
+
+# عينات بصيغ رسائل الكاشير الفعلية في القنوات، لقياس أداء المحلل
+CASHIER_POST_SAMPLES = (
+    "✅ تم قبول الطلب\n🔢 رقم الطلب: 17\n🆔 معرف الطلب: 3f2b9c1e-8a4d-4c55-9e0b-6d7a1f2e3c4b\n⏱️ وقت التوصيل المتوقع: 35 دقيقة",
+    "⏳ جاري تحضير الطلب\n🔢 رقم الطلب: `204`\n🆔 معرف الطلب: `a1b2c3d4-e5f6-4711-8899-aabbccddeeff`\n⏱️ وقت التوصيل المتوقع: 20 دقيقة",
+    "❌ تم رفض الطلب\n🆔 معرف الطلب: 9c8b7a6f-5e4d-4c3b-2a19-0f1e2d3c4b5a\nالسبب: خارج منطقة التوصيل",
+    "🚚 الطلب أصبح جاهزًا للتوصيل\n🔢 رقم الطلب: 58\n🆔 معرف الطلب: 0e9d8c7b-6a5f-4e3d-2c1b-a0f9e8d7c6b5\n🛵 الدليفري: أبو علي (0933123456)",
+    "📢 تأخير بسيط بسبب الضغط، نعتذر\n🆔 معرف الطلب: 77aa88bb-99cc-4dde-8eff-001122334455",
+    "order_id: 5d6e7f80-91a2-4b3c-8d4e-5f60718293a4\norder_number: 9\nتم قبول الطلب",
+    "رسالة في القناة بدون أي معرف للطلب، مثل تنبيه داخلي للكاشير حول الدوام",
+)
+
+
+def run_cashier_parser_benchmark():
+    """أمر صيانة: python3 user.py bench_cashier_parser [iterations]
+
+    يقارن المحلل الموحد بالطريقة السابقة (أربعة أنماط غير مترجمة لكل حقل ثم فحص الحالة من جديد).
+    """
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    legacy_id_patterns = [
+        r"معرف الطلب:?\s*[`\"']?([\w\d\-]+)[`\"']?",
+        r"🆔.*?معرف الطلب:?\s*[`\"']?([\w\d\-]+)[`\"']?",
+        r"🆔\s*معرف الطلب:\s*`([^`]+)`",
+        r"order_id:?\s*[`\"']?([\w\d\-]+)[`\"']?"
+    ]
+    legacy_number_patterns = [
+        r"رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
+        r"🔢.*?رقم الطلب:?\s*[`\"']?(\d+)[`\"']?",
+        r"🔢\s*رقم الطلب:\s*`(\d+)`",
+        r"order_number:?\s*[`\"']?(\d+)[`\"']?"
+    ]
+
+    def legacy_parse(text):
+        order_id = next((m.group(1) for m in (re.search(p, text) for p in legacy_id_patterns) if m), None)
+        number = next((m.group(1) for m in (re.search(p, text) for p in legacy_number_patterns) if m), None)
+        if "تم رفض الطلب" in text:
+            status = "rejected"
+        elif "تم قبول الطلب" in text or "جاري تحضير الطلب" in text:
+            status = "accepted"
+        elif "الطلب أصبح جاهزًا للتوصيل" in text:
+            status = "out_for_delivery"
+        else:
+            status = None
+        eta = re.search(r"⏱️ وقت التوصيل المتوقع:\s*(\d+)\s*دقيقة", text)
+        name = re.search(r"الدليفري:\s*(.*?)\s*\(", text)
+        phone = re.search(r"\((\d+)\)", text)
+        return order_id, number, status, eta, name, phone
+
+    for text in CASHIER_POST_SAMPLES:
+        post = parse_cashier_post(text)
+        legacy = legacy_parse(text)
+        if (post.order_id, post.status) != (legacy[0], legacy[2]):
+            print(f"⚠️ اختلاف في التحليل:\n{text}")
+
+    for label, parse in (("legacy", legacy_parse), ("combined", parse_cashier_post)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for text in CASHIER_POST_SAMPLES:
+                parse(text)
+        elapsed = time.perf_counter() - started
+        per_message = elapsed / (iterations * len(CASHIER_POST_SAMPLES)) * 1e6
+        print(f"{label:>9}: {elapsed:.3f}s  ({per_message:.2f}µs لكل رسالة)")
+
+
 if __name__ == "__main__":
-    run_user_bot()
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild_rating_summary":
+        initialize_database()
+        asyncio.run(run_rating_summary_rebuild())
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench_cashier_parser":
+        run_cashier_parser_benchmark()
+    else:
+        run_user_bot()
 
 